@@ -1,6 +1,10 @@
 from django.contrib import admin
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
+from django.utils.html import format_html
 
-from .models import Category, Region, Appellation, Format, Grape, Reference, Purchase
+from .models import Category, Region, Appellation, Format, Grape, Reference, Purchase, Profile
 
 admin.site.register(Category)
 admin.site.register(Region)
@@ -9,3 +13,44 @@ admin.site.register(Format)
 admin.site.register(Grape)
 admin.site.register(Reference)
 admin.site.register(Purchase)
+
+
+@admin.register(Profile)
+class ProfileAdmin(admin.ModelAdmin):
+    """Request profiles, read-only, downloadable for flame graph tools."""
+
+    list_display = ["created_at", "method", "path", "status", "duration_ms", "samples", "user", "download"]
+    list_filter = ["route", "method"]
+    search_fields = ["path"]
+    exclude = ["stacks"]
+    readonly_fields = ["download"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description="Collapsed stacks")
+    def download(self, obj):
+        return format_html(
+            '<a href="{}">profile-{}.folded</a>',
+            reverse("admin:cave_profile_download", args=[obj.pk]), obj.pk,
+        )
+
+    def get_urls(self):
+        return [
+            path(
+                "<int:pk>/download/",
+                self.admin_site.admin_view(self.download_view),
+                name="cave_profile_download",
+            ),
+        ] + super().get_urls()
+
+    def download_view(self, request, pk):
+        profile = get_object_or_404(Profile, pk=pk)
+        if not self.has_view_permission(request, profile):
+            return HttpResponse(status=403)
+        response = HttpResponse(profile.stacks, content_type="text/plain; charset=utf-8")
+        response["Content-Disposition"] = f'attachment; filename="profile-{pk}.folded"'
+        return response
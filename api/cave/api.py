@@ -1,26 +1,60 @@
+import codecs
+import functools
+import hashlib
 import math
-from typing import List, Optional
+import re
+from typing import Dict, List, Literal, Optional, Union
 from datetime import datetime
 
 from django.conf import settings
-from django.db.models import Q
-from django.http import Http404, HttpResponse
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Q, Sum, Value, prefetch_related_objects
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.template.loader import render_to_string
 
 import ninja
+import pydantic
+from ninja import File, UploadedFile
+from ninja.decorators import decorate_view
 from ninja.pagination import paginate as ninja_paginate
 from ninja.security import django_auth
+from psycopg2 import errorcodes
 import sqids
-
-from .models import Reference, Purchase, Category, Region, Appellation, Format, Grape, MenuTemplate
-
-
+from sqids.constants import DEFAULT_BLOCKLIST
+
+from . import export, importer, lookup_cache, pos, timing
+from .compression import precompress
+from .models import (
+    Reference, Purchase, Category, Region, Appellation, Format, Grape, MenuTemplate,
+    StockMovement, Tombstone,
+)
+from .versioning import (
+    cellar_conditional, cellar_user_etag, get_cellar_version, request_cellar_version, touch,
+)
+
+
+# The full encoder checks each candidate against its blocklist one word at
+# a time, which costs more than serializing the rest of a reference.
+# Candidates are encoded without it and checked with one regex instead;
+# only the few that match go through the full encoder, so ids are the same.
+# The regex follows the encoder's rules for ids longer than 3 characters:
+# words with a digit may not start or end the id, others may not appear.
+_unchecked_sqids = sqids.Sqids(min_length=8, blocklist=[])
 sqids = sqids.Sqids(min_length=8)
+_blocked_words = {word.lower() for word in DEFAULT_BLOCKLIST if len(word) > 3}
+_affixes = "|".join(sorted(re.escape(w) for w in _blocked_words if any(c.isdigit() for c in w)))
+_anywhere = "|".join(sorted(re.escape(w) for w in _blocked_words if not any(c.isdigit() for c in w)))
+_blocked = re.compile(rf"\A(?:{_affixes})|(?:{_affixes})\Z|{_anywhere}")
 
 
 def sqid_encode(id: int):
-    return sqids.encode([id])
+    candidate = _unchecked_sqids.encode([id])
+    if _blocked.search(candidate.lower()):
+        return sqids.encode([id])
+    return candidate
 
 
 def sqid_decode(sqid: str):
@@ -30,12 +64,15 @@ def sqid_decode(sqid: str):
         raise Http404 from exc
 
 
-api = ninja.NinjaAPI(auth=django_auth)
+api = timing.NinjaAPI(auth=django_auth)
 
+# Read endpoints answer If-None-Match with a 304 as long as
+# the cellar version has not moved, without running their queries.
+conditional = decorate_view(cellar_conditional)
+# Same, for responses that also show the user: saving it changes their ETag.
+conditional_on_user = decorate_view(functools.partial(cellar_conditional, etag_func=cellar_user_etag))
 
-@api.get("/healthcheck", auth=None)
-def status(request):
-    return {}
+MENU_CACHE_TIMEOUT = 60 * 60 * 24
 
 
 @api.get("/config", auth=None)
@@ -48,6 +85,44 @@ def get_current_user(request):
     return {"email": request.user.email}
 
 
+BOOTSTRAP_LOOKUPS = [
+    ("categories", Category),
+    ("regions", Region),
+    ("appellations", Appellation),
+    ("formats", Format),
+    ("grapes", Grape),
+]
+
+
+@api.get("/bootstrap", auth=None)
+@conditional_on_user
+def bootstrap(request):
+    """Everything the UI needs on load: config, user, lookups and locations.
+
+    Lookup names and locations come from a single UNION query.
+    """
+    data = {"config": {"oidc_enabled": settings.OIDC_ENABLED}, "me": None}
+    if not request.user.is_authenticated:
+        return data
+
+    data["me"] = {"email": request.user.email}
+    data["locations"] = []
+    queries = [
+        model.objects.annotate(kind=Value(kind)).values_list("kind", "name")
+        for kind, model in BOOTSTRAP_LOOKUPS
+    ]
+    data.update((kind, []) for kind, _ in BOOTSTRAP_LOOKUPS)
+    locations = (
+        Reference.objects.exclude(location__isnull=True)
+        .exclude(location="")
+        .annotate(kind=Value("locations"))
+        .values_list("kind", "location")
+    )
+    for kind, name in queries[0].union(*queries[1:], locations).order_by("kind", "name"):
+        data[kind].append(name)
+    return data
+
+
 class ReferenceIn(ninja.Schema):
     name: str
     category: Optional[str] = None
@@ -81,22 +156,44 @@ class PurchaseOut(ninja.Schema):
     price: float
 
 
+def _retail_price(override, multiplier, total_value, total_qty):
+    """Retail price from purchase totals: override or avg price × multiplier (ceiling)"""
+    if override:
+        return float(override)
+    if not total_qty:
+        return None
+
+    avg_price = float(total_value) / total_qty
+    return math.ceil(avg_price * float(multiplier))
+
+
 def _compute_retail_price(obj):
     """Compute retail price: override or avg_purchase_price × multiplier (ceiling)"""
     if obj.retail_price_override:
         return float(obj.retail_price_override)
 
     purchases = obj.purchases.all()
-    if not purchases:
-        return None
+    return _retail_price(
+        None,
+        obj.price_multiplier,
+        sum(float(p.price) * p.quantity for p in purchases),
+        sum(p.quantity for p in purchases),
+    )
+
+
+def _purchase_out(purchase):
+    return {
+        "id": purchase.id,
+        "date": purchase.date.isoformat(),
+        "quantity": purchase.quantity,
+        "price": float(purchase.price),
+    }
 
-    total_value = sum(float(p.price) * p.quantity for p in purchases)
-    total_qty = sum(p.quantity for p in purchases)
-    if total_qty == 0:
-        return None
 
-    avg_price = total_value / total_qty
-    return math.ceil(avg_price * float(obj.price_multiplier))
+def _purchase_data(purchase_in):
+    data = purchase_in.dict()
+    data["date"] = datetime.fromisoformat(data["date"]).date()
+    return data
 
 
 class ReferenceOut(ninja.Schema):
@@ -140,7 +237,7 @@ class ReferenceOut(ninja.Schema):
 
     @staticmethod
     def resolve_grapes(obj):
-        return list(obj.grapes.values_list("name", flat=True))
+        return [g.name for g in obj.grapes.all()]
 
     @staticmethod
     def resolve_retail_price(obj):
@@ -148,129 +245,193 @@ class ReferenceOut(ninja.Schema):
 
     @staticmethod
     def resolve_purchases(obj):
-        return [
-            {
-                "id": p.id,
-                "date": p.date.isoformat(),
-                "quantity": p.quantity,
-                "price": float(p.price),
-            }
-            for p in obj.purchases.all()
-        ]
+        return [_purchase_out(p) for p in obj.purchases.all()]
+
+
+def _with_reference_out(queryset):
+    """Load everything ReferenceOut reads, in a fixed number of queries."""
+    return queryset.select_related(
+        "category", "region", "appellation", "format"
+    ).prefetch_related("grapes", "purchases")
 
 
 def _cleanup_orphaned_lookups(lookups):
-    for instance in lookups:
-        if instance is not None and instance.references.count() == 0:
-            instance.delete()
+    """Delete the candidate lookups no reference uses anymore.
 
+    Runs once the surrounding transaction has committed, as one DELETE per
+    lookup type, so writes do not hold their locks while it runs.
+    """
+    candidates = {}
+    for instance in lookups:
+        if instance is not None:
+            candidates.setdefault(type(instance), set()).add(instance.pk)
+
+    def cleanup():
+        for model, ids in candidates.items():
+            model.objects.delete_orphans(ids)
+
+    if candidates:
+        transaction.on_commit(cleanup, robust=True)
+
+
+LOOKUP_FIELDS = {
+    "category": Category,
+    "region": Region,
+    "appellation": Appellation,
+    "format": Format,
+}
+
+
+def _resolve_lookups(payloads, cached=True):
+    """Resolve every lookup name used by ReferenceIn payloads, per lookup type.
+
+    With cached, ids known to this process are used without a query; the
+    write must then go through _retry_stale_lookups.
+    """
+    names = {field: set() for field in [*LOOKUP_FIELDS, "grapes"]}
+    for data in payloads:
+        for field in LOOKUP_FIELDS:
+            if data.get(field):
+                names[field].add(data[field])
+        names["grapes"].update(data.get("grapes") or [])
+    models = {**LOOKUP_FIELDS, "grapes": Grape}
+    return {
+        field: (models[field].objects.resolve if cached else models[field].objects.upsert)(field_names)
+        for field, field_names in names.items()
+    }
 
-@api.post("/ref")
-def create_reference(request, reference_in: ReferenceIn):
-    data = reference_in.dict()
 
-    if data.get("category"):
-        category, _ = Category.objects.get_or_create(name=data["category"])
-        data["category"] = category
+# Tables whose foreign keys to lookups are set from _resolve_lookups.
+LOOKUP_REFERRERS = {Reference._meta.db_table, Reference.grapes.through._meta.db_table}
 
-    if data.get("region"):
-        region, _ = Region.objects.get_or_create(name=data["region"])
-        data["region"] = region
 
-    if data.get("appellation"):
-        appellation, _ = Appellation.objects.get_or_create(name=data["appellation"])
-        data["appellation"] = appellation
+def _retry_stale_lookups(write):
+    """Run write() in a transaction; again if a cached lookup id was deleted.
 
-    if data.get("format"):
-        fmt, _ = Format.objects.get_or_create(name=data["format"])
-        data["format"] = fmt
+    An orphan cleanup may delete a lookup whose id this process cached
+    between _resolve_lookups and the commit, where the deferred foreign
+    key check then fails. The process forgets its ids, and the second
+    run upserts the names instead.
+    """
+    try:
+        with transaction.atomic():
+            return write()
+    except IntegrityError as exc:
+        cause = exc.__cause__
+        if (
+            connection.in_atomic_block
+            or getattr(cause, "pgcode", None) != errorcodes.FOREIGN_KEY_VIOLATION
+            or cause.diag.table_name not in LOOKUP_REFERRERS
+        ):
+            raise
+    lookup_cache.forget()
+    with transaction.atomic():
+        return write()
+
+
+REFERENCE_FIELDS = [
+    field.name for field in Reference._meta.concrete_fields
+    if not field.primary_key and field.name != "current_quantity"
+]
+
+
+def _save_reference(reference, data, lookups, user=None):
+    """Apply a ReferenceIn payload to a reference and save it.
+
+    Returns the lookups the reference stopped using, as orphan candidates.
+    """
+    creating = reference.pk is None
+    orphans = [] if creating else _lookup_stubs(reference)
+
+    for field in LOOKUP_FIELDS:
+        name = data.pop(field, None)
+        setattr(reference, field, lookups[field][name] if name else None)
 
     grape_names = data.pop("grapes", None)
+    quantity = data.pop("current_quantity", None)
 
-    reference = Reference.objects.create(**data)
+    for attr, value in data.items():
+        setattr(reference, attr, value)
 
-    if grape_names:
-        grape_objects = [Grape.objects.get_or_create(name=n)[0] for n in grape_names]
-        reference.grapes.set(grape_objects)
+    if creating:
+        reference.current_quantity = quantity or 0
+        reference.save(movement_user=user)
+    else:
+        # The quantity is not written back from the loaded row; a changed
+        # value is recorded as a correction in the ledger, under the version
+        # the save just took.
+        reference.save(update_fields=REFERENCE_FIELDS)
+        if quantity is not None:
+            updated = Reference.objects.set_quantities(
+                [(reference.pk, quantity, None)], user=user, version=reference.version
+            )
+            reference.current_quantity = updated[reference.pk]
 
-    return {"sqid": sqids.encode([reference.id])}
+    if grape_names is not None:
+        if not creating:
+            orphans += list(reference.grapes.all())
+        reference.grapes.set([lookups["grapes"][name] for name in grape_names])
 
+    return orphans
 
-@api.put("/ref/{sqid}", response=ReferenceOut)
-def update_reference(request, sqid: str, payload: ReferenceIn):
-    reference = get_object_or_404(Reference, id=sqid_decode(sqid))
-    data = payload.dict()
 
-    old_lookups = [
-        reference.category, reference.region,
-        reference.appellation, reference.format,
+def _lookup_stubs(reference):
+    """The reference's current lookups, as pk-only instances: no query."""
+    return [
+        model(pk=getattr(reference, f"{field}_id"))
+        for field, model in LOOKUP_FIELDS.items()
+        if getattr(reference, f"{field}_id") is not None
     ]
 
-    if "category" in data:
-        if data["category"]:
-            category, _ = Category.objects.get_or_create(name=data["category"])
-            reference.category = category
-        else:
-            reference.category = None
-        del data["category"]
-
-    if "region" in data:
-        if data["region"]:
-            region, _ = Region.objects.get_or_create(name=data["region"])
-            reference.region = region
-        else:
-            reference.region = None
-        del data["region"]
-
-    if "appellation" in data:
-        if data["appellation"]:
-            appellation, _ = Appellation.objects.get_or_create(name=data["appellation"])
-            reference.appellation = appellation
-        else:
-            reference.appellation = None
-        del data["appellation"]
-
-    if "format" in data:
-        if data["format"]:
-            fmt, _ = Format.objects.get_or_create(name=data["format"])
-            reference.format = fmt
-        else:
-            reference.format = None
-        del data["format"]
 
-    grape_names = data.pop("grapes", None)
+def _delete_reference(reference):
+    """Delete a reference; return its lookups as orphan candidates."""
+    orphans = _lookup_stubs(reference)
+    orphans += list(reference.grapes.all())
+    reference.delete()
+    return orphans
 
-    for attr, value in data.items():
-        setattr(reference, attr, value)
 
-    reference.save()
+@api.post("/ref")
+def create_reference(request, reference_in: ReferenceIn):
+    def write():
+        data = reference_in.dict()
+        reference = Reference()
+        _save_reference(reference, data, _resolve_lookups([data]), request.user)
+        return reference
+
+    return {"sqid": sqid_encode(_retry_stale_lookups(write).id)}
 
-    if grape_names is not None:
-        old_grapes = list(reference.grapes.all())
-        grape_objects = [Grape.objects.get_or_create(name=n)[0] for n in grape_names]
-        reference.grapes.set(grape_objects)
-        _cleanup_orphaned_lookups(old_grapes)
 
-    _cleanup_orphaned_lookups(old_lookups)
+@api.put("/ref/{sqid}", response=ReferenceOut)
+def update_reference(request, sqid: str, payload: ReferenceIn):
+    reference_id = sqid_decode(sqid)
+
+    def write():
+        reference = get_object_or_404(Reference, id=reference_id)
+        data = payload.dict()
+        orphans = _save_reference(reference, data, _resolve_lookups([data]), request.user)
+        _cleanup_orphaned_lookups(orphans)
+        return reference
+
+    reference = _retry_stale_lookups(write)
+    # The retail price and the purchase list both read the purchases.
+    prefetch_related_objects([reference], "purchases")
     return reference
 
 
 @api.delete("/ref/{sqid}")
 def delete_reference(request, sqid: str):
     reference = get_object_or_404(Reference, id=sqid_decode(sqid))
-    old_lookups = [
-        reference.category, reference.region,
-        reference.appellation, reference.format,
-    ]
-    old_grapes = list(reference.grapes.all())
-    reference.delete()
-    _cleanup_orphaned_lookups(old_lookups + old_grapes)
+    with transaction.atomic():
+        _cleanup_orphaned_lookups(_delete_reference(reference))
     return {}
 
 
 @api.get("/ref/{sqid}", response=ReferenceOut)
+@conditional
 def get_reference(request, sqid: str):
-    return get_object_or_404(Reference, id=sqid_decode(sqid))
+    return get_object_or_404(_with_reference_out(Reference.objects), id=sqid_decode(sqid))
 
 
 def _search_word(word):
@@ -289,9 +450,10 @@ def _search_word(word):
 
 
 @api.get("/refs", response=List[ReferenceOut])
+@conditional
 @ninja_paginate
 def list_reference(request, search: str = None, location: str = None):
-    qs = Reference.objects.all()
+    qs = _with_reference_out(Reference.objects.all())
 
     if location:
         qs = qs.filter(location=location)
@@ -308,6 +470,7 @@ def list_reference(request, search: str = None, location: str = None):
 
 
 @api.get("/locations", response=List[str])
+@conditional
 def list_locations(request):
     """Get distinct non-empty location values, sorted alphabetically"""
     return list(
@@ -319,10 +482,29 @@ def list_locations(request):
     )
 
 
-@api.get("/categories", response=List[str])
-def list_categories(request):
+class LookupCountOut(ninja.Schema):
+    name: str
+    count: int
+
+
+LookupList = Union[List[str], List[LookupCountOut]]
+
+
+def _list_lookup(model, counts):
+    """Names of a lookup table; with counts, how many references use each."""
+    if counts:
+        return [
+            {"name": name, "count": count}
+            for name, count in model.objects.values_list("name", "reference_count")
+        ]
+    return list(model.objects.values_list("name", flat=True))
+
+
+@api.get("/categories", response=LookupList)
+@conditional
+def list_categories(request, counts: bool = False):
     """Get all categories"""
-    return list(Category.objects.values_list("name", flat=True))
+    return _list_lookup(Category, counts)
 
 
 class CategoryIn(ninja.Schema):
@@ -332,14 +514,15 @@ class CategoryIn(ninja.Schema):
 @api.post("/categories")
 def create_category(request, category_in: CategoryIn):
     """Create a new category"""
-    category, created = Category.objects.get_or_create(name=category_in.name)
+    category, created = Category.objects.upsert_one(category_in.name)
     return {"name": category.name, "created": created}
 
 
-@api.get("/regions", response=List[str])
-def list_regions(request):
+@api.get("/regions", response=LookupList)
+@conditional
+def list_regions(request, counts: bool = False):
     """Get all regions"""
-    return list(Region.objects.values_list("name", flat=True))
+    return _list_lookup(Region, counts)
 
 
 class RegionIn(ninja.Schema):
@@ -349,14 +532,15 @@ class RegionIn(ninja.Schema):
 @api.post("/regions")
 def create_region(request, region_in: RegionIn):
     """Create a new region"""
-    region, created = Region.objects.get_or_create(name=region_in.name)
+    region, created = Region.objects.upsert_one(region_in.name)
     return {"name": region.name, "created": created}
 
 
-@api.get("/appellations", response=List[str])
-def list_appellations(request):
+@api.get("/appellations", response=LookupList)
+@conditional
+def list_appellations(request, counts: bool = False):
     """Get all appellations"""
-    return list(Appellation.objects.values_list("name", flat=True))
+    return _list_lookup(Appellation, counts)
 
 
 class AppellationIn(ninja.Schema):
@@ -366,14 +550,15 @@ class AppellationIn(ninja.Schema):
 @api.post("/appellations")
 def create_appellation(request, appellation_in: AppellationIn):
     """Create a new appellation"""
-    appellation, created = Appellation.objects.get_or_create(name=appellation_in.name)
+    appellation, created = Appellation.objects.upsert_one(appellation_in.name)
     return {"name": appellation.name, "created": created}
 
 
-@api.get("/formats", response=List[str])
-def list_formats(request):
+@api.get("/formats", response=LookupList)
+@conditional
+def list_formats(request, counts: bool = False):
     """Get all formats"""
-    return list(Format.objects.values_list("name", flat=True))
+    return _list_lookup(Format, counts)
 
 
 class FormatIn(ninja.Schema):
@@ -383,13 +568,14 @@ class FormatIn(ninja.Schema):
 @api.post("/formats")
 def create_format(request, format_in: FormatIn):
     """Create a new format"""
-    fmt, created = Format.objects.get_or_create(name=format_in.name)
+    fmt, created = Format.objects.upsert_one(format_in.name)
     return {"name": fmt.name, "created": created}
 
 
-@api.get("/grapes", response=List[str])
-def list_grapes(request):
-    return list(Grape.objects.values_list("name", flat=True))
+@api.get("/grapes", response=LookupList)
+@conditional
+def list_grapes(request, counts: bool = False):
+    return _list_lookup(Grape, counts)
 
 
 class GrapeIn(ninja.Schema):
@@ -398,7 +584,7 @@ class GrapeIn(ninja.Schema):
 
 @api.post("/grapes")
 def create_grape(request, grape_in: GrapeIn):
-    grape, created = Grape.objects.get_or_create(name=grape_in.name)
+    grape, created = Grape.objects.upsert_one(grape_in.name)
     return {"name": grape.name, "created": created}
 
 
@@ -410,21 +596,275 @@ class CategoryColorIn(ninja.Schema):
 @api.put("/categories/color")
 def update_category_color(request, color_in: CategoryColorIn):
     """Update the color of a category"""
-    Category.objects.filter(name=color_in.name).update(color=color_in.color)
+    touch(Category.objects.filter(name=color_in.name), color=color_in.color)
     return {"success": True}
 
 
 class QuantityUpdateIn(ninja.Schema):
     quantity: int
+    # Only apply if the stored quantity still has this value.
+    expected: Optional[int] = None
+
+
+class QuantityAdjustIn(ninja.Schema):
+    delta: int
+    expected: Optional[int] = None
+    # Refuse adjustments that would take the quantity below zero.
+    floor_at_zero: bool = False
+    reason: StockMovement.Reason = StockMovement.Reason.ADJUSTMENT
 
 
-@api.put("/ref/{sqid}/quantity")
+def _quantity_conflict(reference_id):
+    current = (
+        Reference.objects.filter(id=reference_id)
+        .values_list("current_quantity", flat=True)
+        .first()
+    )
+    if current is None:
+        raise Http404
+    return 409, {"detail": "Quantity guard failed", "quantity": current}
+
+
+@api.put("/ref/{sqid}/quantity", response={200: dict, 409: dict})
 def update_reference_quantity(request, sqid: str, quantity_in: QuantityUpdateIn):
     """Update the current quantity of a reference"""
-    reference = get_object_or_404(Reference, id=sqid_decode(sqid))
-    reference.current_quantity = quantity_in.quantity
-    reference.save()
-    return {"success": True, "quantity": reference.current_quantity}
+    reference_id = sqid_decode(sqid)
+    updated = Reference.objects.set_quantities(
+        [(reference_id, quantity_in.quantity, quantity_in.expected)], user=request.user
+    )
+    if reference_id not in updated:
+        return _quantity_conflict(reference_id)
+    return {"success": True, "quantity": updated[reference_id]}
+
+
+@api.post("/ref/{sqid}/quantity/adjust", response={200: dict, 409: dict})
+def adjust_reference_quantity(request, sqid: str, adjust_in: QuantityAdjustIn):
+    """Add a delta to the current quantity, atomically in the database"""
+    reference_id = sqid_decode(sqid)
+    updated = Reference.objects.adjust_quantities(
+        [(reference_id, adjust_in.delta, adjust_in.expected)],
+        adjust_in.floor_at_zero,
+        adjust_in.reason,
+        request.user,
+    )
+    if reference_id not in updated:
+        return _quantity_conflict(reference_id)
+    return {"success": True, "quantity": updated[reference_id]}
+
+
+class QuantityAdjustItem(ninja.Schema):
+    sqid: str
+    delta: int
+    expected: Optional[int] = None
+
+
+class QuantitiesAdjustIn(ninja.Schema):
+    adjustments: List[QuantityAdjustItem]
+    floor_at_zero: bool = False
+    reason: StockMovement.Reason = StockMovement.Reason.ADJUSTMENT
+    atomic: bool = True
+
+
+@api.post("/quantities/adjust", response={200: dict, 400: dict, 409: dict})
+def adjust_quantities(request, payload: QuantitiesAdjustIn):
+    """Adjust many quantities with a single UPDATE.
+
+    When `atomic` is set (the default), nothing is applied unless every
+    adjustment passes its guards, and the response is a 409.
+    """
+    items = payload.adjustments
+    if len(items) > MAX_BATCH_SIZE:
+        return 400, {"detail": f"At most {MAX_BATCH_SIZE} adjustments per request"}
+    ids = [next(iter(sqids.decode(item.sqid)), None) for item in items]
+    known = [pk for pk in ids if pk is not None]
+    if len(set(known)) != len(known):
+        return 400, {"detail": "Each reference can only be adjusted once per request"}
+
+    with transaction.atomic():
+        updated = Reference.objects.adjust_quantities(
+            [(pk, item.delta, item.expected) for pk, item in zip(ids, items) if pk is not None],
+            payload.floor_at_zero,
+            payload.reason,
+            request.user,
+        )
+        current = dict(
+            Reference.objects.filter(id__in=set(known) - updated.keys())
+            .values_list("id", "current_quantity")
+        )
+        results = []
+        for pk, item in zip(ids, items):
+            if pk in updated:
+                results.append({"sqid": item.sqid, "ok": True, "quantity": updated[pk]})
+            elif pk in current:
+                results.append({
+                    "sqid": item.sqid, "ok": False, "error": "quantity guard failed",
+                    "quantity": current[pk],
+                })
+            else:
+                results.append({"sqid": item.sqid, "ok": False, "error": "reference not found"})
+        if payload.atomic and len(updated) < len(items):
+            transaction.set_rollback(True)
+            return 409, {"committed": False, "results": results}
+    return 200, {"committed": True, "results": results}
+
+
+class MovementOut(ninja.Schema):
+    id: int
+    sqid: str
+    delta: int
+    reason: str
+    user: Optional[str]
+    created_at: str
+
+
+class MovementPage(ninja.Schema):
+    items: List[MovementOut]
+    # Pass as `before` to fetch the next, older page.
+    next: Optional[int]
+
+
+MAX_MOVEMENT_PAGE = 1000
+
+
+def _movement_page(queryset, since, until, before, limit):
+    """Newest-first movements, keyset-paginated on (created_at, id)."""
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lt=until)
+    if before is not None:
+        anchor = StockMovement.objects.filter(pk=before).values_list("created_at", flat=True).first()
+        if anchor is not None:
+            queryset = queryset.filter(
+                Q(created_at__lt=anchor) | Q(created_at=anchor, id__lt=before)
+            )
+    limit = max(1, min(limit, MAX_MOVEMENT_PAGE))
+    rows = list(
+        queryset.order_by("-created_at", "-id").values_list(
+            "id", "reference_id", "delta", "reason", "user__email", "created_at"
+        )[:limit + 1]
+    )
+    items = [
+        {
+            "id": pk,
+            "sqid": sqid_encode(reference_id),
+            "delta": delta,
+            "reason": reason,
+            "user": email,
+            "created_at": created_at.isoformat(),
+        }
+        for pk, reference_id, delta, reason, email, created_at in rows[:limit]
+    ]
+    return {"items": items, "next": items[-1]["id"] if len(rows) > limit else None}
+
+
+@api.get("/ref/{sqid}/movements", response=MovementPage)
+@conditional
+def list_reference_movements(
+    request, sqid: str, since: datetime = None, until: datetime = None,
+    before: int = None, limit: int = 100,
+):
+    """Stock history of a reference"""
+    queryset = StockMovement.objects.filter(reference_id=sqid_decode(sqid))
+    return _movement_page(queryset, since, until, before, limit)
+
+
+@api.get("/movements", response=MovementPage)
+@conditional
+def list_movements(
+    request, since: datetime = None, until: datetime = None,
+    reason: StockMovement.Reason = None, before: int = None, limit: int = 100,
+):
+    """Stock history of the whole cellar"""
+    queryset = StockMovement.objects.all()
+    if reason:
+        queryset = queryset.filter(reason=reason)
+    return _movement_page(queryset, since, until, before, limit)
+
+
+@api.get("/movements/summary", response=List[dict])
+@conditional
+def movements_summary(request, since: datetime = None, until: datetime = None):
+    """Net stock change per reference and reason over a period, e.g. consumption"""
+    queryset = StockMovement.objects.all()
+    if since:
+        queryset = queryset.filter(created_at__gte=since)
+    if until:
+        queryset = queryset.filter(created_at__lt=until)
+    rows = (
+        queryset.order_by()
+        .values_list("reference_id", "reason")
+        .annotate(total=Sum("delta"))
+        .order_by("reference_id", "reason")
+    )
+    return [
+        {"sqid": sqid_encode(reference_id), "reason": reason, "delta": total}
+        for reference_id, reason, total in rows
+    ]
+
+
+@api.post("/pos/sales")
+def ingest_pos_sales(request, format: Literal["ndjson", "csv"] = None):
+    """Apply point-of-sale events streamed in the body as NDJSON or CSV.
+
+    The body is read line by line, so large uploads are not buffered.
+    Events carry their own ids, so a failed upload can simply be resent.
+    """
+    if format is None:
+        format = "csv" if request.content_type == "text/csv" else "ndjson"
+    return pos.ingest(codecs.iterdecode(request, "utf-8"), format, request.user)
+
+
+class SyncOut(ninja.Schema):
+    token: str
+    full: bool
+    references: List[ReferenceOut]
+    categories: List[dict]
+    regions: List[dict]
+    appellations: List[dict]
+    formats: List[dict]
+    grapes: List[dict]
+    deleted: Dict[str, list]
+
+
+@api.get("/sync", response=SyncOut)
+def sync(request, since: int = None):
+    """Rows changed since a previous token, plus tombstones for deletions.
+
+    Without `since` (or with a token from another timeline) everything is
+    returned and `full` is set, telling the client to replace its copy.
+    """
+    # Read the token first: every version up to it is already committed.
+    token = get_cellar_version()
+    full = since is None or since > token
+
+    def changed(qs):
+        if not full:
+            qs = qs.filter(version__gt=since)
+        return qs.filter(version__lte=token)
+
+    references = _with_reference_out(changed(Reference.objects.all()))
+
+    deleted = {}
+    if not full:
+        for model, object_id in changed(Tombstone.objects.all()).values_list(
+            "model", "object_id"
+        ):
+            deleted.setdefault(model, []).append(
+                sqid_encode(object_id) if model == "reference" else object_id
+            )
+
+    return {
+        "token": str(token),
+        "full": full,
+        "references": references,
+        "categories": list(changed(Category.objects.all()).values("id", "name", "color")),
+        "regions": list(changed(Region.objects.all()).values("id", "name")),
+        "appellations": list(changed(Appellation.objects.all()).values("id", "name")),
+        "formats": list(changed(Format.objects.all()).values("id", "name")),
+        "grapes": list(changed(Grape.objects.all()).values("id", "name")),
+        "deleted": deleted,
+    }
 
 
 class MenuTemplateIn(ninja.Schema):
@@ -432,6 +872,7 @@ class MenuTemplateIn(ninja.Schema):
 
 
 @api.get("/menu/template")
+@conditional
 def get_menu_template(request):
     """Get the menu template"""
     return {"content": MenuTemplate.get_template()}
@@ -445,6 +886,7 @@ def save_menu_template(request, payload: MenuTemplateIn):
 
 
 @api.get("/menu/template/generate")
+@conditional
 def generate_menu_template(request):
     """Generate a template from current data"""
     categories = Category.objects.all()
@@ -516,49 +958,27 @@ def _parse_menu_template(content):
 
 
 @api.get("/ref/{sqid}/purchases", response=List[PurchaseOut])
+@conditional
 def list_purchases(request, sqid: str):
     reference = get_object_or_404(Reference, id=sqid_decode(sqid))
-    return [
-        {
-            "id": p.id,
-            "date": p.date.isoformat(),
-            "quantity": p.quantity,
-            "price": float(p.price),
-        }
-        for p in reference.purchases.all()
-    ]
+    return [_purchase_out(p) for p in reference.purchases.all()]
 
 
 @api.post("/ref/{sqid}/purchases", response=PurchaseOut)
 def create_purchase(request, sqid: str, purchase_in: PurchaseIn):
     reference = get_object_or_404(Reference, id=sqid_decode(sqid))
-    purchase_data = purchase_in.dict()
-    purchase_data["date"] = datetime.fromisoformat(purchase_data["date"]).date()
-    purchase = Purchase.objects.create(reference=reference, **purchase_data)
-    return {
-        "id": purchase.id,
-        "date": purchase.date.isoformat(),
-        "quantity": purchase.quantity,
-        "price": float(purchase.price),
-    }
+    purchase = Purchase.objects.create(reference=reference, **_purchase_data(purchase_in))
+    return _purchase_out(purchase)
 
 
 @api.put("/purchase/{purchase_id}", response=PurchaseOut)
 def update_purchase(request, purchase_id: int, purchase_in: PurchaseIn):
     purchase = get_object_or_404(Purchase, id=purchase_id)
-    purchase_data = purchase_in.dict()
-    purchase_data["date"] = datetime.fromisoformat(purchase_data["date"]).date()
-
-    for attr, value in purchase_data.items():
+    for attr, value in _purchase_data(purchase_in).items():
         setattr(purchase, attr, value)
 
     purchase.save()
-    return {
-        "id": purchase.id,
-        "date": purchase.date.isoformat(),
-        "quantity": purchase.quantity,
-        "price": float(purchase.price),
-    }
+    return _purchase_out(purchase)
 
 
 @api.delete("/purchase/{purchase_id}")
@@ -568,6 +988,226 @@ def delete_purchase(request, purchase_id: int):
     return {}
 
 
+MAX_BATCH_SIZE = 1000
+
+
+class BatchOp(ninja.Schema):
+    op: Literal[
+        "create_reference", "update_reference", "delete_reference", "set_quantity",
+        "adjust_quantity", "create_purchase", "update_purchase", "delete_purchase",
+    ]
+    # A reference sqid, or "$<n>" for the reference created by operation n.
+    sqid: Optional[str] = None
+    # A purchase id.
+    id: Optional[int] = None
+    data: Optional[dict] = None
+
+
+class BatchIn(ninja.Schema):
+    operations: List[BatchOp]
+    atomic: bool = True
+
+
+BATCH_PAYLOADS = {
+    "create_reference": ReferenceIn,
+    "update_reference": ReferenceIn,
+    "set_quantity": QuantityUpdateIn,
+    "adjust_quantity": QuantityAdjustIn,
+    "create_purchase": PurchaseIn,
+    "update_purchase": PurchaseIn,
+}
+
+
+class BatchOpError(Exception):
+    pass
+
+
+def _batch_reference(sqid, created):
+    if sqid is None:
+        raise BatchOpError("sqid is required")
+    if sqid.startswith("$"):
+        try:
+            return created[int(sqid[1:])]
+        except (KeyError, ValueError):
+            raise BatchOpError(f"{sqid} does not refer to a created reference") from None
+    try:
+        return Reference.objects.get(id=sqid_decode(sqid))
+    except (Http404, Reference.DoesNotExist):
+        raise BatchOpError("reference not found") from None
+
+
+def _batch_purchase(purchase_id):
+    if purchase_id is None:
+        raise BatchOpError("id is required")
+    try:
+        return Purchase.objects.get(id=purchase_id)
+    except Purchase.DoesNotExist:
+        raise BatchOpError("purchase not found") from None
+
+
+def _run_batch_op(index, op, payload, lookups, created, user):
+    """Run one operation; return (result, orphan candidates)."""
+    if op.op == "create_reference":
+        reference = Reference()
+        _save_reference(reference, payload.dict(), lookups, user)
+        created[index] = reference
+        return {"sqid": sqid_encode(reference.id)}, []
+    if op.op == "update_reference":
+        reference = _batch_reference(op.sqid, created)
+        orphans = _save_reference(reference, payload.dict(), lookups, user)
+        return {"sqid": sqid_encode(reference.id)}, orphans
+    if op.op == "delete_reference":
+        reference = _batch_reference(op.sqid, created)
+        return {}, _delete_reference(reference)
+    if op.op == "set_quantity":
+        reference = _batch_reference(op.sqid, created)
+        updated = Reference.objects.set_quantities(
+            [(reference.pk, payload.quantity, payload.expected)], user=user
+        )
+        if reference.pk not in updated:
+            raise BatchOpError("quantity guard failed")
+        return {"quantity": updated[reference.pk]}, []
+    if op.op == "adjust_quantity":
+        reference = _batch_reference(op.sqid, created)
+        updated = Reference.objects.adjust_quantities(
+            [(reference.pk, payload.delta, payload.expected)],
+            payload.floor_at_zero,
+            payload.reason,
+            user,
+        )
+        if reference.pk not in updated:
+            raise BatchOpError("quantity guard failed")
+        return {"quantity": updated[reference.pk]}, []
+    if op.op == "create_purchase":
+        reference = _batch_reference(op.sqid, created)
+        purchase = Purchase.objects.create(reference=reference, **_purchase_data(payload))
+        return _purchase_out(purchase), []
+    if op.op == "update_purchase":
+        purchase = _batch_purchase(op.id)
+        for attr, value in _purchase_data(payload).items():
+            setattr(purchase, attr, value)
+        purchase.save()
+        return _purchase_out(purchase), []
+    _batch_purchase(op.id).delete()
+    return {}, []
+
+
+@api.post("/batch", response={200: dict, 400: dict})
+def batch(request, batch_in: BatchIn):
+    """Run many reference and purchase operations in one transaction.
+
+    Operations run in order and share lookup resolution. When `atomic` is
+    set (the default), the first failure rolls everything back and the
+    response is a 400; otherwise each operation runs in its own savepoint
+    and failures are reported next to the successes.
+    """
+    operations = batch_in.operations
+    if len(operations) > MAX_BATCH_SIZE:
+        return 400, {"detail": f"At most {MAX_BATCH_SIZE} operations per batch"}
+
+    results = [{"index": index, "ok": True} for index in range(len(operations))]
+    payloads = []
+    for index, op in enumerate(operations):
+        schema = BATCH_PAYLOADS.get(op.op)
+        try:
+            payloads.append(schema(**(op.data or {})) if schema else None)
+        except pydantic.ValidationError as exc:
+            payloads.append(None)
+            results[index] = {
+                "index": index,
+                "ok": False,
+                "error": "invalid payload",
+                "detail": exc.errors(include_url=False, include_context=False, include_input=False),
+            }
+    invalid = [result for result in results if not result["ok"]]
+    if invalid and batch_in.atomic:
+        return 400, {"committed": False, "results": invalid}
+
+    def write():
+        outcomes = [dict(result) for result in results]
+        created = {}
+        orphans = []
+        lookups = _resolve_lookups(
+            [p.dict() for p in payloads if isinstance(p, ReferenceIn)]
+        )
+        for index, (op, payload) in enumerate(zip(operations, payloads)):
+            if not outcomes[index]["ok"]:
+                continue
+            try:
+                with transaction.atomic():
+                    result, op_orphans = _run_batch_op(index, op, payload, lookups, created, request.user)
+            except (BatchOpError, ValueError, DatabaseError) as exc:
+                error = "database error" if isinstance(exc, DatabaseError) else str(exc)
+                outcomes[index] = {"index": index, "ok": False, "error": error}
+                if batch_in.atomic:
+                    transaction.set_rollback(True)
+                    return 400, {"committed": False, "results": [outcomes[index]]}
+                if isinstance(payload, ReferenceIn):
+                    # Lookups resolved for this payload may now be unused.
+                    orphans += [lookups[f].get(getattr(payload, f)) for f in LOOKUP_FIELDS]
+                    orphans += [lookups["grapes"][name] for name in payload.grapes or []]
+                continue
+            outcomes[index].update(result)
+            orphans += op_orphans
+
+        _cleanup_orphaned_lookups(orphans)
+        return 200, {"committed": True, "results": outcomes}
+
+    return _retry_stale_lookups(write)
+
+
+def _export_response(format):
+    """Stream every reference with its lookups, grapes and purchase totals."""
+    response = StreamingHttpResponse(
+        export.export(format), content_type=export.CONTENT_TYPES[format]
+    )
+    filename = f"cellar-{timezone.localdate():%Y%m%d}.{format}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+@api.get("/export/csv")
+@conditional
+def export_csv(request):
+    return _export_response("csv")
+
+
+@api.get("/export/ndjson")
+@conditional
+def export_ndjson(request):
+    return _export_response("ndjson")
+
+
+@api.get("/export/parquet", response={501: dict})
+@conditional
+def export_parquet(request):
+    if export.pyarrow is None:
+        return 501, {"detail": "Parquet export needs pyarrow"}
+    return _export_response("parquet")
+
+
+@api.post("/import", response={200: dict, 400: dict})
+def import_references(
+    request,
+    file: UploadedFile = File(...),
+    format: Literal["csv", "xlsx"] = None,
+    dry_run: bool = False,
+):
+    """Create references and purchases from a CSV or XLSX spreadsheet.
+
+    See cave.importer for the columns. All rows are validated and nothing
+    is written unless every row is valid; with dry_run the report is
+    returned without writing anything either.
+    """
+    if format is None:
+        format = "xlsx" if file.name.lower().endswith(".xlsx") else "csv"
+    try:
+        report = importer.import_references(file, format, request.user, dry_run)
+    except ValueError as exc:
+        return 400, {"detail": str(exc)}
+    return (400 if report["invalid"] else 200), report
+
+
 def _build_wine_data(wine):
     """Build a wine dict for the menu template."""
     details = []
@@ -638,13 +1278,33 @@ def _build_region_list(wines, sorted_regions, sorted_appellations):
     return result
 
 
+def menu_cache_key(version, location=None, hide_prices=False):
+    key_data = f"{version}:{location}:{hide_prices}"
+    return "cave:menu:" + hashlib.md5(key_data.encode()).hexdigest()
+
+
 @api.get("/export/html")
+@conditional
 def export_wine_menu_html(request, location: str = None, hide_prices: bool = False):
     """Generate HTML wine menu for printing using Django template"""
+    cache_key = menu_cache_key(request_cellar_version(request), location, hide_prices)
+    menu = cache.get(cache_key)
+    if menu is None:
+        with timing.phase(request, "render"):
+            content = _render_wine_menu(location, hide_prices).encode()
+        with timing.phase(request, "compress"):
+            menu = {"content": content, "precompressed": precompress(content)}
+        cache.set(cache_key, menu, MENU_CACHE_TIMEOUT)
+
+    response = HttpResponse(menu["content"], content_type="text/html")
+    response.precompressed = menu["precompressed"]
+    return response
 
+
+def _render_wine_menu(location, hide_prices):
     references = Reference.objects.filter(hidden_from_menu=False).select_related(
         "category", "region", "appellation"
-    )
+    ).prefetch_related("purchases")
 
     if location:
         references = references.filter(location=location)
@@ -683,8 +1343,7 @@ def export_wine_menu_html(request, location: str = None, hide_prices: bool = Fal
             "regions": _build_region_list(uncategorized_wines, regions, appellations),
         })
 
-    html_content = render_to_string("wine_menu.html", {
+    return render_to_string("wine_menu.html", {
         "categories": template_categories,
         "hide_prices": hide_prices,
     })
-    return HttpResponse(html_content, content_type="text/html")
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CaveConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "cave"
+
+    def ready(self):
+        from . import auth, lookup_cache, versioning  # noqa: F401  (register signal receivers)
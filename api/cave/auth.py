@@ -1,5 +1,17 @@
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import HASH_SESSION_KEY, get_user_model, user_logged_out
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.crypto import constant_time_compare
 from mozilla_django_oidc.auth import OIDCAuthenticationBackend
 
+USER_CACHE_TIMEOUT = 60 * 15
+DEV_USER_CACHE_KEY = "auth:dev-user"
+
 
 class GibolinOIDCBackend(OIDCAuthenticationBackend):
     """Custom OIDC backend enforcing email whitelist.
@@ -16,3 +28,86 @@ class GibolinOIDCBackend(OIDCAuthenticationBackend):
 
     def create_user(self, claims):
         return None
+
+
+def _user_cache_key(user_id):
+    return f"auth:user:{user_id}"
+
+
+def _user_token_key(user_id):
+    return f"auth:user-token:{user_id}"
+
+
+def user_token(user_id):
+    """Return a token that changes whenever the user is saved or deleted.
+
+    Lets responses showing the user (see api.bootstrap) be revalidated
+    without loading it.
+    """
+    key = _user_token_key(user_id)
+    token = cache.get(key)
+    if token is None:
+        cache.add(key, uuid4().hex, None)
+        token = cache.get(key)
+    return token
+
+
+def get_cached_user(request):
+    """Resolve the session user from the cache, falling back to auth.get_user.
+
+    A cached user is only trusted when the session auth hash still matches
+    it, so password changes and rotated secrets take the uncached path.
+    """
+    try:
+        user_id = request.session[auth.SESSION_KEY]
+        backend_path = request.session[auth.BACKEND_SESSION_KEY]
+    except KeyError:
+        return auth.get_user(request)
+
+    key = _user_cache_key(user_id)
+    if backend_path in settings.AUTHENTICATION_BACKENDS:
+        user = cache.get(key)
+        session_hash = request.session.get(HASH_SESSION_KEY)
+        if user is not None and session_hash and constant_time_compare(
+            session_hash, user.get_session_auth_hash()
+        ):
+            return user
+
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        cache.set(key, user, USER_CACHE_TIMEOUT)
+    else:
+        cache.delete(key)
+    return user
+
+
+def get_dev_user():
+    """Return the first staff user, for DevAutoLoginMiddleware.
+
+    Cached until any user is saved or deleted, so a demoted or deleted
+    user stops being logged in. None is not cached: the lookup runs
+    again until a staff user exists.
+    """
+    user = cache.get(DEV_USER_CACHE_KEY)
+    if user is None:
+        user = get_user_model().objects.filter(is_staff=True).first()
+        if user is not None:
+            cache.set(DEV_USER_CACHE_KEY, user, USER_CACHE_TIMEOUT)
+    return user
+
+
+def invalidate_cached_user(user_id):
+    cache.delete_many([_user_cache_key(user_id), _user_token_key(user_id)])
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _invalidate_on_user_change(sender, instance, **kwargs):
+    invalidate_cached_user(instance.pk)
+    cache.delete(DEV_USER_CACHE_KEY)
+
+
+@receiver(user_logged_out)
+def _invalidate_on_logout(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_cached_user(user.pk)
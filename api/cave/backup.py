@@ -0,0 +1,241 @@
+"""Logical backup of the cellar: every cave table in a chunked zip archive.
+
+The archive holds a manifest (format version, schema migration, columns
+and chunk list per table) and, per table, deflated NDJSON chunks of rows
+written as JSON arrays. Primary keys are kept, so sqids survive a round
+trip. Users are stored by email and matched again on restore.
+
+Derived and per-instance state is left out: lookup reference counts are
+rebuilt by their triggers, and the cellar version and tombstones belong
+to the sync clients of one instance. A restore instead stamps every row
+with a new version, and with --replace writes tombstones for the rows
+that disappear, so clients pick the restored cellar up like any other
+change.
+"""
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from django.contrib.auth import get_user_model
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.migrations.recorder import MigrationRecorder
+from django.utils import timezone
+
+from .importer import insert_rows
+from .models import (
+    Appellation, Category, Format, Grape, MenuTemplate, PosEvent, Purchase,
+    Reference, Region, StockMovement, Tombstone, TrackedModel,
+)
+
+FORMAT = "gibolin-dump"
+FORMAT_VERSION = 1
+CHUNK_SIZE = 10000
+
+# In restore order: rows only point at tables above them.
+MODELS = [
+    Category, Region, Appellation, Format, Grape, Reference,
+    Reference.grapes.through, Purchase, StockMovement, PosEvent, MenuTemplate,
+]
+# Rows sync clients know about, by Tombstone.model.
+SYNCED_MODELS = [Reference, Category, Region, Appellation, Format, Grape]
+DERIVED_FIELDS = {"reference_count"}
+
+
+class BackupError(Exception):
+    pass
+
+
+def _label(model):
+    return model._meta.label_lower
+
+
+def _is_user(field):
+    return field.is_relation and field.related_model is get_user_model()
+
+
+def _fields(model):
+    return [field for field in model._meta.concrete_fields if field.name not in DERIVED_FIELDS]
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _schema_migration():
+    return (
+        MigrationRecorder.Migration.objects.filter(app="cave")
+        .order_by("-name").values_list("name", flat=True).first()
+    )
+
+
+def _write_chunk(archive, label, table, rows):
+    name = f"data/{label}/{len(table['chunks']):05d}.ndjson"
+    with archive.open(name, "w") as out:
+        out.write("".join(
+            json.dumps(row, default=_json_default, ensure_ascii=False) + "\n" for row in rows
+        ).encode())
+    table["chunks"].append(name)
+    table["rows"] += len(rows)
+
+
+def dump(path, chunk_size=CHUNK_SIZE):
+    """Write the archive to path; return its manifest.
+
+    Tables are read through server-side cursors in one repeatable-read
+    transaction, so the archive is a consistent snapshot.
+    """
+    username = get_user_model().USERNAME_FIELD
+    manifest = {
+        "format": FORMAT,
+        "version": FORMAT_VERSION,
+        "created_at": timezone.now().isoformat(),
+        "migration": None,
+        "tables": {},
+    }
+    outermost = not connection.in_atomic_block
+    with ZipFile(path, "w", ZIP_DEFLATED) as archive, transaction.atomic():
+        if outermost:
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        manifest["migration"] = _schema_migration()
+        for model in MODELS:
+            fields = _fields(model)
+            label = _label(model)
+            table = {
+                "columns": [field.name if _is_user(field) else field.attname for field in fields],
+                "rows": 0,
+                "chunks": [],
+            }
+            rows = model._default_manager.order_by("pk").values_list(*(
+                f"{field.name}__{username}" if _is_user(field) else field.attname for field in fields
+            )).iterator(chunk_size)
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    _write_chunk(archive, label, table, chunk)
+                    chunk = []
+            if chunk:
+                _write_chunk(archive, label, table, chunk)
+            manifest["tables"][label] = table
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+    return manifest
+
+
+def _read_manifest(archive):
+    try:
+        manifest = json.loads(archive.read("manifest.json"))
+    except (KeyError, ValueError):
+        raise BackupError("Not a gibolin archive: manifest.json is missing or invalid") from None
+    if manifest.get("format") != FORMAT:
+        raise BackupError("Not a gibolin archive")
+    if manifest.get("version") != FORMAT_VERSION:
+        raise BackupError(f"Unsupported archive version {manifest.get('version')}")
+    applied = MigrationRecorder.Migration.objects.filter(app="cave", name=manifest["migration"])
+    if manifest["migration"] and not applied.exists():
+        raise BackupError(
+            f"The archive needs migration cave.{manifest['migration']}; run migrate first"
+        )
+    return manifest
+
+
+def _restore_table(archive, model, table, version, users):
+    """Insert one table's chunks; return the number of rows."""
+    by_column = {
+        (field.name if _is_user(field) else field.attname): field for field in model._meta.concrete_fields
+    }
+    unknown = [column for column in table["columns"] if column not in by_column]
+    if unknown:
+        raise BackupError(f"{_label(model)}: unknown columns {', '.join(unknown)}")
+    fields = [by_column[column] for column in table["columns"]]
+    # Columns missing from older archives, and derived ones, get their default.
+    missing = [field for field in model._meta.concrete_fields if field not in fields]
+    defaults = [field.get_default() for field in missing]
+    tracked = issubclass(model, TrackedModel)
+
+    def convert(field, value):
+        if value is None:
+            return None
+        if _is_user(field):
+            return users.get(value)
+        if field.is_relation:
+            return value
+        return field.to_python(value)
+
+    columns = [field.attname for field in fields + missing]
+    for name in table["chunks"]:
+        rows = []
+        with archive.open(name) as source:
+            for line in source:
+                row = dict(zip(columns, [
+                    *(convert(field, value) for field, value in zip(fields, json.loads(line))),
+                    *defaults,
+                ]))
+                if tracked:
+                    row["version"] = version
+                rows.append(tuple(row.values()))
+        insert_rows(model, columns, rows)
+    return table["rows"]
+
+
+def restore(path, replace=False):
+    """Load an archive written by dump; return {table label: rows}.
+
+    The cellar must be empty unless replace is set, in which case its
+    rows are deleted first. Everything happens in one transaction.
+    """
+    from . import lookup_cache
+    from .versioning import cellar_changed
+
+    with ZipFile(path) as archive:
+        manifest = _read_manifest(archive)
+        with transaction.atomic():
+            version = cellar_changed()
+            previous = {}
+            if any(model._default_manager.exists() for model in MODELS):
+                if not replace:
+                    raise BackupError("The cellar is not empty; restore with replace to overwrite it")
+                previous = {
+                    model: list(model._default_manager.values_list("pk", flat=True))
+                    for model in SYNCED_MODELS
+                }
+                with connection.cursor() as cursor:
+                    # TRUNCATE refuses tables with foreign key checks still
+                    # pending in the transaction; run them now.
+                    cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+                    cursor.execute("TRUNCATE {}".format(
+                        ", ".join(connection.ops.quote_name(model._meta.db_table) for model in MODELS)
+                    ))
+            with connection.cursor() as cursor:
+                # Checked once at commit rather than per inserted row.
+                cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+            user_model = get_user_model()
+            users = dict(user_model.objects.values_list(user_model.USERNAME_FIELD, "pk"))
+            counts = {}
+            for model in MODELS:
+                table = manifest["tables"].get(_label(model))
+                if table:
+                    counts[_label(model)] = _restore_table(archive, model, table, version, users)
+
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), MODELS):
+                    cursor.execute(sql)
+                for model, ids in previous.items():
+                    cursor.execute(
+                        f"""
+                        INSERT INTO {Tombstone._meta.db_table} (model, object_id, version, deleted_at)
+                        SELECT %s, id, %s, %s FROM unnest(%s::bigint[]) AS id
+                        WHERE id NOT IN (SELECT id FROM {model._meta.db_table})
+                        """,
+                        [model._meta.model_name, version, timezone.now(), ids],
+                    )
+            lookup_cache.invalidate()
+    return counts
@@ -0,0 +1,270 @@
+"""End-to-end API benchmarks on synthetic cellars.
+
+Every scenario is one request through the whole stack (middleware,
+session auth, ninja, the database) against a cellar built by
+generate_cellar. After a few warm-up requests, each scenario is timed
+over a number of iterations and reported as latency percentiles,
+sequential throughput and SQL queries per request.
+
+Results are JSON, and a baseline is kept in the repo so that changes
+show up in diffs. Query counts do not depend on the machine and must not
+grow; latencies do, so they may only grow within a tolerance.
+"""
+
+import io
+import json
+import math
+import platform
+import statistics
+import time
+from contextlib import nullcontext
+from datetime import date
+from pathlib import Path
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from .models import Purchase, Reference
+
+SIZES = [100, 1000, 10000]
+ITERATIONS = 20
+WARMUP = 3
+SEED = 0
+# How much slower than the baseline a p95 may get before it is a regression,
+# and by at least how much, so that jitter on millisecond requests is not one.
+TOLERANCE = 1.5
+MIN_SLOWDOWN_MS = 5.0
+BASELINE = Path(__file__).resolve().parent.parent / "benchmarks" / "baseline.json"
+
+
+class Bench:
+    """A logged-in client and the sample rows the scenarios point at."""
+
+    def __init__(self, user):
+        self.client = Client()
+        self.client.force_login(user)
+        references = Reference.objects.filter(current_quantity__gt=0, domain__isnull=False)
+        self.reference = references.order_by("pk")[references.count() // 2]
+        self.sqid = self._sqid(self.reference)
+        self.count = Reference.objects.count()
+        self.purchase = Purchase.objects.filter(reference=self.reference).order_by("pk").first()
+        self.word = self.reference.domain.split()[-1]
+        self.batch = [self._sqid(r) for r in references.order_by("pk")[:20]]
+        self.token = self.client.get("/api/sync").json()["token"]
+
+    @staticmethod
+    def _sqid(reference):
+        from .api import sqid_encode
+
+        return sqid_encode(reference.pk)
+
+    def payload(self, **changes):
+        r = self.reference
+        return {
+            "name": r.name,
+            "category": r.category.name if r.category else None,
+            "region": r.region.name if r.region else None,
+            "appellation": r.appellation.name if r.appellation else None,
+            "format": r.format.name if r.format else None,
+            "grapes": [g.name for g in r.grapes.all()],
+            "domain": r.domain,
+            "location": r.location,
+            "vintage": r.vintage,
+            "current_quantity": r.current_quantity,
+            **changes,
+        }
+
+    def scratch_reference(self):
+        """A new reference for a scenario to delete."""
+        return self._sqid(Reference.objects.create(name="Benchmark scratch"))
+
+
+class Scenario:
+    """One request; path, body and before are callables of the Bench, run untimed.
+
+    before prepares each request, e.g. by dropping what a previous one cached.
+    """
+
+    def __init__(self, name, method, path, body=None, before=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.before = before
+
+    def request(self, bench):
+        if self.before:
+            self.before(bench)
+        path = self.path(bench)
+        body = self.body(bench) if self.body else None
+        return path, body
+
+
+def _get(name, path, before=None):
+    return Scenario(name, "get", path if callable(path) else lambda b: path, before=before)
+
+
+def _forget_menu(bench):
+    from .api import menu_cache_key
+    from .versioning import get_cellar_version
+
+    cache.delete(menu_cache_key(get_cellar_version()))
+
+
+# Reads first: writes change the cellar version and with it the caches.
+SCENARIOS = [
+    _get("bootstrap", "/api/bootstrap"),
+    _get("me", "/api/me"),
+    _get("refs", "/api/refs"),
+    _get("refs_last_page", lambda b: f"/api/refs?offset={max(0, b.count - 100)}&limit=100"),
+    _get("refs_by_location", lambda b: f"/api/refs?location={b.reference.location}"),
+    _get("search", lambda b: f"/api/refs?search={b.word}"),
+    _get("search_two_words", lambda b: f"/api/refs?search={b.word}+{b.reference.vintage or ''}"),
+    _get("ref_detail", lambda b: f"/api/ref/{b.sqid}"),
+    _get("ref_purchases", lambda b: f"/api/ref/{b.sqid}/purchases"),
+    _get("ref_movements", lambda b: f"/api/ref/{b.sqid}/movements"),
+    _get("movements", "/api/movements"),
+    _get("movements_summary", "/api/movements/summary"),
+    _get("locations", "/api/locations"),
+    _get("categories_counts", "/api/categories?counts=true"),
+    _get("regions_counts", "/api/regions?counts=true"),
+    _get("appellations_counts", "/api/appellations?counts=true"),
+    _get("grapes_counts", "/api/grapes?counts=true"),
+    _get("formats", "/api/formats"),
+    _get("sync_full", "/api/sync"),
+    _get("sync_delta", lambda b: f"/api/sync?since={b.token}"),
+    _get("menu_template_generate", "/api/menu/template/generate"),
+    _get("menu_html", "/api/export/html"),
+    _get("menu_html_uncached", "/api/export/html", before=_forget_menu),
+    _get("export_csv", "/api/export/csv"),
+    Scenario("create_ref", "post", lambda b: "/api/ref",
+             lambda b: b.payload(name="Benchmark cuvée", current_quantity=6)),
+    Scenario("update_ref", "put", lambda b: f"/api/ref/{b.sqid}", lambda b: b.payload()),
+    Scenario("adjust_quantity", "post", lambda b: f"/api/ref/{b.sqid}/quantity/adjust",
+             lambda b: {"delta": 1}),
+    Scenario("adjust_quantities_batch", "post", lambda b: "/api/quantities/adjust",
+             lambda b: {"adjustments": [{"sqid": sqid, "delta": 1} for sqid in b.batch]}),
+    Scenario("add_purchase", "post", lambda b: f"/api/ref/{b.sqid}/purchases",
+             lambda b: {"date": date.today().isoformat(), "quantity": 6, "price": 12.5}),
+    Scenario("update_purchase", "put", lambda b: f"/api/purchase/{b.purchase.pk}",
+             lambda b: {"date": b.purchase.date.isoformat(), "quantity": 6, "price": 13}),
+    Scenario("delete_ref", "delete", lambda b: f"/api/ref/{b.scratch_reference()}"),
+]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _call(bench, scenario, queries=None):
+    """Send one request; return its duration, and count its queries into queries."""
+    path, body = scenario.request(bench)
+    kwargs = {"data": json.dumps(body), "content_type": "application/json"} if body else {}
+    with CaptureQueriesContext(connection) if queries is not None else nullcontext() as captured:
+        started = time.perf_counter()
+        response = getattr(bench.client, scenario.method)(path, **kwargs)
+        if response.streaming:
+            b"".join(response.streaming_content)
+        elapsed = time.perf_counter() - started
+    if response.status_code >= 400:
+        raise RuntimeError(
+            f"{scenario.name}: {scenario.method.upper()} {path} returned {response.status_code}"
+        )
+    if queries is not None:
+        queries.extend(captured.captured_queries)
+    return elapsed
+
+
+def measure(bench, scenario, iterations=ITERATIONS, warmup=WARMUP):
+    """Time a scenario; return its statistics."""
+    for _ in range(warmup):
+        _call(bench, scenario)
+    queries = []
+    _call(bench, scenario, queries)
+    timings = [_call(bench, scenario) for _ in range(iterations)]
+    ms = [t * 1000 for t in timings]
+    return {
+        "queries": len(queries),
+        "p50_ms": round(percentile(ms, 0.50), 2),
+        "p95_ms": round(percentile(ms, 0.95), 2),
+        "p99_ms": round(percentile(ms, 0.99), 2),
+        "mean_ms": round(statistics.fmean(ms), 2),
+        "rps": round(len(timings) / sum(timings), 1),
+    }
+
+
+def seed(size, seed=SEED):
+    """Replace the cellar with a generated one of size references."""
+    call_command("generate_cellar", references=size, seed=seed, clear=True, stdout=io.StringIO())
+    cache.clear()
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+
+def run(user, sizes=SIZES, iterations=ITERATIONS, warmup=WARMUP, only=None, progress=None):
+    """Seed each size in turn and measure every scenario against it.
+
+    Runs in the current database, whose cellar is replaced.
+    """
+    results = {
+        "meta": {
+            "iterations": iterations,
+            "warmup": warmup,
+            "seed": SEED,
+            "python": platform.python_version(),
+            "postgresql": connection.pg_version,
+        },
+        "sizes": {},
+    }
+    for size in sizes:
+        seed(size)
+        bench = Bench(user)
+        measured = results["sizes"][str(size)] = {}
+        for scenario in SCENARIOS:
+            if only and not any(name in scenario.name for name in only):
+                continue
+            measured[scenario.name] = measure(bench, scenario, iterations, warmup)
+            if progress:
+                progress(size, scenario.name, measured[scenario.name])
+    return results
+
+
+def compare(baseline, results, tolerance=TOLERANCE):
+    """Regressions of results against a baseline, as readable lines.
+
+    A scenario regresses when it runs more queries than in the baseline,
+    or when its p95 exceeds the baseline one by more than tolerance (and
+    MIN_SLOWDOWN_MS).
+    Scenarios or sizes missing on either side are skipped.
+    """
+    regressions = []
+    for size, scenarios in results["sizes"].items():
+        for name, current in scenarios.items():
+            previous = baseline.get("sizes", {}).get(size, {}).get(name)
+            if previous is None:
+                continue
+            if current["queries"] > previous["queries"]:
+                regressions.append(
+                    f"{size}/{name}: {current['queries']} queries (baseline {previous['queries']})"
+                )
+            slower = current["p95_ms"] - previous["p95_ms"]
+            if current["p95_ms"] > previous["p95_ms"] * tolerance and slower > MIN_SLOWDOWN_MS:
+                regressions.append(
+                    f"{size}/{name}: p95 {current['p95_ms']}ms (baseline {previous['p95_ms']}ms)"
+                )
+    return regressions
+
+
+def write(results, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+
+
+def load(path):
+    return json.loads(Path(path).read_text())
@@ -0,0 +1,110 @@
+"""Content-negotiated response compression.
+
+gzip is always available; brotli and zstd are used when their packages are
+installed. Dynamic responses are compressed at a fast level, while bodies
+that are built once and reused (see precompress) get the maximum effort.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class _GzipCompressor:
+    def __init__(self, level):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor:
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._obj.process(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+# encoding -> (compressor class, fast level, max level), in preference order
+CODECS = {}
+if brotli is not None:
+    CODECS["br"] = (_BrotliCompressor, 5, 11)
+if zstandard is not None:
+    CODECS["zstd"] = (_ZstdCompressor, 3, 19)
+CODECS["gzip"] = (_GzipCompressor, 6, 9)
+
+
+def negotiate(accept_encoding):
+    """Pick the preferred available encoding allowed by an Accept-Encoding header."""
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    for encoding in CODECS:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def compress_bytes(data, encoding, max_effort=False):
+    cls, fast, best = CODECS[encoding]
+    compressor = cls(best if max_effort else fast)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """Compress an iterable of chunks, flushing after each so streams stay live."""
+    cls, fast, _ = CODECS[encoding]
+    compressor = cls(fast)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def precompress(data):
+    """Compress a reusable body once per available encoding, at maximum effort."""
+    return {encoding: compress_bytes(data, encoding, max_effort=True) for encoding in CODECS}
@@ -0,0 +1,217 @@
+"""Full-cellar export as CSV, NDJSON or Parquet.
+
+One query returns every reference with its lookups, grapes and purchase
+totals. It is read through a server-side cursor and written out as it
+arrives, so memory use does not depend on the size of the cellar.
+Parquet needs pyarrow and is written one row group at a time.
+"""
+
+import csv
+import io
+import json
+from datetime import date, datetime
+
+from django.db import connection
+
+from .models import (
+    Appellation, Category, Format, Grape, Purchase, Reference, Region,
+)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+# Rows fetched per round trip, and rows per CSV/NDJSON chunk.
+CHUNK_SIZE = 2000
+ROW_GROUP_SIZE = 10000
+
+COLUMNS = [
+    "sqid", "name", "category", "region", "appellation", "format", "grapes",
+    "domain", "location", "vintage", "current_quantity", "price_multiplier",
+    "retail_price_override", "retail_price", "notes", "hidden_from_menu",
+    "purchase_count", "purchased_quantity", "average_purchase_price",
+    "first_purchase", "last_purchase", "updated_at",
+]
+
+
+def _query():
+    tables = {
+        model.__name__.lower(): model._meta.db_table
+        for model in (Reference, Category, Region, Appellation, Format, Grape, Purchase)
+    }
+    tables["reference_grapes"] = Reference.grapes.through._meta.db_table
+    return """
+        SELECT ref.id, ref.name, category.name, region.name, appellation.name,
+               format.name, grapes.names, ref.domain, ref.location, ref.vintage,
+               ref.current_quantity, ref.price_multiplier, ref.retail_price_override,
+               ref.notes, ref.hidden_from_menu, coalesce(purchases.count, 0),
+               coalesce(purchases.quantity, 0), purchases.value, purchases.first,
+               purchases.last, ref.updated_at
+        FROM {reference} AS ref
+        LEFT JOIN {category} AS category ON category.id = ref.category_id
+        LEFT JOIN {region} AS region ON region.id = ref.region_id
+        LEFT JOIN {appellation} AS appellation ON appellation.id = ref.appellation_id
+        LEFT JOIN {format} AS format ON format.id = ref.format_id
+        LEFT JOIN (
+            SELECT link.reference_id, array_agg(grape.name ORDER BY grape.name) AS names
+            FROM {reference_grapes} AS link
+            JOIN {grape} AS grape ON grape.id = link.grape_id
+            GROUP BY link.reference_id
+        ) AS grapes ON grapes.reference_id = ref.id
+        LEFT JOIN (
+            SELECT reference_id, count(*) AS count, sum(quantity) AS quantity,
+                   sum(price * quantity) AS value, min(date) AS first, max(date) AS last
+            FROM {purchase}
+            GROUP BY reference_id
+        ) AS purchases ON purchases.reference_id = ref.id
+        ORDER BY ref.id
+    """.format(**tables)
+
+
+def rows():
+    """Yield one dict per reference, keyed by COLUMNS."""
+    from .api import _retail_price, sqid_encode
+
+    with connection.chunked_cursor() as cursor:
+        # psycopg2's cursor fetches itersize rows per round trip; set on
+        # Django's wrapper, the attribute would have no effect.
+        cursor.cursor.itersize = CHUNK_SIZE
+        cursor.execute(_query())
+        for (
+            pk, name, category, region, appellation, format, grapes, domain, location,
+            vintage, quantity, multiplier, override, notes, hidden, purchase_count,
+            purchased, value, first, last, updated_at,
+        ) in cursor:
+            yield {
+                "sqid": sqid_encode(pk),
+                "name": name,
+                "category": category,
+                "region": region,
+                "appellation": appellation,
+                "format": format,
+                "grapes": grapes or [],
+                "domain": domain,
+                "location": location,
+                "vintage": vintage,
+                "current_quantity": quantity,
+                "price_multiplier": float(multiplier),
+                "retail_price_override": float(override) if override is not None else None,
+                "retail_price": _retail_price(override, multiplier, value, purchased),
+                "notes": notes,
+                "hidden_from_menu": hidden,
+                "purchase_count": purchase_count,
+                "purchased_quantity": purchased,
+                "average_purchase_price": round(float(value) / purchased, 2) if purchased else None,
+                "first_purchase": first,
+                "last_purchase": last,
+                "updated_at": updated_at,
+            }
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def write_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, COLUMNS)
+    writer.writeheader()
+    for chunk in _chunks(rows, CHUNK_SIZE):
+        # Grapes are joined the way the importer splits them.
+        writer.writerows({**row, "grapes": ", ".join(row["grapes"])} for row in chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def write_ndjson(rows):
+    for chunk in _chunks(rows, CHUNK_SIZE):
+        yield "".join(
+            json.dumps(row, default=_json_default, ensure_ascii=False) + "\n" for row in chunk
+        ).encode()
+
+
+class _Sink:
+    """Write-only file collecting what pyarrow writes until it is drained."""
+
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def _parquet_schema():
+    string, money = pyarrow.string(), pyarrow.float64()
+    return pyarrow.schema([
+        ("sqid", string), ("name", string), ("category", string), ("region", string),
+        ("appellation", string), ("format", string), ("grapes", pyarrow.list_(string)),
+        ("domain", string), ("location", string), ("vintage", pyarrow.int32()),
+        ("current_quantity", pyarrow.int32()), ("price_multiplier", money),
+        ("retail_price_override", money), ("retail_price", money), ("notes", string),
+        ("hidden_from_menu", pyarrow.bool_()), ("purchase_count", pyarrow.int64()),
+        ("purchased_quantity", pyarrow.int64()), ("average_purchase_price", money),
+        ("first_purchase", pyarrow.date32()), ("last_purchase", pyarrow.date32()),
+        ("updated_at", pyarrow.timestamp("us", tz="UTC")),
+    ])
+
+
+def write_parquet(rows):
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow")
+    schema = _parquet_schema()
+    sink = _Sink()
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for chunk in _chunks(rows, ROW_GROUP_SIZE):
+            writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+WRITERS = {"csv": write_csv, "ndjson": write_ndjson, "parquet": write_parquet}
+
+
+def export(fmt):
+    """Return an iterator of encoded chunks of the whole cellar."""
+    return WRITERS[fmt](rows())
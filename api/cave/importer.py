@@ -0,0 +1,268 @@
+"""Bulk import of references and their purchases from CSV or XLSX files.
+
+One row per reference, with ReferenceIn fields as columns (grapes
+separated by commas) and optionally one purchase in purchase_date,
+purchase_quantity and purchase_price. Rows sharing a value in the
+optional `ref` column describe the same reference: the first one creates
+it, the next ones only add purchases.
+
+Rows are streamed and written in chunks: lookups are resolved once per
+chunk, then references, grapes, opening stock movements and purchases
+are inserted with one statement each. The import is all or nothing: it
+runs in one transaction, rolled back when any row is invalid or for a
+dry run, so a dry run reports exactly what the import would do.
+"""
+
+import codecs
+import csv
+import re
+from datetime import date, datetime
+
+import pydantic
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Purchase, Reference, StockMovement
+
+FORMATS = ("csv", "xlsx")
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 20
+
+# ReferenceIn fields stored as they are.
+REFERENCE_COLUMNS = [
+    "name", "domain", "location", "vintage", "price_multiplier",
+    "retail_price_override", "notes", "hidden_from_menu",
+]
+
+KEY_COLUMN = "ref"
+PURCHASE_COLUMNS = {
+    "purchase_date": "date",
+    "purchase_quantity": "quantity",
+    "purchase_price": "price",
+}
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _cell(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = "" if value is None else str(value).strip()
+    return value or None
+
+
+def _csv_rows(source):
+    reader = csv.DictReader(codecs.iterdecode(source, "utf-8-sig"))
+    for row in reader:
+        yield reader.line_num, {
+            (column or "").strip(): _cell(value) for column, value in row.items()
+        }
+
+
+def _xlsx_rows(source):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_cell(value) or "" for value in next(rows, ())]
+        for number, values in enumerate(rows, 2):
+            if any(value is not None for value in values):
+                yield number, {column: _cell(value) for column, value in zip(header, values)}
+    finally:
+        workbook.close()
+
+
+def read_rows(source, fmt="csv"):
+    """Yield (row number, {column: value or None}) from a binary file."""
+    return _xlsx_rows(source) if fmt == "xlsx" else _csv_rows(source)
+
+
+def _check_columns(row, schema):
+    allowed = {KEY_COLUMN, *PURCHASE_COLUMNS, *schema.model_fields}
+    unknown = sorted(column for column in row if column not in allowed)
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+
+
+def _parse(row, reference_schema, purchase_schema, purchase_data):
+    """Validate a row; return (reference data or None, purchase data or None).
+
+    reference_schema is None for rows that only add a purchase.
+    """
+    purchase = {
+        field: row.pop(column) for column, field in PURCHASE_COLUMNS.items()
+        if row.get(column) is not None
+    }
+    reference = None
+    if reference_schema is not None:
+        if row.get("grapes"):
+            row["grapes"] = [name.strip() for name in re.split(r"[,;]", row["grapes"]) if name.strip()]
+        reference = reference_schema(
+            **{column: value for column, value in row.items() if value is not None}
+        ).dict()
+    return reference, purchase_data(purchase_schema(**purchase)) if purchase else None
+
+
+def _reject(stats, number, error, detail=None):
+    stats["invalid"] += 1
+    if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+        stats["errors"].append({"row": number, "error": error, **({"detail": detail} if detail else {})})
+
+
+def allocate_ids(model, count):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            [model._meta.db_table, model._meta.pk.column, count],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def insert_rows(model, columns, rows):
+    """INSERT rows, tuples of values for columns, in one statement.
+
+    Like Reference.objects.adjust_quantities, values are passed as one
+    array per column: bulk_create spends more time building a statement
+    with a placeholder per value than the database takes to run it.
+    """
+    if not rows:
+        return
+    fields = [model._meta.get_field(column) for column in columns]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {connection.ops.quote_name(model._meta.db_table)}
+                ({", ".join(connection.ops.quote_name(field.column) for field in fields)})
+            SELECT * FROM unnest({", ".join(f"%s::{field.db_type(connection)}[]" for field in fields)})
+            """,
+            [list(values) for values in zip(*rows)],
+        )
+
+
+def _write(chunk, keys, stats, user):
+    """Insert a chunk of (key, reference data, purchase data) entries.
+
+    Ids are allocated up front, so references, their grapes, opening
+    stock movements and purchases take one INSERT per table.
+    """
+    from .api import LOOKUP_FIELDS, _resolve_lookups
+    from .versioning import cellar_changed
+
+    version = cellar_changed()
+    now = timezone.now()
+    # The import cannot run twice, so its lookups are upserted, which locks
+    # them, rather than taken from the process cache (see _retry_stale_lookups).
+    lookups = _resolve_lookups([data for _, data, _ in chunk if data], cached=False)
+    ids = iter(allocate_ids(Reference, sum(data is not None for _, data, _ in chunk)))
+    references, grapes, movements, purchases = [], [], [], []
+    for key, data, purchase in chunk:
+        if data is None:
+            reference_id = keys[key]
+        else:
+            reference_id = next(ids)
+            quantity = data["current_quantity"] or 0
+            references.append((
+                reference_id,
+                *(lookups[field][data[field]].pk if data[field] else None for field in LOOKUP_FIELDS),
+                *(data[field] for field in REFERENCE_COLUMNS),
+                quantity, now, now, version,
+            ))
+            grapes += [
+                (reference_id, lookups["grapes"][name].pk) for name in dict.fromkeys(data["grapes"] or [])
+            ]
+            if quantity:
+                movements.append(
+                    (reference_id, quantity, StockMovement.Reason.INITIAL, getattr(user, "pk", None), now)
+                )
+        if key is not None:
+            keys[key] = reference_id
+        if purchase is not None:
+            purchases.append((
+                reference_id, purchase["date"], purchase["quantity"], purchase["price"],
+                now, now, version,
+            ))
+
+    insert_rows(
+        Reference,
+        ["id", *(f"{field}_id" for field in LOOKUP_FIELDS), *REFERENCE_COLUMNS,
+         "current_quantity", "created_at", "updated_at", "version"],
+        references,
+    )
+    insert_rows(Reference.grapes.through, ["reference_id", "grape_id"], grapes)
+    insert_rows(StockMovement, ["reference_id", "delta", "reason", "user_id", "created_at"], movements)
+    insert_rows(
+        Purchase,
+        ["reference_id", "date", "quantity", "price", "created_at", "updated_at", "version"],
+        purchases,
+    )
+
+    stats["references"] += len(references)
+    stats["purchases"] += len(purchases)
+
+
+def import_references(source, fmt="csv", user=None, dry_run=False, chunk_size=CHUNK_SIZE):
+    """Import references and purchases from a binary file; return a report.
+
+    Nothing is written when a row is invalid or with dry_run. Raises
+    ValueError when the header has unknown columns.
+    """
+    from .api import PurchaseIn, ReferenceIn, _purchase_data
+
+    stats = {
+        "rows": 0, "references": 0, "purchases": 0, "invalid": 0,
+        "errors": [], "committed": False,
+    }
+    # Keys seen so far, and the id of their reference once written.
+    keys = {}
+    chunk = []
+    try:
+        with transaction.atomic():
+            for number, row in read_rows(source, fmt):
+                if not stats["rows"]:
+                    _check_columns(row, ReferenceIn)
+                stats["rows"] += 1
+                key = row.pop(KEY_COLUMN, None)
+                # Later rows of a reference only carry a purchase.
+                repeated = key in keys
+                try:
+                    data, purchase = _parse(
+                        row, None if repeated else ReferenceIn, PurchaseIn, _purchase_data
+                    )
+                except pydantic.ValidationError as exc:
+                    _reject(
+                        stats, number, "invalid row",
+                        exc.errors(include_url=False, include_context=False, include_input=False),
+                    )
+                    continue
+                except ValueError as exc:
+                    _reject(stats, number, str(exc))
+                    continue
+                if repeated:
+                    if purchase is None:
+                        _reject(stats, number, f"duplicate {KEY_COLUMN} {key!r} without a purchase")
+                        continue
+                elif key is not None:
+                    keys[key] = None
+                if stats["invalid"]:
+                    # Keep validating, but nothing will be written.
+                    continue
+                chunk.append((key, data, purchase))
+                if len(chunk) >= chunk_size:
+                    _write(chunk, keys, stats, user)
+                    chunk = []
+            if chunk and not stats["invalid"]:
+                _write(chunk, keys, stats, user)
+            if stats["invalid"] or dry_run:
+                raise _Rollback
+    except _Rollback:
+        pass
+    else:
+        stats["committed"] = True
+    return stats
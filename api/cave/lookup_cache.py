@@ -0,0 +1,111 @@
+"""Per-process name -> id cache for the lookup tables.
+
+Lookups are small and rarely change, so each worker keeps their ids in
+memory and reference writes only query names it has never seen (see
+LookupManager.resolve). Gunicorn workers load the tables when they start
+(see gunicorn.conf.py). Created lookups are added to the copy of the
+worker that created them. A token in the shared cache changes whenever a
+lookup is renamed or deleted; a worker whose token no longer matches
+drops its copy and reloads it at the start of its next write request.
+"""
+
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connection, transaction
+from django.db.models import Value
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .versioning import LOOKUP_MODELS
+
+LOOKUP_VERSION_KEY = "cave:lookup-version"
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# ids is {model: {name: id}}, or None until loaded for the current token.
+_state = {"token": None, "ids": None}
+
+
+def _shared_token():
+    token = cache.get(LOOKUP_VERSION_KEY)
+    if token is None:
+        cache.add(LOOKUP_VERSION_KEY, uuid4().hex, None)
+        token = cache.get(LOOKUP_VERSION_KEY)
+    return token
+
+
+def _check_token():
+    token = _shared_token()
+    if token != _state["token"]:
+        _state.update(token=token, ids=None)
+    return token
+
+
+def warm():
+    """Load every lookup table, unless the loaded copy is still current.
+
+    Skipped inside atomic blocks, which could expose uncommitted rows.
+    """
+    token = _check_token()
+    if _state["ids"] is not None or connection.in_atomic_block:
+        return
+    ids = {model: {} for model in LOOKUP_MODELS}
+    queries = [
+        model.objects.annotate(kind=Value(index)).values_list("kind", "name", "id").order_by()
+        for index, model in enumerate(LOOKUP_MODELS)
+    ]
+    for kind, name, pk in queries[0].union(*queries[1:], all=True):
+        ids[LOOKUP_MODELS[kind]][name] = pk
+    if _state["token"] == token:
+        _state["ids"] = ids
+
+
+def cached_ids(model, names):
+    """Return {name: id} for the names this process already knows."""
+    _check_token()
+    known = (_state["ids"] or {}).get(model, {})
+    return {name: known[name] for name in names if name in known}
+
+
+def remember(model, ids):
+    """Add committed {name: id} pairs to the local copy."""
+    token = _state["token"]
+
+    def add():
+        if _state["token"] == token and _state["ids"] is not None:
+            _state["ids"][model].update(ids)
+
+    transaction.on_commit(add)
+
+
+def forget():
+    """Drop this process's copy now; it reloads at the next write request."""
+    _state.update(ids=None)
+
+
+def invalidate():
+    """Make every worker drop its copy once the current transaction commits."""
+    def publish():
+        cache.set(LOOKUP_VERSION_KEY, uuid4().hex, None)
+        _state.update(token=None, ids=None)
+
+    transaction.on_commit(publish)
+
+
+@receiver(request_started)
+def _warm_before_writes(sender, environ=None, **kwargs):
+    if environ is not None and environ.get("REQUEST_METHOD") not in SAFE_METHODS:
+        warm()
+
+
+def _on_lookup_change(sender, created=False, **kwargs):
+    # A new row leaves every known id valid.
+    if not created:
+        invalidate()
+
+
+for _model in LOOKUP_MODELS:
+    post_save.connect(_on_lookup_change, sender=_model, dispatch_uid=f"lookup-cache-save-{_model.__name__}")
+    post_delete.connect(_on_lookup_change, sender=_model, dispatch_uid=f"lookup-cache-delete-{_model.__name__}")
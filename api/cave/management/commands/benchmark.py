@@ -0,0 +1,86 @@
+import logging
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from cave import benchmark
+
+
+def _sizes(value):
+    try:
+        return [int(size) for size in value.split(",")]
+    except ValueError:
+        raise CommandError(f"Invalid --sizes {value!r}: expected e.g. 100,1000,10000") from None
+
+
+class Command(BaseCommand):
+    help = "Benchmark every API endpoint against synthetic cellars of several sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", default=",".join(map(str, benchmark.SIZES)),
+            help="Comma-separated cellar sizes, in references",
+        )
+        parser.add_argument("--iterations", type=int, default=benchmark.ITERATIONS)
+        parser.add_argument("--warmup", type=int, default=benchmark.WARMUP)
+        parser.add_argument(
+            "--only", action="append", help="Only scenarios whose name contains this (repeatable)"
+        )
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument(
+            "--save", action="store_true", help=f"Write the results as the new baseline ({benchmark.BASELINE.name})"
+        )
+        parser.add_argument(
+            "--compare", nargs="?", const=str(benchmark.BASELINE),
+            help="Fail on regressions against a baseline (the repo one by default)",
+        )
+        parser.add_argument("--tolerance", type=float, default=benchmark.TOLERANCE)
+        parser.add_argument(
+            "--keepdb", action="store_true", help="Keep the benchmark database between runs"
+        )
+
+    def handle(self, *args, **options):
+        sizes = _sizes(options["sizes"])
+        baseline = None
+        if options["compare"]:
+            try:
+                baseline = benchmark.load(options["compare"])
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"Cannot read baseline: {exc}")
+
+        # Cellars are generated in a throwaway database, never the real one.
+        verbosity = options["verbosity"]
+        setup_test_environment()
+        # Thousands of requests: keep their log lines out of the report.
+        logging.getLogger("cave.requests").setLevel(logging.WARNING)
+        logging.getLogger("cave.slow").setLevel(logging.ERROR)
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(
+            verbosity=verbosity, autoclobber=True, keepdb=options["keepdb"]
+        )
+        try:
+            user, _ = get_user_model().objects.get_or_create(email="benchmark@example.com")
+            results = benchmark.run(
+                user, sizes, options["iterations"], options["warmup"], options["only"],
+                progress=self.progress if verbosity else None,
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity, options["keepdb"])
+            teardown_test_environment()
+
+        for path in filter(None, [options["output"], options["save"] and benchmark.BASELINE]):
+            benchmark.write(results, path)
+            self.stdout.write(f"Wrote {path}")
+        if baseline is not None:
+            regressions = benchmark.compare(baseline, results, options["tolerance"])
+            if regressions:
+                raise CommandError("Regressions:\n  " + "\n  ".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regression against the baseline"))
+
+    def progress(self, size, name, stats):
+        self.stdout.write(
+            f"{size:>7} {name:<26} p50 {stats['p50_ms']:>8.2f}ms  p95 {stats['p95_ms']:>8.2f}ms  "
+            f"{stats['rps']:>7.1f} req/s  {stats['queries']:>3} queries"
+        )
@@ -10,10 +10,8 @@ class Command(BaseCommand):
         models = [Category, Region, Appellation, Format, Grape]
         total = 0
         for model in models:
-            orphans = model.objects.filter(references__isnull=True)
-            count = orphans.count()
+            count = len(model.objects.delete_orphans())
             if count:
-                orphans.delete()
                 total += count
                 self.stdout.write(f"Deleted {count} orphaned {model.__name__}(s)")
         if total:
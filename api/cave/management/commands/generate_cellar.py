@@ -0,0 +1,225 @@
+import bisect
+import itertools
+import math
+import random
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from cave import lookup_cache
+from cave.backup import MODELS
+from cave.importer import allocate_ids, insert_rows
+from cave.models import (
+    Appellation, Category, Format, Grape, Purchase, Reference, Region, StockMovement, Tombstone,
+)
+from cave.versioning import cellar_changed, touch
+
+CATEGORIES = [
+    ("Rouges", "#B71C1C", 45), ("Blancs", "#4A90E2", 35), ("Rosés", "#E91E63", 8),
+    ("Bulles", "#FFD700", 8), ("Macération", "#FF9800", 4),
+]
+REGIONS = {
+    "Bourgogne": ["Bourgogne", "Chablis", "Meursault", "Gevrey-Chambertin", "Volnay", "Pommard"],
+    "Loire": ["Sancerre", "Vouvray", "Saumur-Champigny", "Muscadet", "Chinon", "Anjou"],
+    "Rhône": ["Côtes-du-Rhône", "Crozes-Hermitage", "Saint-Joseph", "Cornas", "Gigondas"],
+    "Beaujolais": ["Morgon", "Fleurie", "Moulin-à-Vent", "Brouilly", "Chiroubles"],
+    "Languedoc": ["Languedoc", "Pic Saint-Loup", "Faugères", "Terrasses du Larzac"],
+    "Jura": ["Arbois", "Côtes du Jura", "Château-Chalon", "L'Étoile"],
+    "Alsace": ["Alsace", "Alsace Grand Cru", "Crémant d'Alsace"],
+    "Bordeaux": ["Bordeaux", "Saint-Émilion", "Pauillac", "Margaux", "Graves"],
+    "Savoie": ["Savoie", "Chignin", "Apremont"],
+    "Sud-Ouest": ["Cahors", "Madiran", "Jurançon", "Gaillac"],
+    "Mâcon": ["Mâcon-Villages", "Pouilly-Fuissé", "Viré-Clessé", "Saint-Véran"],
+    "Bugey": ["Bugey", "Cerdon"],
+    "Italie": ["Vin de Table", "Etna", "Barolo", "Chianti Classico"],
+}
+GRAPES = [
+    "Pinot Noir", "Chardonnay", "Gamay", "Syrah", "Chenin Blanc", "Sauvignon Blanc",
+    "Grenache", "Merlot", "Cabernet Franc", "Cabernet Sauvignon", "Mourvèdre", "Cinsault",
+    "Carignan", "Savagnin", "Poulsard", "Trousseau", "Riesling", "Gewurztraminer",
+    "Pinot Gris", "Aligoté", "Melon de Bourgogne", "Malbec", "Tannat", "Viognier",
+    "Marsanne", "Roussanne", "Mondeuse", "Jacquère", "Altesse", "Nebbiolo", "Sangiovese",
+    "Nerello Mascalese", "Petit Manseng", "Gros Manseng", "Sémillon", "Muscat",
+]
+FORMATS = [("Standard", 85), ("Magnum", 7), ("Demi-bouteille", 4), ("Clavelin", 3), ("Jéroboam", 1)]
+LOCATIONS = [("Maison principale", 60), ("Résidence secondaire", 25), ("Réserve", 10), ("Bar", 5)]
+DOMAIN_PREFIXES = ["Domaine", "Château", "Clos", "Mas", "Maison", "Cave"]
+SURNAMES = [
+    "Lefèvre", "Moreau", "Bernard", "Dubois", "Roux", "Fontaine", "Chevalier", "Girard",
+    "Lambert", "Bonnet", "Mercier", "Blanc", "Guérin", "Faure", "Rousseau", "Garnier",
+    "Perrin", "Morel", "Clément", "Gauthier", "Masson", "Marchand", "Duval", "Denis",
+    "Lemoine", "Renaud", "Barbier", "Arnaud", "Picard", "Brunet", "Noël", "Rolland",
+]
+CUVEES = [
+    "Vieilles Vignes", "Les Crays", "Cuvée Tradition", "Sous la Roche", "Le Clos",
+    "Premier Cru", "Les Vignes d'Antan", "Fût de Chêne", "Réserve", "Les Terres Blanches",
+    "Côte Rôtie", "La Source", "Les Galets", "Pur Jus", "Sans Soufre", "L'Insolite",
+]
+
+
+def _zipf(count, s=1.1):
+    """Cumulative weights giving rank r a share proportional to 1 / r**s."""
+    return list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(count)))
+
+
+def _weighted(pairs):
+    return [value for value, *_ in pairs], list(itertools.accumulate(pair[-1] for pair in pairs))
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic cellar of any size for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--references", type=int, default=10000, help="Number of references")
+        parser.add_argument(
+            "--purchases-per-ref", type=int, default=3, help="Purchases per reference"
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Random seed (same seed, same cellar)")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="References per transaction")
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Truncate every cellar table first, without tombstones: benchmark databases only",
+        )
+
+    def handle(self, *args, **options):
+        count = options["references"]
+        if count < 1 or options["purchases_per_ref"] < 0:
+            raise CommandError("--references must be positive and --purchases-per-ref not negative")
+        self.rng = random.Random(options["seed"])
+        started = time.monotonic()
+
+        if options["clear"]:
+            with connection.cursor() as cursor:
+                cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+                cursor.execute("TRUNCATE {}".format(", ".join(
+                    connection.ops.quote_name(model._meta.db_table) for model in [*MODELS, Tombstone]
+                )))
+            lookup_cache.invalidate()
+            cellar_changed()
+
+        self.create_lookups(count)
+        self.domains = self.domain_pool(max(20, count // 8))
+        self.domain_weights = _zipf(len(self.domains), 0.8)
+        created = {"references": 0, "purchases": 0}
+        for offset in range(0, count, options["chunk_size"]):
+            size = min(options["chunk_size"], count - offset)
+            with transaction.atomic():
+                purchases = self.create_chunk(size, options["purchases_per_ref"])
+            created["references"] += size
+            created["purchases"] += purchases
+            rate = created["references"] / (time.monotonic() - started)
+            self.stdout.write(f"{created['references']}/{count} references ({rate:.0f}/s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {created['references']} references and {created['purchases']} purchases "
+            f"in {time.monotonic() - started:.1f}s"
+        ))
+
+    def pick(self, values, cum_weights):
+        return values[bisect.bisect(cum_weights, self.rng.random() * cum_weights[-1])]
+
+    def create_lookups(self, count):
+        """Lookups grow slowly with the cellar, like real ones."""
+        categories = Category.objects.upsert(name for name, _, _ in CATEGORIES)
+        for name, color, _ in CATEGORIES:
+            if categories[name].color != color:
+                touch(Category.objects.filter(pk=categories[name].pk), color=color)
+        self.categories = _weighted([(categories[name].pk, w) for name, _, w in CATEGORIES])
+
+        regions = Region.objects.upsert(REGIONS)
+        self.regions = [regions[name] for name in REGIONS]
+        self.region_weights = _zipf(len(self.regions), 0.9)
+        # Beyond the real appellations, large cellars get lieux-dits.
+        extra = int(math.sqrt(count) / len(REGIONS))
+        appellations = {
+            region: list(names) + [f"{names[0]} {CUVEES[i % len(CUVEES)]} {i}" for i in range(extra)]
+            for region, names in REGIONS.items()
+        }
+        ids = Appellation.objects.upsert(name for names in appellations.values() for name in names)
+        self.appellations = {
+            regions[region].pk: ([ids[name].pk for name in names], _zipf(len(names)))
+            for region, names in appellations.items()
+        }
+        formats = Format.objects.upsert(name for name, _ in FORMATS)
+        self.formats = _weighted([(formats[name].pk, w) for name, w in FORMATS])
+        grapes = Grape.objects.upsert(GRAPES)
+        self.grapes = [grapes[name].pk for name in GRAPES]
+        self.grape_weights = _zipf(len(self.grapes), 0.9)
+        self.locations = _weighted(LOCATIONS)
+
+    def domain_pool(self, size):
+        names = [f"{prefix} {surname}" for surname in SURNAMES for prefix in DOMAIN_PREFIXES]
+        self.rng.shuffle(names)
+        return [
+            names[i % len(names)] + (f" {i // len(names) + 1}" if i >= len(names) else "")
+            for i in range(size)
+        ]
+
+    def create_chunk(self, size, purchases_per_ref):
+        rng = self.rng
+        version = cellar_changed()
+        now = timezone.now()
+        today = date.today()
+        references, links, purchases, movements = [], [], [], []
+        for reference_id in allocate_ids(Reference, size):
+            region = self.pick(self.regions, self.region_weights)
+            appellation = self.pick(*self.appellations[region.pk])
+            vintage = today.year - 1 - min(int(rng.expovariate(0.25)), 40) if rng.random() < 0.95 else None
+            # Bottle prices are roughly log-normal around 20 EUR.
+            base_price = math.exp(rng.gauss(3.0, 0.6))
+            purchased = 0
+            for _ in range(purchases_per_ref):
+                quantity = rng.choice((6, 6, 12, 12, 1, 2, 3, 24))
+                purchased += quantity
+                purchases.append((
+                    reference_id,
+                    today - timedelta(days=int(rng.expovariate(1 / 400))),
+                    quantity,
+                    Decimal(f"{base_price * rng.uniform(0.85, 1.15):.2f}"),
+                    now, now, version,
+                ))
+            # A sixth of the references are sold out.
+            quantity = 0 if rng.random() < 0.16 else rng.randint(1, max(1, purchased or 12))
+            if quantity:
+                movements.append((reference_id, quantity, StockMovement.Reason.INITIAL, now))
+            grape_count = min(len(self.grapes), 1 + int(rng.expovariate(1.2)))
+            grapes = {self.pick(self.grapes, self.grape_weights) for _ in range(grape_count)}
+            links += [(reference_id, grape) for grape in grapes]
+            domain = self.pick(self.domains, self.domain_weights)
+            references.append((
+                reference_id,
+                f"{domain} {rng.choice(CUVEES)}" if rng.random() < 0.7 else domain,
+                self.pick(*self.categories),
+                region.pk,
+                appellation,
+                self.pick(*self.formats),
+                domain,
+                self.pick(*self.locations),
+                vintage,
+                quantity,
+                Decimal(rng.choice(("2.50", "3.00", "3.00", "3.00", "3.50"))),
+                Decimal(f"{base_price * 3 + 5:.0f}") if rng.random() < 0.03 else None,
+                None,
+                rng.random() < 0.05,
+                now, now, version,
+            ))
+        insert_rows(
+            Reference,
+            ["id", "name", "category_id", "region_id", "appellation_id", "format_id", "domain",
+             "location", "vintage", "current_quantity", "price_multiplier", "retail_price_override",
+             "notes", "hidden_from_menu", "created_at", "updated_at", "version"],
+            references,
+        )
+        insert_rows(Reference.grapes.through, ["reference_id", "grape_id"], links)
+        insert_rows(
+            Purchase,
+            ["reference_id", "date", "quantity", "price", "created_at", "updated_at", "version"],
+            purchases,
+        )
+        insert_rows(StockMovement, ["reference_id", "delta", "reason", "created_at"], movements)
+        return len(purchases)
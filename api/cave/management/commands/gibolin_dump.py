@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cave import backup
+
+
+class Command(BaseCommand):
+    help = "Write every cellar table to a compressed, chunked archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Archive to write (zip)")
+        parser.add_argument(
+            "--chunk-size", type=int, default=backup.CHUNK_SIZE, help="Rows per archive chunk"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            manifest = backup.dump(options["path"], options["chunk_size"])
+        except OSError as exc:
+            raise CommandError(exc)
+        for label, table in manifest["tables"].items():
+            self.stdout.write(f"{label}: {table['rows']} rows")
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['path']}"))
@@ -0,0 +1,28 @@
+import zipfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cave import backup
+
+
+class Command(BaseCommand):
+    help = "Load an archive written by gibolin_dump, keeping ids (and sqids)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Archive to restore")
+        parser.add_argument(
+            "--replace",
+            action="store_true",
+            help="Delete the current cellar first (required when it is not empty)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            counts = backup.restore(options["path"], replace=options["replace"])
+        except (OSError, backup.BackupError) as exc:
+            raise CommandError(exc)
+        except zipfile.BadZipFile:
+            raise CommandError(f"{options['path']} is not a zip archive")
+        for label, rows in counts.items():
+            self.stdout.write(f"{label}: {rows} rows")
+        self.stdout.write(self.style.SUCCESS(f"Restored {options['path']}"))
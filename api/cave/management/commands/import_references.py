@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cave import importer
+
+
+class Command(BaseCommand):
+    help = "Create references and purchases from a CSV or XLSX spreadsheet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Spreadsheet to import")
+        parser.add_argument(
+            "--format",
+            choices=importer.FORMATS,
+            help="File format (default: guessed from the file extension, else csv)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Validate and report without writing anything",
+        )
+        parser.add_argument("--chunk-size", type=int, default=importer.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("xlsx" if path.lower().endswith(".xlsx") else "csv")
+        try:
+            with open(path, "rb") as source:
+                report = importer.import_references(
+                    source, fmt, dry_run=options["dry_run"], chunk_size=options["chunk_size"]
+                )
+        except (OSError, ValueError) as exc:
+            raise CommandError(exc)
+
+        for error in report["errors"]:
+            detail = "; ".join(
+                f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.get("detail", [])
+            )
+            self.stderr.write(f"row {error['row']}: {error['error']}" + (f" ({detail})" if detail else ""))
+        summary = (
+            f"{report['rows']} rows, {report['references']} references, "
+            f"{report['purchases']} purchases, {report['invalid']} invalid"
+        )
+        if report["invalid"]:
+            raise CommandError(f"{summary}; nothing imported")
+        if not report["committed"]:
+            self.stdout.write(f"{summary} (dry run, nothing imported)")
+        else:
+            self.stdout.write(self.style.SUCCESS(summary))
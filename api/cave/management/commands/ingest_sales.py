@@ -0,0 +1,83 @@
+import csv
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cave import pos
+
+
+class Command(BaseCommand):
+    help = "Apply point-of-sale events from an NDJSON or CSV file (or - for stdin)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to read, or - for stdin")
+        parser.add_argument(
+            "--format",
+            choices=pos.FORMATS,
+            help="Event format (default: guessed from the file extension, else ndjson)",
+        )
+        parser.add_argument("--batch-size", type=int, default=pos.BATCH_SIZE)
+        parser.add_argument(
+            "--follow",
+            action="store_true",
+            help="Keep reading events appended to the file, like tail -f",
+        )
+        parser.add_argument("--interval", type=float, default=1.0, help="Polling interval with --follow")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("csv" if path.endswith(".csv") else "ndjson")
+        if path == "-":
+            if options["follow"]:
+                raise CommandError("--follow needs a file")
+            self.report(pos.ingest(sys.stdin, fmt, batch_size=options["batch_size"]))
+            return
+        try:
+            source = open(path, newline="", encoding="utf-8")
+        except OSError as exc:
+            raise CommandError(exc)
+        with source:
+            if not options["follow"]:
+                self.report(pos.ingest(source, fmt, batch_size=options["batch_size"]))
+                return
+            self.follow(source, fmt, options)
+
+    def follow(self, source, fmt, options):
+        # CSV: the header is the first complete line, read whenever it
+        # arrives, then given to every chunk.
+        fieldnames = None
+        line_count = 0
+        try:
+            while True:
+                lines = []
+                # Only whole lines: a partial one is re-read once complete.
+                while True:
+                    offset = source.tell()
+                    line = source.readline()
+                    if not line.endswith("\n"):
+                        source.seek(offset)
+                        break
+                    lines.append(line)
+                if fmt == "csv" and fieldnames is None and lines:
+                    fieldnames = next(csv.reader([lines.pop(0)]))
+                    line_count += 1
+                if lines:
+                    self.report(pos.ingest(
+                        lines, fmt, batch_size=options["batch_size"],
+                        fieldnames=fieldnames, first_line=line_count + 1,
+                    ))
+                    line_count += len(lines)
+                else:
+                    time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+
+    def report(self, stats):
+        self.stdout.write(
+            f"{stats['received']} received, {stats['applied']} applied, "
+            f"{stats['duplicates']} duplicates, {stats['rejected']} rejected, "
+            f"{stats['movements']} stock movements"
+        )
+        for error in stats["errors"]:
+            self.stderr.write(f"line {error['line']}: {error['error']}")
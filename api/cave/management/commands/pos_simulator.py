@@ -0,0 +1,77 @@
+import csv
+import itertools
+import json
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from cave import pos
+from cave.api import sqid_encode
+from cave.models import Reference
+
+
+class Command(BaseCommand):
+    help = "Stand-in for the till: append random sale events to a file for ingest_sales"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="File to append events to")
+        parser.add_argument("--events", type=int, default=1000, help="Number of events to write")
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Events per second (default: as fast as possible)",
+        )
+        parser.add_argument("--format", choices=pos.FORMATS)
+        parser.add_argument(
+            "--duplicates",
+            type=float,
+            default=0.01,
+            help="Fraction of events re-sent with an id already written, like a till retrying",
+        )
+        parser.add_argument("--seed", type=int)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("csv" if path.endswith(".csv") else "ndjson")
+        rng = random.Random(options["seed"])
+        sqids = [sqid_encode(pk) for pk in Reference.objects.values_list("pk", flat=True)]
+        if not sqids:
+            raise CommandError("No references to sell")
+        # A few references make most of the sales. Cumulative weights spare
+        # choices() summing them again for every event.
+        cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(sqids))))
+
+        with open(path, "a", newline="", encoding="utf-8") as out:
+            writer = csv.DictWriter(out, ["event_id", "sqid", "quantity", "occurred_at"])
+            if fmt == "csv" and out.tell() == 0:
+                writer.writeheader()
+            sent = []
+            started = time.monotonic()
+            for count in range(options["events"]):
+                if sent and rng.random() < options["duplicates"]:
+                    event = rng.choice(sent)
+                else:
+                    event = {
+                        "event_id": str(uuid.UUID(int=rng.getrandbits(128))),
+                        "sqid": rng.choices(sqids, cum_weights=cum_weights)[0],
+                        "quantity": 1 if rng.random() < 0.9 else rng.randint(2, 6),
+                        "occurred_at": timezone.now().isoformat(),
+                    }
+                    sent.append(event)
+                if fmt == "csv":
+                    writer.writerow(event)
+                else:
+                    out.write(json.dumps(event) + "\n")
+                if options["rate"]:
+                    out.flush()
+                    delay = started + (count + 1) / options["rate"] - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Wrote {options['events']} events ({len(sent)} unique) to {path}")
+        )
@@ -0,0 +1,118 @@
+"""Prometheus metrics, served at /metrics.
+
+Per route: request counts by status, latency histograms, and the DB
+queries and DB time of each request (from the request's timing.Timer).
+Also requests in flight and hits and misses of the shared cache per key
+family, for hit ratios.
+
+Gunicorn workers are separate processes. When PROMETHEUS_MULTIPROC_DIR
+is set (docker-entrypoint.sh does), each worker writes its values to
+memory-mapped files in that directory and /metrics aggregates all of
+them, whichever worker answers; no external service is involved. The
+directory must be emptied before the workers start, and gunicorn.conf.py
+tells the client when a worker exits. Without it, as in development and
+tests, metrics are those of the current process.
+"""
+
+import os
+import time
+
+from django.core.cache.backends import filebased
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+REQUESTS = Counter(
+    "gibolin_http_requests", "HTTP requests", ["method", "route", "status"]
+)
+LATENCY = Histogram(
+    "gibolin_http_request_duration_seconds", "Time to produce a response",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+IN_FLIGHT = Gauge(
+    "gibolin_http_requests_in_flight", "Requests being handled", multiprocess_mode="livesum"
+)
+DB_QUERIES = Histogram(
+    "gibolin_db_queries_per_request", "SQL queries run by a request", ["route"],
+    buckets=QUERY_BUCKETS,
+)
+DB_DURATION = Histogram(
+    "gibolin_db_duration_seconds", "Time a request spent in SQL queries", ["route"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE = Counter(
+    "gibolin_cache_lookups", "Shared cache reads", ["family", "result"]
+)
+
+UNMATCHED = "unmatched"
+
+
+def route(request):
+    """The URL pattern that handled the request, e.g. api/ref/<sqid>.
+
+    Patterns rather than paths keep the number of label values bounded.
+    """
+    match = getattr(request, "resolver_match", None)
+    return match.route if match is not None else UNMATCHED
+
+
+def observe(request, response, started):
+    """Record a finished request."""
+    label = route(request)
+    REQUESTS.labels(request.method, label, str(response.status_code)).inc()
+    LATENCY.labels(request.method, label).observe(time.perf_counter() - started)
+    timer = getattr(request, "timer", None)
+    if timer is not None:
+        DB_QUERIES.labels(label).observe(timer.queries)
+        DB_DURATION.labels(label).observe(timer.db)
+
+
+def render():
+    """Return (body, content type) of the exposition of every metric."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# Session keys of the cache and cached_db engines.
+SESSION_KEY_PREFIX = "django.contrib.sessions.cache"
+_missing = object()
+
+
+def key_family(key):
+    """Group cache keys by purpose: auth:user:12 -> auth:user."""
+    if key.startswith(SESSION_KEY_PREFIX):
+        return "session"
+    return ":".join(key.split(":")[:2])
+
+
+class FileBasedCache(filebased.FileBasedCache):
+    """The file-based cache, counting hits and misses per key family.
+
+    Reads through get(), get_many() (which calls get()), has_key() and
+    ``in`` are counted. add() checks for the key too, but as part of a
+    write, so that check is not counted.
+    """
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _missing, version)
+        CACHE.labels(key_family(key), "miss" if value is _missing else "hit").inc()
+        return default if value is _missing else value
+
+    def has_key(self, key, version=None):
+        found = super().has_key(key, version)
+        CACHE.labels(key_family(key), "hit" if found else "miss").inc()
+        return found
+
+    def add(self, key, value, timeout=filebased.DEFAULT_TIMEOUT, version=None):
+        if super().has_key(key, version):
+            return False
+        self.set(key, value, timeout, version)
+        return True
@@ -1,11 +1,220 @@
+import json
+import logging
+import time
+
 from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.db import DatabaseError, connection
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.functional import SimpleLazyObject
+from whitenoise import middleware as whitenoise
+
+from . import compression, metrics, profiling, slowlog
+from .auth import get_cached_user, get_dev_user
+from .timing import Timer
+
+logger = logging.getLogger(__name__)
+request_logger = logging.getLogger("cave.requests")
+
+
+class HealthCheckMiddleware:
+    """Answer health and readiness probes before the rest of the stack.
+
+    Must be first in MIDDLEWARE: probes skip sessions, CSRF, auth and
+    messages entirely. /api/healthcheck only proves the process is up,
+    /api/readiness also measures a database round trip. Probes are not
+    authenticated, so database errors are logged rather than returned.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path == "/api/healthcheck":
+            return JsonResponse({})
+        if request.path == "/api/readiness":
+            return self.readiness()
+        return self.get_response(request)
+
+    @staticmethod
+    def readiness():
+        pool = {
+            "open": connection.connection is not None,
+            "max_age": connection.settings_dict["CONN_MAX_AGE"],
+        }
+        start = time.perf_counter()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except DatabaseError:
+            logger.exception("Readiness probe failed")
+            return JsonResponse({"status": "unavailable", "pool": pool}, status=503)
+        latency_ms = (time.perf_counter() - start) * 1000
+        return JsonResponse(
+            {"status": "ok", "db_latency_ms": round(latency_ms, 2), "pool": pool}
+        )
+
+
+class ServerTimingMiddleware:
+    """Time each request; report it in Server-Timing and one log line.
+
+    Reports DB time and query count, the view, serialization and
+    rendering phases (see timing), and the total. Slow requests are also
+    written to the slow request log (see slowlog). Goes right after
+    HealthCheckMiddleware so the total covers the rest of the stack. The
+    body of a streaming response is produced after the header is sent,
+    so its timings stop at the start of the stream.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = request.timer = Timer()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        metrics = timer.metrics()
+        response.headers["Server-Timing"] = timer.header(metrics)
+        request_logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            **metrics,
+        }))
+        slowlog.record(request, response, timer, metrics)
+        return response
+
+
+class MetricsMiddleware:
+    """Record each request in the Prometheus metrics (see metrics).
+
+    Goes right after ServerTimingMiddleware, whose timer supplies the DB
+    figures. Requests are labelled by URL pattern, known once resolved.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with metrics.IN_FLIGHT.track_inprogress():
+            response = self.get_response(request)
+        metrics.observe(request, response, started)
+        return response
+
+
+class WhiteNoiseMiddleware(whitenoise.WhiteNoiseMiddleware):
+    """WhiteNoise, also caching Vite's content-hashed /assets/ forever.
+
+    WHITENOISE_IMMUTABLE_FILE_TEST would replace WhiteNoise's own test,
+    which recognises hashed static files; this keeps both.
+    """
+
+    def immutable_file_test(self, path, url):
+        return url.startswith("/assets/") or super().immutable_file_test(path, url)
+
+
+class CompressionMiddleware:
+    """Compress text responses with the best encoding the client accepts.
+
+    Responses may carry precomputed bodies in a ``precompressed`` attribute
+    (encoding -> bytes, see compression.precompress); those are reused as is.
+    Streaming responses are compressed chunk by chunk.
+    """
+
+    min_length = 1024
+    content_types = ("application/json", "text/html", "text/csv", "application/x-ndjson")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header("Content-Encoding") or getattr(response, "is_async", False):
+            return response
+        if not response.get("Content-Type", "").startswith(self.content_types):
+            return response
+        if not response.streaming and len(response.content) < self.min_length:
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoding = compression.negotiate(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compression.compress_chunks(
+                response.streaming_content, encoding
+            )
+            del response.headers["Content-Length"]
+        else:
+            precompressed = getattr(response, "precompressed", None) or {}
+            content = precompressed.get(encoding) or compression.compress_bytes(
+                response.content, encoding
+            )
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response.headers["Content-Length"] = str(len(content))
+
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """AuthenticationMiddleware that resolves request.user through the cache.
+
+    Sessions already come from the cache (cached_db engine), so a warm
+    authenticated request does no auth-related database work.
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: self._get_user(request))
+
+    @staticmethod
+    def _get_user(request):
+        if not hasattr(request, "_cached_user"):
+            request._cached_user = get_cached_user(request)
+        return request._cached_user
+
+
+class ProfilingMiddleware:
+    """Profile requests of staff users who ask for it (see profiling).
+
+    Goes after CachedAuthenticationMiddleware, and DevAutoLoginMiddleware
+    in development, which provide the user. The response's X-Profile
+    header gives the backoffice URL to download the profile from; the
+    profile of a streaming response is complete once the body is sent.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profiling.requested(request):
+            return self.get_response(request)
+        with profiling.Sampler(settings.PROFILE_INTERVAL_MS / 1000) as sampler:
+            response = self.get_response(request)
+        profile = profiling.save(request, response, sampler, metrics.route(request))
+        if response.streaming:
+            response.streaming_content = profiling.stream(profile, sampler, response.streaming_content)
+        response.headers["X-Profile"] = reverse("admin:cave_profile_download", args=[profile.pk])
+        return response
 
 
 class DevAutoLoginMiddleware:
     """Auto-authenticate as first staff user in dev when OIDC is not configured.
 
     Only active when settings.DEBUG is True at request time (Django's test
-    runner sets DEBUG=False, so this does nothing during tests).
+    runner sets DEBUG=False, so this does nothing during tests). The staff
+    user comes from the shared cache rather than a query on every request
+    (see auth.get_dev_user).
     """
 
     def __init__(self, get_response):
@@ -13,9 +222,7 @@ class DevAutoLoginMiddleware:
 
     def __call__(self, request):
         if settings.DEBUG and not request.user.is_authenticated:
-            from users.models import User
-
-            dev_user = User.objects.filter(is_staff=True).first()
+            dev_user = get_dev_user()
             if dev_user:
                 from django.contrib.auth import login
 
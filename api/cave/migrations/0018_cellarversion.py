@@ -0,0 +1,20 @@
+# Generated by Django 5.0.3 on 2026-10-19 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cave', '0017_grape_reference_grapes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CellarVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,144 @@
+# Generated by Django 5.0.3 on 2026-10-19 04:53
+
+from django.db import migrations, models
+
+# Reference columns pointing at a lookup table.
+FK_LOOKUPS = {
+    'category_id': 'cave_category',
+    'region_id': 'cave_region',
+    'appellation_id': 'cave_appellation',
+    'format_id': 'cave_format',
+}
+LOOKUP_TABLES = [*FK_LOOKUPS.values(), 'cave_grape']
+
+
+def adjust(table, column, op):
+    return (
+        f"IF {column} IS NOT NULL THEN "
+        f"UPDATE {table} SET reference_count = reference_count {op} 1 WHERE id = {column}; "
+        f"END IF;"
+    )
+
+
+def changed(table, column):
+    return (
+        f"IF OLD.{column} IS DISTINCT FROM NEW.{column} THEN "
+        f"{adjust(table, 'OLD.' + column, '-')} {adjust(table, 'NEW.' + column, '+')} END IF;"
+    )
+
+
+ON_INSERT = "\n        ".join(adjust(t, 'NEW.' + c, '+') for c, t in FK_LOOKUPS.items())
+ON_DELETE = "\n        ".join(adjust(t, 'OLD.' + c, '-') for c, t in FK_LOOKUPS.items())
+ON_UPDATE = "\n        ".join(changed(t, c) for c, t in FK_LOOKUPS.items())
+
+PROTECT_TRIGGERS = "\n".join(
+    f"CREATE TRIGGER cave_protect_reference_count BEFORE UPDATE OF reference_count ON {table} "
+    f"FOR EACH ROW EXECUTE FUNCTION cave_protect_reference_count();"
+    for table in LOOKUP_TABLES
+)
+
+BACKFILL = "\n".join(
+    f"UPDATE {table} SET reference_count = "
+    f"(SELECT count(*) FROM cave_reference WHERE {column} = {table}.id);"
+    for column, table in FK_LOOKUPS.items()
+)
+
+CREATE_TRIGGERS = f"""
+CREATE FUNCTION cave_reference_lookup_counts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {ON_INSERT}
+    ELSIF TG_OP = 'DELETE' THEN
+        {ON_DELETE}
+    ELSE
+        {ON_UPDATE}
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cave_reference_lookup_counts
+AFTER INSERT OR DELETE OR UPDATE OF {', '.join(FK_LOOKUPS)} ON cave_reference
+FOR EACH ROW EXECUTE FUNCTION cave_reference_lookup_counts();
+
+CREATE FUNCTION cave_reference_grape_counts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {adjust('cave_grape', 'NEW.grape_id', '+')}
+    ELSE
+        {adjust('cave_grape', 'OLD.grape_id', '-')}
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cave_reference_grape_counts
+AFTER INSERT OR DELETE ON cave_reference_grapes
+FOR EACH ROW EXECUTE FUNCTION cave_reference_grape_counts();
+
+-- Counts only change from the triggers above (nested, so depth > 1): a
+-- plain save() of a lookup writes back whatever count it had loaded.
+CREATE FUNCTION cave_protect_reference_count() RETURNS trigger AS $$
+BEGIN
+    IF pg_trigger_depth() = 1 THEN
+        NEW.reference_count := OLD.reference_count;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+{PROTECT_TRIGGERS}
+
+{BACKFILL}
+UPDATE cave_grape SET reference_count =
+    (SELECT count(*) FROM cave_reference_grapes WHERE grape_id = cave_grape.id);
+"""
+
+DROP_PROTECT_TRIGGERS = "\n".join(
+    f"DROP TRIGGER cave_protect_reference_count ON {table};" for table in LOOKUP_TABLES
+)
+
+DROP_TRIGGERS = f"""
+DROP TRIGGER cave_reference_lookup_counts ON cave_reference;
+DROP FUNCTION cave_reference_lookup_counts();
+DROP TRIGGER cave_reference_grape_counts ON cave_reference_grapes;
+DROP FUNCTION cave_reference_grape_counts();
+{DROP_PROTECT_TRIGGERS}
+DROP FUNCTION cave_protect_reference_count();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cave', '0019_sync_tracking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appellation',
+            name='reference_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='reference_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='format',
+            name='reference_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='grape',
+            name='reference_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='region',
+            name='reference_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.3 on 2026-10-19 05:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cave', '0020_lookup_reference_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.IntegerField()),
+                ('reason', models.CharField(choices=[('initial', 'Initial'), ('purchase', 'Purchase'), ('sale', 'Sale'), ('breakage', 'Breakage'), ('transfer', 'Transfer'), ('correction', 'Correction'), ('adjustment', 'Adjustment')], max_length=16)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('reference', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='cave.reference')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at', '-id'],
+                'indexes': [models.Index(fields=['reference', '-created_at', '-id'], name='cave_movement_ref_history')],
+            },
+        ),
+        # Open the ledger with the stock each reference holds today.
+        migrations.RunSQL(
+            """
+            INSERT INTO cave_stockmovement (reference_id, delta, reason, created_at)
+            SELECT id, current_quantity, 'initial', now()
+            FROM cave_reference WHERE current_quantity <> 0
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
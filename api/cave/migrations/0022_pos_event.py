@@ -0,0 +1,21 @@
+# Generated by Django 5.0.3 on 2026-10-19 05:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cave', '0021_stock_movement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PosEvent',
+            fields=[
+                ('event_id', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('received_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,170 @@
+from django.db import migrations
+
+# Reference columns pointing at a lookup table.
+FK_LOOKUPS = {
+    'category_id': 'cave_category',
+    'region_id': 'cave_region',
+    'appellation_id': 'cave_appellation',
+    'format_id': 'cave_format',
+}
+
+# The per-row triggers of 0020 update a popular lookup (a format, a
+# region) once per reference, which turns a bulk insert into thousands of
+# updates of the same row. Inserts and deletes now run triggers once per
+# statement, which apply the net change of all its rows with one UPDATE
+# per lookup table. Updates keep a row trigger: a statement trigger cannot
+# take a column list, so it would run its aggregates on every update of
+# cave_reference (quantities, POS batches, version stamps). The row
+# trigger only fires when a lookup column actually changes (save() writes
+# every column).
+
+
+def apply_changes(table, changes):
+    return (
+        f"UPDATE {table} AS lookup SET reference_count = lookup.reference_count + delta.n "
+        f"FROM (SELECT id, sum(n) AS n FROM ({changes}) AS changes (id, n) "
+        f"WHERE id IS NOT NULL GROUP BY id) AS delta "
+        f"WHERE lookup.id = delta.id AND delta.n <> 0;"
+    )
+
+
+def counts_function(name, columns):
+    """A statement trigger function keeping the counts behind columns on
+    inserts and deletes."""
+    def branch(*sources):
+        return "\n        ".join(
+            apply_changes(table, " UNION ALL ".join(
+                f"SELECT {column}, {n} FROM {rows}" for rows, n in sources
+            ))
+            for column, table in columns.items()
+        )
+
+    return f"""
+CREATE FUNCTION {name}() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {branch(('new_rows', 1))}
+    ELSE
+        {branch(('old_rows', -1))}
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+def statement_triggers(name, table, events):
+    transitions = {
+        'INSERT': 'REFERENCING NEW TABLE AS new_rows',
+        'DELETE': 'REFERENCING OLD TABLE AS old_rows',
+    }
+    # Transition tables need one trigger per event.
+    return "\n".join(
+        f"CREATE TRIGGER {name}_{event.lower()} AFTER {event} ON {table} "
+        f"{transitions[event]} FOR EACH STATEMENT EXECUTE FUNCTION {name}();"
+        for event in events
+    )
+
+
+def drop_statement_triggers(name, table, events):
+    return "\n".join(f"DROP TRIGGER {name}_{event.lower()} ON {table};" for event in events)
+
+
+EVENTS = ['INSERT', 'DELETE']
+
+
+def row_adjust(table, column, op):
+    return (
+        f"IF {column} IS NOT NULL THEN "
+        f"UPDATE {table} SET reference_count = reference_count {op} 1 WHERE id = {column}; "
+        f"END IF;"
+    )
+
+
+def row_changed(table, column):
+    return (
+        f"IF OLD.{column} IS DISTINCT FROM NEW.{column} THEN "
+        f"{row_adjust(table, 'OLD.' + column, '-')} {row_adjust(table, 'NEW.' + column, '+')} END IF;"
+    )
+
+
+DROP_ROW_TRIGGERS = """
+DROP TRIGGER cave_reference_lookup_counts ON cave_reference;
+DROP FUNCTION cave_reference_lookup_counts();
+DROP TRIGGER cave_reference_grape_counts ON cave_reference_grapes;
+DROP FUNCTION cave_reference_grape_counts();
+"""
+
+CREATE_STATEMENT_TRIGGERS = f"""
+{DROP_ROW_TRIGGERS}
+{counts_function('cave_reference_lookup_counts', FK_LOOKUPS)}
+{statement_triggers('cave_reference_lookup_counts', 'cave_reference', EVENTS)}
+{counts_function('cave_reference_grape_counts', {'grape_id': 'cave_grape'})}
+{statement_triggers('cave_reference_grape_counts', 'cave_reference_grapes', EVENTS)}
+
+CREATE FUNCTION cave_reference_lookup_count_updates() RETURNS trigger AS $$
+BEGIN
+    {" ".join(row_changed(t, c) for c, t in FK_LOOKUPS.items())}
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cave_reference_lookup_count_updates
+AFTER UPDATE OF {', '.join(FK_LOOKUPS)} ON cave_reference
+FOR EACH ROW WHEN ({" OR ".join(f"OLD.{c} IS DISTINCT FROM NEW.{c}" for c in FK_LOOKUPS)})
+EXECUTE FUNCTION cave_reference_lookup_count_updates();
+"""
+
+
+# The triggers of 0020, restored when migrating back.
+RESTORE_ROW_TRIGGERS = f"""
+DROP TRIGGER cave_reference_lookup_count_updates ON cave_reference;
+DROP FUNCTION cave_reference_lookup_count_updates();
+{drop_statement_triggers('cave_reference_lookup_counts', 'cave_reference', EVENTS)}
+DROP FUNCTION cave_reference_lookup_counts();
+{drop_statement_triggers('cave_reference_grape_counts', 'cave_reference_grapes', EVENTS)}
+DROP FUNCTION cave_reference_grape_counts();
+
+CREATE FUNCTION cave_reference_lookup_counts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {" ".join(row_adjust(t, 'NEW.' + c, '+') for c, t in FK_LOOKUPS.items())}
+    ELSIF TG_OP = 'DELETE' THEN
+        {" ".join(row_adjust(t, 'OLD.' + c, '-') for c, t in FK_LOOKUPS.items())}
+    ELSE
+        {" ".join(row_changed(t, c) for c, t in FK_LOOKUPS.items())}
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cave_reference_lookup_counts
+AFTER INSERT OR DELETE OR UPDATE OF {', '.join(FK_LOOKUPS)} ON cave_reference
+FOR EACH ROW EXECUTE FUNCTION cave_reference_lookup_counts();
+
+CREATE FUNCTION cave_reference_grape_counts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {row_adjust('cave_grape', 'NEW.grape_id', '+')}
+    ELSE
+        {row_adjust('cave_grape', 'OLD.grape_id', '-')}
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cave_reference_grape_counts
+AFTER INSERT OR DELETE ON cave_reference_grapes
+FOR EACH ROW EXECUTE FUNCTION cave_reference_grape_counts();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cave', '0022_pos_event'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_STATEMENT_TRIGGERS, RESTORE_ROW_TRIGGERS),
+    ]
@@ -1,9 +1,204 @@
 from django.conf import settings
-from django.db import models
+from django.db import connection, connections, models, transaction
+from django.utils import timezone
 
 
-class Category(models.Model):
+class TrackedModel(models.Model):
+    """Base for rows exposed through /api/sync.
+
+    Saving stamps the row with the next cellar version inside the same
+    transaction. Writers serialize on the CellarVersion row, so versions
+    follow commit order and a version is a safe delta sync token.
+    """
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    version = models.BigIntegerField(default=0, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        from .versioning import cellar_changed
+
+        with transaction.atomic(using=kwargs.get("using")):
+            self.version = cellar_changed()
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "version", "updated_at"}
+            super().save(*args, **kwargs)
+
+
+class LookupManager(models.Manager):
+    """Manager for the name-keyed lookup tables (category, region, ...)."""
+
+    def upsert(self, names):
+        """Return {name: instance} for names, creating the missing ones.
+
+        One SELECT, plus one INSERT ... ON CONFLICT ... RETURNING when
+        names are missing, whatever the number of names. Existing rows are
+        returned unchanged but locked until the transaction ends, so a
+        concurrent orphan cleanup cannot delete them before they are
+        referenced. The cellar version only moves when a row is created.
+        """
+        return {obj.name: obj for obj, _ in self._upsert(names)}
+
+    def resolve(self, names):
+        """Like upsert, but names known to this process cost no query.
+
+        Their ids are used unlocked. An orphan cleanup may delete one
+        before the references using it commit; their deferred foreign key
+        check then fails, and api._retry_stale_lookups writes again.
+        """
+        from . import lookup_cache
+
+        names = set(names)
+        found = {
+            name: self.model.from_db(self.db, ["id", "name"], (pk, name))
+            for name, pk in lookup_cache.cached_ids(self.model, names).items()
+        }
+        found.update(self.upsert(names - found.keys()))
+        return found
+
+    def upsert_one(self, name):
+        """get_or_create(name=name) as a single upsert; returns (obj, created)."""
+        return self._upsert([name])[0]
+
+    def delete_orphans(self, ids=None):
+        """Delete the lookups no reference uses, among ids (all when None).
+
+        A plain SELECT finds the orphans first, so a cleanup with nothing
+        to do takes no lock and leaves the cellar version alone. Otherwise
+        the version is bumped before the DELETE ... WHERE reference_count
+        = 0 ... RETURNING: like every writer, this locks CellarVersion
+        before lookup rows, which rules out deadlocks with _upsert. The
+        count is kept by triggers that lock the lookup row, so a writer
+        about to use a lookup makes the DELETE wait and then see its new
+        count. No post_delete signals fire: tombstones and the lookup id
+        cache are handled here. Returns the deleted ids.
+        """
+        from . import lookup_cache
+        from .versioning import cellar_changed
+
+        if ids is not None:
+            ids = sorted({pk for pk in ids if pk is not None})
+            if not ids:
+                return []
+        model = self.model
+        conn = connections[self.db]
+        where = "reference_count = 0"
+        params = []
+        if ids is not None:
+            where += " AND id = ANY(%s)"
+            params.append(ids)
+        table = conn.ops.quote_name(model._meta.db_table)
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table} WHERE {where})", params)
+            if not cursor.fetchone()[0]:
+                return []
+        with transaction.atomic(using=self.db):
+            version = cellar_changed()
+            with conn.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {table} WHERE {where} RETURNING id", params)
+                deleted = [row[0] for row in cursor.fetchall()]
+            if deleted:
+                Tombstone.objects.using(self.db).bulk_create(
+                    Tombstone(model=model._meta.model_name, object_id=pk, version=version)
+                    for pk in deleted
+                )
+                lookup_cache.invalidate()
+        return deleted
+
+    def _lock(self, where, params):
+        """Return the rows matching where, locked FOR KEY SHARE.
+
+        Like every writer, this locks CellarVersion before lookup rows (see
+        delete_orphans). One statement: the lateral subquery only runs,
+        and locks, once the version row is locked.
+        """
+        model = self.model
+        conn = connections[self.db]
+        columns = ", ".join(
+            f"lookup.{conn.ops.quote_name(f.column)}" for f in model._meta.concrete_fields
+        )
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT {columns}
+                FROM (
+                    SELECT id FROM {CellarVersion._meta.db_table} WHERE id = 1 FOR NO KEY UPDATE
+                ) AS version
+                CROSS JOIN LATERAL (
+                    SELECT * FROM {model._meta.db_table}
+                    WHERE {where} AND version.id = 1
+                    ORDER BY id FOR KEY SHARE
+                ) AS lookup
+                """,
+                params,
+            )
+            field_names = [f.attname for f in model._meta.concrete_fields]
+            return [model.from_db(self.db, field_names, row) for row in cursor.fetchall()]
+
+    def _upsert(self, names):
+        from . import lookup_cache
+        from .versioning import cellar_changed
+
+        # Sorted so concurrent writers lock rows in the same order.
+        names = sorted(set(names))
+        if not names:
+            return []
+        model = self.model
+        table = model._meta.db_table
+        fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+        field_names = [f.attname for f in model._meta.concrete_fields]
+        conn = connections[self.db]
+        selected = ", ".join(conn.ops.quote_name(f.column) for f in model._meta.concrete_fields)
+        # Callers resolve several lookup types per write: no savepoint each.
+        with transaction.atomic(using=self.db, savepoint=False):
+            # Existing rows are only locked: they are neither rewritten nor
+            # restamped, and the version only moves when a row is created.
+            result = [(obj, False) for obj in self._lock("name = ANY(%s)", [names])]
+            missing = sorted(set(names) - {obj.name for obj, _ in result})
+            if not missing:
+                lookup_cache.remember(model, {obj.name: obj.pk for obj, _ in result})
+                return result
+
+            # New rows leave the ids other workers know valid, so they are
+            # remembered here rather than invalidating every copy.
+            now = timezone.now()
+            values = {"created_at": now, "updated_at": now, "version": cellar_changed()}
+            columns, params = [], []
+            for field in fields:
+                if field.name == "name":
+                    continue
+                columns.append(conn.ops.quote_name(field.column))
+                params.append(field.get_db_prep_save(
+                    values.get(field.name, field.get_default()), conn
+                ))
+            with conn.cursor() as cursor:
+                # DO UPDATE rather than DO NOTHING so that a row created
+                # concurrently is still returned (and locked).
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (name, {", ".join(columns)})
+                    SELECT name, {", ".join(["%s"] * len(params))}
+                    FROM unnest(%s::text[]) AS name
+                    ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+                    RETURNING {selected}, (xmax = 0) AS created
+                    """,
+                    [*params, missing],
+                )
+                result += [
+                    (model.from_db(self.db, field_names, row[:-1]), row[-1])
+                    for row in cursor.fetchall()
+                ]
+            lookup_cache.remember(model, {obj.name: obj.pk for obj, _ in result})
+        return result
+
+
+class Category(TrackedModel):
     name = models.CharField(max_length=255, unique=True)
+    # Maintained by database triggers (migration 0020), never by save().
+    reference_count = models.PositiveIntegerField(default=0, editable=False)
     color = models.CharField(max_length=7, default="#000000")  # Hex color code
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -13,6 +208,8 @@ class Category(models.Model):
         related_name="categories",
     )
 
+    objects = LookupManager()
+
     class Meta:
         verbose_name_plural = "categories"
         ordering = ["name"]
@@ -21,8 +218,10 @@ class Category(models.Model):
         return self.name
 
 
-class Region(models.Model):
+class Region(TrackedModel):
     name = models.CharField(max_length=255, unique=True)
+    # Maintained by database triggers (migration 0020), never by save().
+    reference_count = models.PositiveIntegerField(default=0, editable=False)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.SET_NULL,
@@ -31,6 +230,8 @@ class Region(models.Model):
         related_name="regions",
     )
 
+    objects = LookupManager()
+
     class Meta:
         verbose_name_plural = "regions"
         ordering = ["name"]
@@ -39,8 +240,10 @@ class Region(models.Model):
         return self.name
 
 
-class Appellation(models.Model):
+class Appellation(TrackedModel):
     name = models.CharField(max_length=255, unique=True)
+    # Maintained by database triggers (migration 0020), never by save().
+    reference_count = models.PositiveIntegerField(default=0, editable=False)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.SET_NULL,
@@ -49,6 +252,8 @@ class Appellation(models.Model):
         related_name="appellations",
     )
 
+    objects = LookupManager()
+
     class Meta:
         verbose_name_plural = "appellations"
         ordering = ["name"]
@@ -57,8 +262,10 @@ class Appellation(models.Model):
         return self.name
 
 
-class Format(models.Model):
+class Format(TrackedModel):
     name = models.CharField(max_length=255, unique=True)
+    # Maintained by database triggers (migration 0020), never by save().
+    reference_count = models.PositiveIntegerField(default=0, editable=False)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.SET_NULL,
@@ -67,6 +274,8 @@ class Format(models.Model):
         related_name="formats",
     )
 
+    objects = LookupManager()
+
     class Meta:
         ordering = ["name"]
 
@@ -74,8 +283,10 @@ class Format(models.Model):
         return self.name
 
 
-class Grape(models.Model):
+class Grape(TrackedModel):
     name = models.CharField(max_length=255, unique=True)
+    # Maintained by database triggers (migration 0020), never by save().
+    reference_count = models.PositiveIntegerField(default=0, editable=False)
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.SET_NULL,
@@ -84,6 +295,8 @@ class Grape(models.Model):
         related_name="grapes",
     )
 
+    objects = LookupManager()
+
     class Meta:
         ordering = ["name"]
 
@@ -91,7 +304,87 @@ class Grape(models.Model):
         return self.name
 
 
-class Reference(models.Model):
+class ReferenceManager(models.Manager):
+    def adjust_quantities(
+        self, adjustments, floor_at_zero=False, reason="adjustment", user=None, version=None
+    ):
+        """Add deltas to current_quantity and record them in the ledger.
+
+        One statement: an UPDATE ... RETURNING feeding the StockMovement
+        INSERT. adjustments is an iterable of (id, delta, expected) where
+        expected is None or the quantity the row must still hold. Rows
+        failing that guard, or going below zero with floor_at_zero, are
+        left untouched. Returns {id: new quantity} for the updated rows.
+        A caller that already bumped the cellar version in its transaction
+        passes it as version rather than bumping it twice.
+        """
+        from .versioning import cellar_changed
+
+        adjustments = list(adjustments)
+        if not adjustments:
+            return {}
+        ids, deltas, expected = (list(column) for column in zip(*adjustments))
+        if len(set(ids)) != len(ids):
+            raise ValueError("Each reference can only be adjusted once per call")
+        conn = connections[self.db]
+        table = conn.ops.quote_name(self.model._meta.db_table)
+        ledger = conn.ops.quote_name(StockMovement._meta.db_table)
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            if version is None:
+                version = cellar_changed()
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    WITH adjusted AS (
+                        UPDATE {table} AS ref
+                        SET current_quantity = ref.current_quantity + adj.delta,
+                            version = %s, updated_at = %s
+                        FROM unnest(%s::bigint[], %s::integer[], %s::integer[])
+                            AS adj(id, delta, expected)
+                        WHERE ref.id = adj.id
+                          AND (adj.expected IS NULL OR ref.current_quantity = adj.expected)
+                          AND (NOT %s OR ref.current_quantity + adj.delta >= 0)
+                        RETURNING ref.id, ref.current_quantity, adj.delta
+                    ), logged AS (
+                        INSERT INTO {ledger} (reference_id, delta, reason, user_id, created_at)
+                        SELECT id, delta, %s, %s, %s FROM adjusted WHERE delta <> 0
+                    )
+                    SELECT id, current_quantity FROM adjusted
+                    """,
+                    [
+                        version, now, ids, deltas, expected, floor_at_zero,
+                        reason, getattr(user, "pk", None), now,
+                    ],
+                )
+                return dict(cursor.fetchall())
+
+    def set_quantities(self, targets, reason="correction", user=None, version=None):
+        """Move current_quantity to absolute values through the ledger.
+
+        targets is an iterable of (id, quantity, expected). The rows are
+        locked first so the recorded deltas are exact.
+        """
+        targets = list(targets)
+        with transaction.atomic(using=self.db):
+            current = dict(
+                self.filter(pk__in=[pk for pk, _, _ in targets])
+                .select_for_update()
+                .values_list("pk", "current_quantity")
+            )
+            return self.adjust_quantities(
+                [
+                    (pk, quantity - current[pk], current[pk])
+                    for pk, quantity, expected in targets
+                    if pk in current and expected in (None, current[pk])
+                ],
+                reason=reason,
+                user=user,
+                version=version,
+            )
+
+
+class Reference(TrackedModel):
     name = models.CharField(max_length=255)
     category = models.ForeignKey(
         Category,
@@ -138,14 +431,31 @@ class Reference(models.Model):
         related_name="references_owned",
     )
 
+    objects = ReferenceManager()
+
     class Meta:
         ordering = ["name"]
 
     def __str__(self):
         return self.name
 
-
-class Purchase(models.Model):
+    def save(self, *args, movement_user=None, **kwargs):
+        # Later changes go through ReferenceManager so they reach the ledger;
+        # the opening stock of a new reference is recorded here, by
+        # movement_user (None outside of requests, e.g. in the shell).
+        adding = self._state.adding
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
+            if adding and self.current_quantity:
+                StockMovement.objects.create(
+                    reference=self,
+                    delta=self.current_quantity,
+                    reason=StockMovement.Reason.INITIAL,
+                    user=movement_user,
+                )
+
+
+class Purchase(TrackedModel):
     reference = models.ForeignKey(
         Reference, on_delete=models.CASCADE, related_name="purchases"
     )
@@ -157,6 +467,64 @@ class Purchase(models.Model):
         ordering = ["-date"]
 
 
+class StockMovement(models.Model):
+    """Append-only stock ledger; Reference.current_quantity is its sum."""
+
+    class Reason(models.TextChoices):
+        INITIAL = "initial"
+        PURCHASE = "purchase"
+        SALE = "sale"
+        BREAKAGE = "breakage"
+        TRANSFER = "transfer"
+        CORRECTION = "correction"
+        ADJUSTMENT = "adjustment"
+
+    reference = models.ForeignKey(
+        Reference, on_delete=models.CASCADE, related_name="movements", db_index=False
+    )
+    delta = models.IntegerField()
+    reason = models.CharField(max_length=16, choices=Reason.choices)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="stock_movements",
+    )
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ["-created_at", "-id"]
+        indexes = [
+            # History of one reference, newest first (also serves the FK).
+            models.Index(fields=["reference", "-created_at", "-id"], name="cave_movement_ref_history"),
+        ]
+
+
+class PosEvent(models.Model):
+    """Id of a point-of-sale event already applied, so replays are no-ops."""
+
+    event_id = models.CharField(max_length=64, primary_key=True)
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @classmethod
+    def record(cls, event_ids):
+        """Insert the ids not seen before; return those, in one statement."""
+        if not event_ids:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {cls._meta.db_table} (event_id, received_at)
+                SELECT event_id, %s FROM unnest(%s::text[]) AS event_id
+                ON CONFLICT (event_id) DO NOTHING
+                RETURNING event_id
+                """,
+                [timezone.now(), list(event_ids)],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
 class MenuTemplate(models.Model):
     content = models.TextField(default="")
     updated_at = models.DateTimeField(auto_now=True)
@@ -173,11 +541,73 @@ class MenuTemplate(models.Model):
 
     @classmethod
     def get_template(cls):
-        obj, _ = cls.objects.get_or_create(pk=1)
-        return obj.content
+        return cls.objects.filter(pk=1).values_list("content", flat=True).first() or ""
 
     @classmethod
     def set_template(cls, content):
         obj, _ = cls.objects.get_or_create(pk=1)
         obj.content = content
         obj.save()
+
+
+class CellarVersion(models.Model):
+    """Single-row change counter for the whole cellar (see cave.versioning).
+
+    The value is a microsecond timestamp that only moves forward, so it
+    keeps moving forward across a restore into an empty database.
+    """
+
+    version = models.BigIntegerField(default=0)
+
+    @classmethod
+    def bump(cls):
+        """Advance the version, locking the row until the transaction ends."""
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table} (id, version)
+                VALUES (1, (extract(epoch FROM clock_timestamp()) * 1000000)::bigint)
+                ON CONFLICT (id) DO UPDATE
+                SET version = GREATEST({table}.version + 1, EXCLUDED.version)
+                RETURNING version
+                """
+            )
+            return cursor.fetchone()[0]
+
+
+class Tombstone(models.Model):
+    """Record of a deleted row, so sync clients can drop their copy."""
+
+    model = models.CharField(max_length=32)
+    object_id = models.BigIntegerField()
+    version = models.BigIntegerField(db_index=True)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+
+class Profile(models.Model):
+    """Stack samples of one request, profiled on demand (see cave.profiling)."""
+
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="profiles",
+    )
+    method = models.CharField(max_length=8)
+    path = models.TextField()
+    route = models.CharField(max_length=255)
+    status = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    interval_ms = models.FloatField()
+    samples = models.PositiveIntegerField()
+    # Collapsed stack format, for flame graph tools.
+    stacks = models.TextField()
+
+    class Meta:
+        ordering = ["-created_at", "-id"]
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.created_at:%Y-%m-%d %H:%M:%S})"
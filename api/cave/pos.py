@@ -0,0 +1,146 @@
+"""Point-of-sale ingestion: sale events in, coalesced stock movements out.
+
+Events are NDJSON objects or CSV rows with an `event_id`, the `sqid` of
+the reference sold and an optional `quantity` (bottles, default 1,
+negative for returns). Events are applied in batches, each in one
+transaction: ids applied before are skipped through PosEvent, and the
+remaining quantities are summed per reference and applied with a single
+Reference.objects.adjust_quantities call. Replaying a file is a no-op as
+long as its events are younger than POS_EVENT_RETENTION_DAYS: older ids
+are pruned after each ingestion.
+"""
+
+import csv
+import json
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import PosEvent, Reference, StockMovement
+
+FORMATS = ("ndjson", "csv")
+BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 20
+
+
+def parse_events(lines, fmt="ndjson", fieldnames=None, first_line=1):
+    """Yield (line number, event dict or None when unparsable) from text lines.
+
+    first_line is the number of the first line, for lines read in chunks.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(lines, fieldnames=fieldnames)
+        for row in reader:
+            yield first_line - 1 + reader.line_num, row
+        return
+    for number, line in enumerate(lines, first_line):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            event = None
+        yield number, event if isinstance(event, dict) else None
+
+
+def _clean(event, decode):
+    if event is None:
+        raise ValueError("unparsable event")
+    event_id = str(event.get("event_id") or "").strip()
+    if not event_id or len(event_id) > PosEvent._meta.get_field("event_id").max_length:
+        raise ValueError("missing or invalid event_id")
+    reference_id = decode(str(event.get("sqid") or ""))
+    if reference_id is None:
+        raise ValueError("invalid sqid")
+    raw = event.get("quantity")
+    if raw is None or raw == "":
+        quantity = 1
+    elif isinstance(raw, bool) or isinstance(raw, float) and not raw.is_integer():
+        # int() would take true as 1 and truncate 1.5.
+        raise ValueError("invalid quantity")
+    else:
+        try:
+            quantity = int(raw)
+        except (TypeError, ValueError):
+            raise ValueError("invalid quantity") from None
+    if not quantity:
+        raise ValueError("quantity must not be zero")
+    return event_id, reference_id, quantity
+
+
+def _reject(stats, number, reason):
+    stats["rejected"] += 1
+    if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+        stats["errors"].append({"line": number, "error": reason})
+
+
+def _apply(batch, stats, user):
+    with transaction.atomic():
+        known = set(
+            Reference.objects.filter(id__in={ref for _, ref, _ in batch.values()})
+            .values_list("id", flat=True)
+        )
+        for event_id, (number, reference_id, _) in list(batch.items()):
+            if reference_id not in known:
+                _reject(stats, number, "unknown reference")
+                del batch[event_id]
+        new = PosEvent.record(list(batch))
+        totals = Counter()
+        for event_id in new:
+            _, reference_id, quantity = batch[event_id]
+            totals[reference_id] += quantity
+        Reference.objects.adjust_quantities(
+            [(ref, -total, None) for ref, total in sorted(totals.items()) if total],
+            reason=StockMovement.Reason.SALE,
+            user=user,
+        )
+    stats["applied"] += len(new)
+    stats["duplicates"] += len(batch) - len(new)
+    stats["movements"] += len(totals)
+
+
+def prune():
+    """Forget event ids older than POS_EVENT_RETENTION_DAYS."""
+    cutoff = timezone.now() - timedelta(days=settings.POS_EVENT_RETENTION_DAYS)
+    return PosEvent.objects.filter(received_at__lt=cutoff).delete()[0]
+
+
+def ingest(lines, fmt="ndjson", user=None, batch_size=BATCH_SIZE, fieldnames=None, first_line=1):
+    """Apply sale events read from text lines; return counters and errors."""
+    from .api import sqids
+
+    decoded = {}
+
+    def decode(sqid):
+        if sqid not in decoded:
+            decoded[sqid] = next(iter(sqids.decode(sqid)), None)
+        return decoded[sqid]
+
+    stats = {
+        "received": 0, "applied": 0, "duplicates": 0, "rejected": 0,
+        "movements": 0, "errors": [],
+    }
+    batch = {}
+    for number, event in parse_events(lines, fmt, fieldnames, first_line):
+        stats["received"] += 1
+        try:
+            event_id, reference_id, quantity = _clean(event, decode)
+        except (ValueError, TypeError) as exc:
+            _reject(stats, number, str(exc))
+            continue
+        if event_id in batch:
+            stats["duplicates"] += 1
+            continue
+        batch[event_id] = (number, reference_id, quantity)
+        if len(batch) >= batch_size:
+            _apply(batch, stats, user)
+            batch = {}
+    if batch:
+        _apply(batch, stats, user)
+    if stats["applied"]:
+        prune()
+    return stats
@@ -0,0 +1,142 @@
+"""On-demand profiling of single requests, for staff users.
+
+A staff user asks for a profile with an X-Profile header or a ``profile``
+query parameter. ProfilingMiddleware then samples the stack of the thread
+handling the request every PROFILE_INTERVAL_MS from a background thread,
+and stores the samples as a Profile in collapsed stack format
+("outer;inner;leaf count" per line), which flamegraph.pl, inferno and
+speedscope read. Profiles are listed and downloaded from the backoffice.
+
+Sampling needs no tracing hook, so profiled code runs at nearly full
+speed; requests that do not ask for a profile only pay for the check.
+The body of a streaming response is produced after the middleware
+returns; it is sampled while it is sent and added to the profile then.
+"""
+
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+
+from .models import Profile
+
+PARAM = "profile"
+HEADER = "HTTP_X_PROFILE"
+PROJECT_DIR = Path(settings.BASE_DIR)
+
+# The switch interval is process-wide and samplers of concurrent requests
+# overlap: the first one lowers it, the last one puts the original back.
+_switch_lock = threading.Lock()
+_switch = {"samplers": 0, "original": None}
+
+
+def requested(request):
+    """Whether the request asks to be profiled; staff only."""
+    if HEADER not in request.META and PARAM not in request.GET:
+        return False
+    return request.user.is_staff
+
+
+def _label(frame):
+    code = frame.f_code
+    path = Path(code.co_filename)
+    if path.is_relative_to(PROJECT_DIR):
+        path = path.relative_to(PROJECT_DIR)
+    elif "site-packages" in path.parts:
+        path = Path(*path.parts[path.parts.index("site-packages") + 1:])
+    return f"{code.co_qualname} ({path}:{code.co_firstlineno})".replace(";", ":")
+
+
+class Sampler:
+    """Count the stacks of the current thread, sampled from another thread.
+
+    Stacks stop at the frame that entered the sampler, which leaves out
+    the WSGI server and the outer middleware. While sampling, the
+    interpreter's switch interval is lowered to the sampling interval, so
+    the sampler gets the GIL on time even when the request is CPU bound.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def __enter__(self):
+        self._root = sys._getframe(1)
+        with _switch_lock:
+            if not _switch["samplers"]:
+                _switch["original"] = sys.getswitchinterval()
+            _switch["samplers"] += 1
+            sys.setswitchinterval(min(sys.getswitchinterval(), self.interval))
+        self._started = time.perf_counter()
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self._started
+        with _switch_lock:
+            _switch["samplers"] -= 1
+            if not _switch["samplers"]:
+                sys.setswitchinterval(_switch["original"])
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            labels = []
+            while frame is not None and frame is not self._root:
+                labels.append(_label(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(labels))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """The samples in collapsed stack format, heaviest stacks first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def save(request, response, sampler, route):
+    """Store the profile of a request; keep the latest PROFILE_KEEP."""
+    profile = Profile.objects.create(
+        user=request.user,
+        method=request.method,
+        path=request.get_full_path(),
+        route=route,
+        status=response.status_code,
+        duration_ms=round(sampler.duration * 1000, 2),
+        interval_ms=settings.PROFILE_INTERVAL_MS,
+        samples=sampler.samples,
+        stacks=sampler.collapsed(),
+    )
+    Profile.objects.filter(
+        pk__in=Profile.objects.values("pk")[settings.PROFILE_KEEP:]
+    ).delete()
+    return profile
+
+
+def stream(profile, sampler, content):
+    """Yield a streaming response's content, sampling it into profile.
+
+    The samples of the stream are added to those of the view (sampler)
+    once it is sent, or once the client goes away.
+    """
+    streamed = Sampler(sampler.interval)
+    try:
+        with streamed:
+            yield from content
+    finally:
+        sampler.stacks.update(streamed.stacks)
+        sampler.samples += streamed.samples
+        sampler.duration += streamed.duration
+        profile.samples = sampler.samples
+        profile.duration_ms = round(sampler.duration * 1000, 2)
+        profile.stacks = sampler.collapsed()
+        profile.save(update_fields=["samples", "duration_ms", "stacks"])
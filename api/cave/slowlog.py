@@ -0,0 +1,140 @@
+"""Slow request log.
+
+A request is logged to cave.slow when it takes longer than
+SLOW_REQUEST_MS, or when one of its queries takes longer than
+SLOW_QUERY_MS. The entry is one JSON object: route, path and query
+parameters, user, status, the request's timings (see timing) and its SQL
+statements with their durations. Parameters of statements on the session
+and user tables are redacted: they hold session keys and credentials.
+With SLOW_REQUEST_EXPLAIN, the slowest SELECTs are run again under
+EXPLAIN (ANALYZE, BUFFERS) and their plans added. That happens once the
+response has been sent (when it is closed), in a rolled back
+transaction, and only for requests that were slow already.
+
+settings.LOGGING sends cave.slow to a rotating local file, SLOW_LOG_FILE.
+"""
+
+import json
+import logging
+import re
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+
+from .metrics import route
+
+logger = logging.getLogger("cave.slow")
+
+MAX_LOGGED_STATEMENTS = 100
+MAX_PARAMS_LENGTH = 200
+# Statements EXPLAIN ANALYZE may run again: reads without side effects.
+EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+SIDE_EFFECTS = re.compile(r"\b(nextval|setval|FOR UPDATE|FOR SHARE|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+# Tables whose values must not reach the log, in parameters or in plans.
+SENSITIVE = re.compile(r"\b(django_session|users_user\w*|auth_\w+)\b")
+REDACTED = "[redacted]"
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def _params(sql, params):
+    if SENSITIVE.search(sql):
+        return REDACTED
+    text = repr(params)
+    return text if len(text) <= MAX_PARAMS_LENGTH else text[:MAX_PARAMS_LENGTH] + "..."
+
+
+def _user(request):
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated:
+        return None
+    return user.get_username()
+
+
+def slow_reasons(timer, total_ms):
+    """Why a request belongs in the log, or an empty list."""
+    reasons = []
+    if settings.SLOW_REQUEST_MS is not None and total_ms >= settings.SLOW_REQUEST_MS:
+        reasons.append("request")
+    if settings.SLOW_QUERY_MS is not None and any(
+        elapsed * 1000 >= settings.SLOW_QUERY_MS for *_, elapsed in timer.statements
+    ):
+        reasons.append("query")
+    return reasons
+
+
+def explain(sql, params):
+    """The EXPLAIN (ANALYZE, BUFFERS) plan of a read, or None."""
+    if not EXPLAINABLE.match(sql) or SIDE_EFFECTS.search(sql) or SENSITIVE.search(sql):
+        return None
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+            transaction.set_rollback(True)
+    except DatabaseError as exc:
+        return {"error": str(exc)}
+    return plan[0] if isinstance(plan, list) else plan
+
+
+def add_plans(entry, timer):
+    """Add the plans of the entry's SLOW_REQUEST_EXPLAIN slowest reads."""
+    statements = entry["statements"]
+    slowest = sorted(
+        (index for index, statement in enumerate(statements) if not statement["many"]),
+        key=lambda index: statements[index]["ms"], reverse=True,
+    )
+    for index in slowest[:settings.SLOW_REQUEST_EXPLAIN]:
+        sql, params, *_ = timer.statements[index]
+        plan = explain(sql, params)
+        if plan is not None:
+            statements[index]["plan"] = plan
+
+
+def entry(request, response, timer, metrics, reasons):
+    """The log entry of a slow request, without plans."""
+    statements = [
+        {"sql": sql, "params": _params(sql, params), "many": many, "ms": _ms(elapsed)}
+        for sql, params, many, elapsed in timer.statements[:MAX_LOGGED_STATEMENTS]
+    ]
+    return {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "reasons": reasons,
+        "method": request.method,
+        "route": route(request),
+        "path": request.path,
+        "params": {key: values for key, values in request.GET.lists()},
+        "user": _user(request),
+        "status": response.status_code,
+        **metrics,
+        "statements": statements,
+        "statements_omitted": timer.queries - len(statements),
+    }
+
+
+def _log(entry):
+    logger.warning(json.dumps(entry, default=str, ensure_ascii=False))
+
+
+def record(request, response, timer, metrics):
+    """Log the request if it was slow.
+
+    Entries with plans are logged when the response is closed, after the
+    server has sent it, so the client does not wait for EXPLAIN ANALYZE.
+    """
+    reasons = slow_reasons(timer, metrics["total_ms"])
+    if not reasons:
+        return
+    slow = entry(request, response, timer, metrics, reasons)
+    if not settings.SLOW_REQUEST_EXPLAIN:
+        _log(slow)
+        return
+
+    def explain_and_log():
+        add_plans(slow, timer)
+        _log(slow)
+
+    response._resource_closers.append(explain_and_log)
@@ -1,16 +1,114 @@
-from django.test import TestCase, Client, override_settings
-from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.signals import request_started
+from django.db import OperationalError, connection, transaction
+from django.db.models import Max, Sum
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from django.test.utils import CaptureQueriesContext
+from mozilla_django_oidc.middleware import SessionRefresh
+from prometheus_client import REGISTRY
+import brotli
+from contextlib import contextmanager
+import csv
+from datetime import datetime, timedelta, timezone as dt_timezone
+from functools import wraps
+import gzip
 import json
+import logging
+import os
+import re
+import subprocess
+import sys
+from io import BytesIO, StringIO
+import tempfile
+import time
+import traceback
+import zipfile
+from unittest.mock import patch
 
 from users.models import User
-from .auth import GibolinOIDCBackend
-from .models import Reference, Purchase, Category, Region, Appellation, Format, Grape, MenuTemplate
+from .auth import GibolinOIDCBackend, _user_cache_key, get_dev_user
+from . import backup, benchmark, compression, export, importer, lookup_cache, metrics, pos, profiling, slowlog, timing
+from .management.commands import ingest_sales
+from .middleware import CompressionMiddleware, WhiteNoiseMiddleware
+from .versioning import VERSION_CACHE_KEY, get_cellar_version, publish_version
+from .models import (
+    Reference, Purchase, Category, Region, Appellation, Format, Grape, MenuTemplate, PosEvent,
+    Profile, StockMovement, Tombstone,
+)
 from .api import (
-    sqid_encode, sqid_decode, _parse_menu_template,
+    sqids, sqid_encode, sqid_decode, _parse_menu_template,
     _build_wine_data, _build_appellation_list, _build_region_list,
+    _cleanup_orphaned_lookups, _save_reference,
 )
 
 
+# Keep the per-request and slow request logs out of the test output.
+logging.getLogger("cave.requests").setLevel(logging.WARNING)
+logging.getLogger("cave.slow").setLevel(logging.ERROR)
+
+# Cellar sizes a query budget must hold for.
+BUDGET_SIZES = (1, 50)
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RequestQueries:
+    """Record the SQL each request runs, with where in our code it ran from."""
+
+    def __init__(self):
+        self.requests = []
+
+    def __enter__(self):
+        request_started.connect(self.started)
+        self.wrapper = connection.execute_wrapper(self.record)
+        self.wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wrapper.__exit__(*exc_info)
+        request_started.disconnect(self.started)
+
+    def started(self, sender, environ=None, **kwargs):
+        path = (environ or {}).get("PATH_INFO", "?")
+        query = (environ or {}).get("QUERY_STRING")
+        method = (environ or {}).get("REQUEST_METHOD", "?")
+        self.requests.append((f"{method} {path}" + (f"?{query}" if query else ""), []))
+
+    def record(self, execute, sql, params, many, context):
+        if self.requests:
+            stack = [
+                frame for frame in traceback.extract_stack()[:-1]
+                if frame.filename.startswith(PROJECT_DIR)
+            ]
+            self.requests[-1][1].append((sql, stack))
+        return execute(sql, params, many, context)
+
+
+def query_budget(budget, sizes=BUDGET_SIZES):
+    """Run a test against cellars of several sizes; each request it makes
+    must run at most budget queries, whatever the size.
+
+    The test finds the cellar's first reference in self.reference.
+    """
+    def decorate(test):
+        @wraps(test)
+        def wrapper(self):
+            for size in sizes:
+                with self.subTest(references=size):
+                    self.make_cellar(size)
+                    with self.assertRequestQueries(budget):
+                        test(self)
+        return wrapper
+    return decorate
+
+
 class AuthenticatedTestCase(TestCase):
     """Base test class that creates and logs in a test user."""
 
@@ -22,6 +120,35 @@ class AuthenticatedTestCase(TestCase):
         self.client = Client()
         self.client.force_login(self.user)
 
+    def make_cellar(self, size):
+        """Replace the cellar with a generated one of size references."""
+        call_command("generate_cellar", references=size, clear=True, stdout=StringIO())
+        cache.clear()
+        self.reference = Reference.objects.order_by("pk").first()
+        self.sqid = sqid_encode(self.reference.pk)
+
+    @contextmanager
+    def assertRequestQueries(self, budget):
+        """Fail when a request made in the block runs more than budget queries.
+
+        The failure lists the queries of each offending request with the
+        stack of project code that issued them.
+        """
+        with RequestQueries() as recorded:
+            yield recorded
+        over = [(request, queries) for request, queries in recorded.requests if len(queries) > budget]
+        if over:
+            lines = []
+            for request, queries in over:
+                lines.append(f"{request} ran {len(queries)} queries, budget {budget}:")
+                for number, (sql, stack) in enumerate(queries, 1):
+                    lines.append(f"  {number}. {sql}")
+                    lines.extend(
+                        f"       {os.path.relpath(frame.filename, PROJECT_DIR)}:{frame.lineno} in {frame.name}"
+                        for frame in stack[-4:]
+                    )
+            self.fail("\n".join(lines))
+
 
 class ReferenceModelTest(TestCase):
     def test_reference_creation(self):
@@ -139,6 +266,11 @@ class SqidUtilsTest(TestCase):
         decoded_id = sqid_decode(sqid)
         self.assertEqual(original_id, decoded_id)
 
+    def test_sqid_encode_matches_the_full_encoder(self):
+        # 1111 and 1235 have blocked candidates, so they take the slow path.
+        for id in [*range(2000), 4893, 8675, 10**6, 2**40]:
+            self.assertEqual(sqid_encode(id), sqids.encode([id]), id)
+
 
 class ReferenceAPITest(AuthenticatedTestCase):
     def setUp(self):
@@ -388,6 +520,390 @@ class ReferenceAPITest(AuthenticatedTestCase):
         self.assertIn("Red", data)  # From self.category
 
 
+class QuantityAPITest(AuthenticatedTestCase):
+    """Test absolute and relative stock quantity updates."""
+
+    def setUp(self):
+        super().setUp()
+        self.ref = Reference.objects.create(name="Wine", current_quantity=10, notes="Keep")
+        self.sqid = sqid_encode(self.ref.id)
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type="application/json")
+
+    def quantity(self, ref=None):
+        return Reference.objects.get(pk=(ref or self.ref).pk).current_quantity
+
+    def test_set_quantity(self):
+        response = self.client.put(
+            f"/api/ref/{self.sqid}/quantity", json.dumps({"quantity": 4}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json(), {"success": True, "quantity": 4})
+        self.assertEqual(self.quantity(), 4)
+
+    def test_set_quantity_only_writes_quantity(self):
+        Reference.objects.filter(pk=self.ref.pk).update(notes="Changed elsewhere")
+        self.client.put(
+            f"/api/ref/{self.sqid}/quantity", json.dumps({"quantity": 4}),
+            content_type="application/json",
+        )
+        self.assertEqual(Reference.objects.get(pk=self.ref.pk).notes, "Changed elsewhere")
+
+    def test_set_quantity_expected_guard(self):
+        response = self.client.put(
+            f"/api/ref/{self.sqid}/quantity", json.dumps({"quantity": 4, "expected": 9}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["quantity"], 10)
+        self.assertEqual(self.quantity(), 10)
+
+    def test_set_quantity_not_found(self):
+        response = self.client.put(
+            f"/api/ref/{sqid_encode(999999)}/quantity", json.dumps({"quantity": 4}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_adjust(self):
+        response = self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": -3})
+        self.assertEqual(response.json(), {"success": True, "quantity": 7})
+        response = self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": -2})
+        self.assertEqual(response.json()["quantity"], 5)
+        self.assertEqual(self.quantity(), 5)
+
+    def test_adjust_stamps_version(self):
+        version = self.ref.version
+        self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": 1})
+        self.assertGreater(Reference.objects.get(pk=self.ref.pk).version, version)
+
+    def test_adjust_floor_at_zero(self):
+        response = self.post(
+            f"/api/ref/{self.sqid}/quantity/adjust", {"delta": -11, "floor_at_zero": True}
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.quantity(), 10)
+        response = self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": -11})
+        self.assertEqual(response.json()["quantity"], -1)
+
+    def test_adjust_expected_guard(self):
+        response = self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": 1, "expected": 3})
+        self.assertEqual(response.status_code, 409)
+        response = self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": 1, "expected": 10})
+        self.assertEqual(response.json()["quantity"], 11)
+
+    def test_adjust_single_statement(self):
+        # Savepoint, version bump, update, release.
+        with self.assertNumQueries(4):
+            Reference.objects.adjust_quantities([(self.ref.pk, 1, None)])
+
+    def test_bulk_adjust(self):
+        other = Reference.objects.create(name="Other", current_quantity=2)
+        response = self.post("/api/quantities/adjust", {"adjustments": [
+            {"sqid": self.sqid, "delta": -4},
+            {"sqid": sqid_encode(other.id), "delta": 3, "expected": 2},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [r["quantity"] for r in response.json()["results"]], [6, 5]
+        )
+        self.assertEqual((self.quantity(), self.quantity(other)), (6, 5))
+
+    def test_bulk_adjust_atomic_failure(self):
+        other = Reference.objects.create(name="Other", current_quantity=2)
+        response = self.post("/api/quantities/adjust", {
+            "adjustments": [
+                {"sqid": self.sqid, "delta": -4},
+                {"sqid": sqid_encode(other.id), "delta": -3},
+                {"sqid": "nope", "delta": 1},
+            ],
+            "floor_at_zero": True,
+        })
+        self.assertEqual(response.status_code, 409)
+        results = response.json()["results"]
+        self.assertEqual([r["ok"] for r in results], [True, False, False])
+        self.assertEqual(results[1]["quantity"], 2)
+        self.assertEqual(results[2]["error"], "reference not found")
+        self.assertEqual((self.quantity(), self.quantity(other)), (10, 2))
+
+    def test_bulk_adjust_non_atomic(self):
+        other = Reference.objects.create(name="Other", current_quantity=2)
+        response = self.post("/api/quantities/adjust", {
+            "adjustments": [
+                {"sqid": self.sqid, "delta": -4},
+                {"sqid": sqid_encode(other.id), "delta": -3},
+            ],
+            "floor_at_zero": True,
+            "atomic": False,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((self.quantity(), self.quantity(other)), (6, 2))
+
+    def test_bulk_adjust_rejects_duplicates(self):
+        response = self.post("/api/quantities/adjust", {"adjustments": [
+            {"sqid": self.sqid, "delta": 1}, {"sqid": self.sqid, "delta": 1},
+        ]})
+        self.assertEqual(response.status_code, 400)
+
+
+class StockLedgerTest(AuthenticatedTestCase):
+    """Test the stock movement ledger behind current_quantity."""
+
+    def setUp(self):
+        super().setUp()
+        self.ref = Reference.objects.create(name="Wine", current_quantity=10)
+        self.sqid = sqid_encode(self.ref.id)
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type="application/json")
+
+    def movements(self, ref=None):
+        return list(
+            StockMovement.objects.filter(reference=ref or self.ref)
+            .order_by("id").values_list("delta", "reason")
+        )
+
+    def assertLedgerMatches(self, ref=None):
+        ref = Reference.objects.get(pk=(ref or self.ref).pk)
+        total = ref.movements.aggregate(total=Sum("delta"))["total"] or 0
+        self.assertEqual(total, ref.current_quantity)
+
+    def test_new_reference_opens_ledger(self):
+        self.assertEqual(self.movements(), [(10, "initial")])
+        empty = Reference.objects.create(name="Empty")
+        self.assertEqual(self.movements(empty), [])
+
+    def test_created_reference_records_user(self):
+        sqid = self.post("/api/ref", {"name": "Opened", "current_quantity": 4}).json()["sqid"]
+        movement = StockMovement.objects.get(reference_id=sqid_decode(sqid))
+        self.assertEqual((movement.delta, movement.reason, movement.user), (4, "initial", self.user))
+
+    def test_adjust_records_reason_and_user(self):
+        self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": -2, "reason": "sale"})
+        self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": 0})
+        movement = StockMovement.objects.filter(reference=self.ref).first()
+        self.assertEqual((movement.delta, movement.reason), (-2, "sale"))
+        self.assertEqual(movement.user, self.user)
+        self.assertEqual(len(self.movements()), 2)
+        self.assertLedgerMatches()
+
+    def test_rejected_adjustment_records_nothing(self):
+        self.post(f"/api/ref/{self.sqid}/quantity/adjust", {"delta": -20, "floor_at_zero": True})
+        self.assertEqual(self.movements(), [(10, "initial")])
+
+    def test_set_quantity_records_correction(self):
+        self.client.put(
+            f"/api/ref/{self.sqid}/quantity", json.dumps({"quantity": 7}),
+            content_type="application/json",
+        )
+        self.assertEqual(self.movements(), [(10, "initial"), (-3, "correction")])
+        self.assertLedgerMatches()
+
+    def test_reference_update_records_correction(self):
+        Reference.objects.adjust_quantities([(self.ref.pk, -4, None)], reason="sale")
+        response = self.client.put(
+            f"/api/ref/{self.sqid}",
+            json.dumps({"name": "Wine", "current_quantity": 5}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["current_quantity"], 5)
+        self.assertEqual(
+            self.movements(), [(10, "initial"), (-4, "sale"), (-1, "correction")]
+        )
+        self.assertLedgerMatches()
+
+    def test_reference_update_does_not_write_stale_quantity(self):
+        stale = Reference.objects.get(pk=self.ref.pk)
+        Reference.objects.adjust_quantities([(self.ref.pk, -4, None)])
+        _save_reference(stale, {"name": "Renamed"}, {})
+        self.assertEqual(Reference.objects.get(pk=self.ref.pk).current_quantity, 6)
+        self.assertLedgerMatches()
+
+    def test_batch_records_movements(self):
+        self.post("/api/batch", {"operations": [
+            {"op": "adjust_quantity", "sqid": self.sqid, "data": {"delta": -1, "reason": "breakage"}},
+            {"op": "set_quantity", "sqid": self.sqid, "data": {"quantity": 12}},
+        ]})
+        self.assertEqual(
+            self.movements(), [(10, "initial"), (-1, "breakage"), (3, "correction")]
+        )
+
+    def test_history_pagination(self):
+        for delta in (1, 2, 3):
+            Reference.objects.adjust_quantities([(self.ref.pk, delta, None)])
+        page = self.client.get(f"/api/ref/{self.sqid}/movements?limit=2").json()
+        self.assertEqual([m["delta"] for m in page["items"]], [3, 2])
+        page = self.client.get(
+            f"/api/ref/{self.sqid}/movements?limit=2&before={page['next']}"
+        ).json()
+        self.assertEqual([m["delta"] for m in page["items"]], [1, 10])
+        self.assertIsNone(page["next"])
+
+    def test_history_period_and_reason(self):
+        StockMovement.objects.filter(reference=self.ref).update(
+            created_at=datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        )
+        Reference.objects.adjust_quantities([(self.ref.pk, -2, None)], reason="sale")
+        data = self.client.get("/api/movements?since=2025-01-01T00:00:00Z").json()
+        self.assertEqual([m["delta"] for m in data["items"]], [-2])
+        data = self.client.get("/api/movements?reason=initial").json()
+        self.assertEqual([m["sqid"] for m in data["items"]], [self.sqid])
+
+    def test_summary(self):
+        Reference.objects.adjust_quantities([(self.ref.pk, -2, None)], reason="sale")
+        Reference.objects.adjust_quantities([(self.ref.pk, -3, None)], reason="sale")
+        data = self.client.get("/api/movements/summary").json()
+        self.assertIn({"sqid": self.sqid, "reason": "sale", "delta": -5}, data)
+
+    def test_history_query_uses_index(self):
+        queryset = StockMovement.objects.filter(reference=self.ref).order_by("-created_at", "-id")
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        self.assertIn("cave_movement_ref_history", queryset[:10].explain())
+
+
+class PosIngestTest(AuthenticatedTestCase):
+    """Test point-of-sale event ingestion."""
+
+    def setUp(self):
+        super().setUp()
+        self.a = Reference.objects.create(name="A", current_quantity=20)
+        self.b = Reference.objects.create(name="B", current_quantity=20)
+
+    def events(self, *events):
+        return [json.dumps(event) + "\n" for event in events]
+
+    def quantities(self):
+        return [Reference.objects.get(pk=ref.pk).current_quantity for ref in (self.a, self.b)]
+
+    def test_coalesces_per_reference(self):
+        stats = pos.ingest(self.events(
+            {"event_id": "1", "sqid": sqid_encode(self.a.id)},
+            {"event_id": "2", "sqid": sqid_encode(self.a.id), "quantity": 2},
+            {"event_id": "3", "sqid": sqid_encode(self.b.id), "quantity": 3},
+            {"event_id": "4", "sqid": sqid_encode(self.b.id), "quantity": -1},
+        ))
+        self.assertEqual((stats["applied"], stats["movements"]), (4, 2))
+        self.assertEqual(self.quantities(), [17, 18])
+        sales = StockMovement.objects.filter(reason="sale").order_by("reference_id")
+        self.assertEqual([m.delta for m in sales], [-3, -2])
+
+    def test_deduplicates_within_and_across_batches(self):
+        sqid = sqid_encode(self.a.id)
+        first = self.events(*({"event_id": str(i), "sqid": sqid} for i in range(5)))
+        stats = pos.ingest(first + first[:2], batch_size=3)
+        self.assertEqual((stats["applied"], stats["duplicates"]), (5, 2))
+        stats = pos.ingest(first)
+        self.assertEqual((stats["applied"], stats["duplicates"]), (0, 5))
+        self.assertEqual(self.quantities()[0], 15)
+        self.assertEqual(PosEvent.objects.count(), 5)
+
+    def test_rejects_invalid_events(self):
+        stats = pos.ingest(self.events(
+            {"event_id": "1", "sqid": sqid_encode(999999)},
+            {"sqid": sqid_encode(self.a.id)},
+            {"event_id": "3", "sqid": sqid_encode(self.a.id), "quantity": 0},
+            {"event_id": "4", "sqid": sqid_encode(self.a.id)},
+        ) + ["not json\n"])
+        self.assertEqual((stats["applied"], stats["rejected"]), (1, 4))
+        self.assertEqual(
+            [e["line"] for e in stats["errors"]], [2, 3, 5, 1]
+        )
+        # Rejected ids are not recorded, so a corrected event can be resent.
+        self.assertFalse(PosEvent.objects.filter(event_id="1").exists())
+
+    def test_rejects_non_integral_quantities(self):
+        sqid = sqid_encode(self.a.id)
+        stats = pos.ingest(self.events(*(
+            {"event_id": str(i), "sqid": sqid, "quantity": quantity}
+            for i, quantity in enumerate([1.5, True, "2.5", "two", [1], 2.0, "3"])
+        )))
+        self.assertEqual((stats["applied"], stats["rejected"]), (2, 5))
+        self.assertEqual({e["error"] for e in stats["errors"]}, {"invalid quantity"})
+        self.assertEqual(self.quantities()[0], 15)
+
+    def test_csv(self):
+        lines = [
+            "event_id,sqid,quantity\n",
+            f"1,{sqid_encode(self.a.id)},2\n",
+            f"2,{sqid_encode(self.b.id)},\n",
+        ]
+        stats = pos.ingest(lines, "csv")
+        self.assertEqual(stats["applied"], 2)
+        self.assertEqual(self.quantities(), [18, 19])
+
+    def test_endpoint(self):
+        body = "".join(self.events(
+            {"event_id": "1", "sqid": sqid_encode(self.a.id)},
+            {"event_id": "2", "sqid": sqid_encode(self.a.id)},
+        ))
+        response = self.client.post("/api/pos/sales", body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["applied"], 2)
+        movement = StockMovement.objects.get(reason="sale")
+        self.assertEqual((movement.delta, movement.user), (-2, self.user))
+
+        body = f"event_id,sqid\n3,{sqid_encode(self.b.id)}\n"
+        response = self.client.post("/api/pos/sales", body, content_type="text/csv")
+        self.assertEqual(response.json()["applied"], 1)
+        self.assertEqual(self.quantities(), [18, 19])
+
+    def test_old_event_ids_are_pruned(self):
+        PosEvent.objects.create(event_id="old", received_at=timezone.now() - timedelta(days=91))
+        PosEvent.objects.create(event_id="recent", received_at=timezone.now() - timedelta(days=89))
+        pos.ingest(self.events({"event_id": "1", "sqid": sqid_encode(self.a.id)}))
+        self.assertEqual(
+            set(PosEvent.objects.values_list("event_id", flat=True)), {"recent", "1"}
+        )
+
+    def test_follow_reads_a_late_csv_header(self):
+        sqid = sqid_encode(self.a.id)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sales.csv")
+            open(path, "w").close()
+            errors = StringIO()
+            command = ingest_sales.Command(stdout=StringIO(), stderr=errors)
+            chunks = [
+                "event_id,sqid,quantity\n1,%s,1\n" % sqid,
+                "2,%s,1\n3,,1\n" % sqid,
+                "4,%s,1\n" % sqid,
+            ]
+
+            def append(seconds):
+                if not chunks:
+                    raise KeyboardInterrupt
+                with open(path, "a") as f:
+                    f.write(chunks.pop(0))
+
+            with open(path, newline="") as source, patch.object(ingest_sales.time, "sleep", append):
+                command.follow(source, "csv", {"batch_size": 100, "interval": 0})
+        self.assertEqual(self.quantities()[0], 17)
+        self.assertIn("line 4: invalid sqid", errors.getvalue())
+
+    def test_endpoint_requires_authentication(self):
+        self.client.logout()
+        response = self.client.post("/api/pos/sales", "", content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 401)
+
+    def test_simulator_and_command(self):
+        unique = 0
+        with tempfile.TemporaryDirectory() as tmp:
+            for seed, name in enumerate(("sales.ndjson", "sales.csv")):
+                path = os.path.join(tmp, name)
+                out = StringIO()
+                call_command("pos_simulator", path, events=200, seed=seed, duplicates=0.1, stdout=out)
+                unique += int(re.search(r"\((\d+) unique\)", out.getvalue())[1])
+                out = StringIO()
+                call_command("ingest_sales", path, stdout=out)
+                self.assertIn("200 received", out.getvalue())
+                call_command("ingest_sales", path, stdout=out)
+                self.assertIn("0 applied", out.getvalue())
+        sold = -sum(StockMovement.objects.filter(reason="sale").values_list("delta", flat=True))
+        self.assertEqual(sum(self.quantities()), 40 - sold)
+        self.assertEqual(PosEvent.objects.count(), unique)
+
+
 class PurchaseAPITest(AuthenticatedTestCase):
     def setUp(self):
         super().setUp()
@@ -1315,6 +1831,1052 @@ class CSRFProtectionTest(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+class ConditionalGetTest(AuthenticatedTestCase):
+    """Test ETag handling driven by the cellar version."""
+
+    def test_read_endpoints_send_validators(self):
+        ref = Reference.objects.create(name="Wine")
+        for url in [
+            "/api/refs", f"/api/ref/{sqid_encode(ref.id)}", "/api/categories",
+            "/api/regions", "/api/appellations", "/api/formats", "/api/grapes",
+            "/api/locations", "/api/menu/template",
+        ]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertTrue(response.has_header("ETag"), url)
+            self.assertFalse(response.has_header("Last-Modified"), url)
+            self.assertIn("no-cache", response["Cache-Control"], url)
+
+    def test_matching_etag_returns_304_without_running_query(self):
+        Category.objects.create(name="Red")
+        etag = self.client.get("/api/categories")["ETag"]
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/categories", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_write_changes_etag(self):
+        etag = self.client.get("/api/categories")["ETag"]
+        self.client.post(
+            "/api/categories",
+            json.dumps({"name": "Red"}),
+            content_type="application/json",
+        )
+        response = self.client.get("/api/categories", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), ["Red"])
+
+    def test_queryset_update_changes_etag(self):
+        Category.objects.create(name="Red")
+        etag = self.client.get("/api/categories")["ETag"]
+        self.client.put(
+            "/api/categories/color",
+            json.dumps({"name": "Red", "color": "#ff0000"}),
+            content_type="application/json",
+        )
+        response = self.client.get("/api/categories", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since_is_ignored(self):
+        # Whole seconds cannot tell two writes in the same second apart.
+        self.client.get("/api/grapes")
+        Grape.objects.create(name="Gamay")
+        response = self.client.get("/api/grapes", HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), ["Gamay"])
+
+    def test_unauthenticated_gets_401_not_304(self):
+        etag = self.client.get("/api/categories")["ETag"]
+        response = Client().get("/api/categories", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 401)
+
+    def test_menu_export_reflects_changes(self):
+        ref = Reference.objects.create(name="First Wine")
+        self.assertIn("First Wine", self.client.get("/api/export/html").content.decode())
+        ref.name = "Renamed Wine"
+        ref.save()
+        self.assertIn("Renamed Wine", self.client.get("/api/export/html").content.decode())
+
+    def test_version_published_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name="Red")
+        self.assertEqual(cache.get(VERSION_CACHE_KEY), get_cellar_version())
+
+    def test_published_version_never_moves_back(self):
+        with self.captureOnCommitCallbacks() as earlier:
+            Category.objects.create(name="Red")
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name="White")
+        latest = cache.get(VERSION_CACHE_KEY)
+        # The earlier commit's callbacks run last, as in another worker.
+        for callback in earlier:
+            callback()
+        self.assertEqual(cache.get(VERSION_CACHE_KEY), latest)
+
+    def test_stale_cache_is_replaced_by_the_committed_version(self):
+        Category.objects.create(name="Red")
+        cache.set(VERSION_CACHE_KEY, 1, None)
+        publish_version(2)
+        self.assertEqual(cache.get(VERSION_CACHE_KEY), get_cellar_version())
+
+
+class BootstrapAPITest(AuthenticatedTestCase):
+    """Test /api/bootstrap, which replaces the UI's startup requests."""
+
+    def test_returns_everything_in_one_query(self):
+        Category.objects.create(name="White")
+        Category.objects.create(name="Red")
+        Region.objects.create(name="Loire")
+        Appellation.objects.create(name="Chinon")
+        Format.objects.create(name="Magnum")
+        Grape.objects.create(name="Gamay")
+        Reference.objects.create(name="A", location="Cave")
+        Reference.objects.create(name="B", location="Cave")
+        Reference.objects.create(name="C", location="")
+        self.client.get("/api/me")
+        # One query for the cellar version, one UNION for the data.
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/bootstrap")
+        data = response.json()
+        self.assertEqual(data["me"], {"email": "test@example.com"})
+        self.assertFalse(data["config"]["oidc_enabled"])
+        self.assertEqual(data["categories"], ["Red", "White"])
+        self.assertEqual(data["regions"], ["Loire"])
+        self.assertEqual(data["appellations"], ["Chinon"])
+        self.assertEqual(data["formats"], ["Magnum"])
+        self.assertEqual(data["grapes"], ["Gamay"])
+        self.assertEqual(data["locations"], ["Cave"])
+
+    def test_matches_individual_endpoints(self):
+        Category.objects.create(name="Rosé")
+        Reference.objects.create(name="A", location="Bar")
+        data = self.client.get("/api/bootstrap").json()
+        for key in ["categories", "regions", "appellations", "formats", "grapes", "locations"]:
+            self.assertEqual(data[key], self.client.get(f"/api/{key}").json(), key)
+
+    def test_unauthenticated_returns_config_only(self):
+        response = Client().get("/api/bootstrap")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"config": {"oidc_enabled": False}, "me": None})
+
+    def test_warm_reload_is_a_304(self):
+        etag = self.client.get("/api/bootstrap")["ETag"]
+        response = self.client.get("/api/bootstrap", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_is_per_user(self):
+        etag = self.client.get("/api/bootstrap")["ETag"]
+        other = User.objects.create_user(email="other@example.com", password="x")
+        client = Client()
+        client.force_login(other)
+        response = client.get("/api/bootstrap", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["me"]["email"], "other@example.com")
+
+    def test_user_change_changes_etag(self):
+        etag = self.client.get("/api/bootstrap")["ETag"]
+        self.user.email = "renamed@example.com"
+        self.user.save()
+        response = self.client.get("/api/bootstrap", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["me"]["email"], "renamed@example.com")
+
+
+class SyncAPITest(AuthenticatedTestCase):
+    """Test /api/sync delta synchronisation."""
+
+    def sync(self, since=None):
+        url = "/api/sync" if since is None else f"/api/sync?since={since}"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_full_sync(self):
+        Reference.objects.create(name="Wine", category=Category.objects.create(name="Red"))
+        data = self.sync()
+        self.assertTrue(data["full"])
+        self.assertEqual([r["name"] for r in data["references"]], ["Wine"])
+        self.assertEqual([c["name"] for c in data["categories"]], ["Red"])
+
+    def test_delta_returns_only_changed_rows(self):
+        ref_a = Reference.objects.create(name="Wine A")
+        Reference.objects.create(name="Wine B")
+        token = self.sync()["token"]
+        ref_a.name = "Wine A2"
+        ref_a.save()
+        Grape.objects.create(name="Syrah")
+        data = self.sync(token)
+        self.assertFalse(data["full"])
+        self.assertEqual([r["name"] for r in data["references"]], ["Wine A2"])
+        self.assertEqual([g["name"] for g in data["grapes"]], ["Syrah"])
+        self.assertEqual(data["categories"], [])
+
+    def test_no_changes_returns_same_token(self):
+        Reference.objects.create(name="Wine")
+        token = self.sync()["token"]
+        data = self.sync(token)
+        self.assertEqual(data["token"], token)
+        self.assertEqual(data["references"], [])
+
+    def test_deletions_produce_tombstones(self):
+        cat = Category.objects.create(name="Red")
+        ref = Reference.objects.create(name="Wine", category=cat)
+        token = self.sync()["token"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/ref/{sqid_encode(ref.id)}")
+        data = self.sync(token)
+        self.assertEqual(data["deleted"]["reference"], [sqid_encode(ref.id)])
+        self.assertEqual(data["deleted"]["category"], [cat.id])
+
+    def test_purchase_change_resyncs_reference(self):
+        ref = Reference.objects.create(name="Wine")
+        token = self.sync()["token"]
+        Purchase.objects.create(reference=ref, date="2024-01-01", quantity=6, price=10)
+        data = self.sync(token)
+        self.assertEqual(len(data["references"]), 1)
+        self.assertEqual(len(data["references"][0]["purchases"]), 1)
+
+    def test_grape_change_resyncs_reference(self):
+        ref = Reference.objects.create(name="Wine")
+        grape = Grape.objects.create(name="Merlot")
+        token = self.sync()["token"]
+        ref.grapes.add(grape)
+        data = self.sync(token)
+        self.assertEqual(data["references"][0]["grapes"], ["Merlot"])
+
+    def test_unknown_token_forces_full_sync(self):
+        Reference.objects.create(name="Wine")
+        token = int(self.sync()["token"])
+        data = self.sync(token + 10**12)
+        self.assertTrue(data["full"])
+        self.assertEqual(len(data["references"]), 1)
+
+
+class ImportTest(AuthenticatedTestCase):
+    """Test the bulk spreadsheet import."""
+
+    CSV = (
+        "ref,name,category,grapes,vintage,current_quantity,purchase_date,purchase_quantity,purchase_price\n"
+        "1,Chablis,White,Chardonnay,2020,6,2023-01-10,6,18.50\n"
+        "1,,,,,,2024-02-01,12,19\n"
+        ",Morgon,Red,\"Gamay, Pinot Noir\",2019,0,,,\n"
+        ",Sancerre,White,,,3,,,\n"
+    )
+
+    def run_import(self, content, **kwargs):
+        return importer.import_references(BytesIO(content.encode()), **kwargs)
+
+    def test_csv(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            report = self.run_import(self.CSV, user=self.user, chunk_size=2)
+        self.assertEqual(
+            {k: report[k] for k in ("rows", "references", "purchases", "invalid", "committed")},
+            {"rows": 4, "references": 3, "purchases": 2, "invalid": 0, "committed": True},
+        )
+        chablis = Reference.objects.get(name="Chablis")
+        self.assertEqual((chablis.category.name, chablis.vintage, chablis.current_quantity), ("White", 2020, 6))
+        self.assertEqual(sorted(p.quantity for p in chablis.purchases.all()), [6, 12])
+        morgon = Reference.objects.get(name="Morgon")
+        self.assertEqual(sorted(g.name for g in morgon.grapes.all()), ["Gamay", "Pinot Noir"])
+        self.assertEqual(Category.objects.get(name="White").reference_count, 2)
+        self.assertEqual(Grape.objects.get(name="Gamay").reference_count, 1)
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(reason="initial").values_list("delta", flat=True)), [3, 6]
+        )
+        # Imported rows are visible to delta sync.
+        synced = self.client.get("/api/sync", {"since": 0}).json()
+        self.assertEqual(len(synced["references"]), 3)
+
+    def test_dry_run(self):
+        report = self.run_import(self.CSV, dry_run=True)
+        self.assertEqual((report["references"], report["purchases"]), (3, 2))
+        self.assertFalse(report["committed"])
+        self.assertFalse(Reference.objects.exists())
+        self.assertFalse(Category.objects.exists())
+
+    def test_invalid_rows_import_nothing(self):
+        content = (
+            "name,vintage,purchase_date,purchase_quantity,purchase_price\n"
+            "Chablis,2020,,,\n"
+            ",2020,,,\n"
+            "Morgon,old,,,\n"
+            "Sancerre,,2023-13-01,1,10\n"
+        )
+        report = self.run_import(content)
+        self.assertEqual(report["invalid"], 3)
+        self.assertFalse(report["committed"])
+        self.assertEqual([e["row"] for e in report["errors"]], [3, 4, 5])
+        self.assertEqual(report["errors"][1]["detail"][0]["loc"], ("vintage",))
+        self.assertFalse(Reference.objects.exists())
+
+    def test_unknown_column(self):
+        with self.assertRaisesMessage(ValueError, "Unknown columns: colour"):
+            self.run_import("name,colour\nChablis,yellow\n")
+
+    def test_duplicate_key_without_purchase(self):
+        report = self.run_import("ref,name\na,Chablis\na,Chablis\n")
+        self.assertEqual(report["errors"][0]["row"], 3)
+
+    def test_xlsx(self):
+        import openpyxl
+
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(["name", "vintage", "hidden_from_menu", "purchase_date", "purchase_quantity", "purchase_price"])
+        sheet.append(["Chablis", 2020, True, datetime(2023, 1, 10), 6, 18.5])
+        sheet.append([None] * 6)
+        sheet.append(["Morgon", 2019.0, None, None, None, None])
+        buffer = BytesIO()
+        workbook.save(buffer)
+        buffer.seek(0)
+
+        report = importer.import_references(buffer, "xlsx")
+        self.assertTrue(report["committed"], report)
+        chablis = Reference.objects.get(name="Chablis")
+        self.assertTrue(chablis.hidden_from_menu)
+        self.assertEqual(str(chablis.purchases.get().date), "2023-01-10")
+        self.assertEqual(Reference.objects.get(name="Morgon").vintage, 2019)
+
+    def test_endpoint(self):
+        upload = SimpleUploadedFile("cellar.csv", self.CSV.encode(), content_type="text/csv")
+        response = self.client.post("/api/import?dry_run=true", {"file": upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Reference.objects.exists())
+
+        upload = SimpleUploadedFile("cellar.csv", self.CSV.encode(), content_type="text/csv")
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/import", {"file": upload})
+        self.assertEqual(response.json()["references"], 3)
+        self.assertEqual(StockMovement.objects.filter(user=self.user).count(), 2)
+
+        upload = SimpleUploadedFile("cellar.csv", b"name,vintage\nX,old\n", content_type="text/csv")
+        response = self.client.post("/api/import", {"file": upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["invalid"], 1)
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write(self.CSV)
+        try:
+            out = StringIO()
+            call_command("import_references", f.name, "--dry-run", stdout=out)
+            self.assertIn("dry run", out.getvalue())
+            self.assertFalse(Reference.objects.exists())
+            call_command("import_references", f.name, stdout=out)
+            self.assertEqual(Reference.objects.count(), 3)
+        finally:
+            os.unlink(f.name)
+
+
+class ExportTest(AuthenticatedTestCase):
+    """Test the streaming cellar export."""
+
+    def setUp(self):
+        super().setUp()
+        self.chablis = Reference.objects.create(
+            name="Chablis",
+            category=Category.objects.create(name="White"),
+            format=Format.objects.create(name="75cl"),
+            vintage=2020,
+            current_quantity=6,
+            price_multiplier=2,
+        )
+        self.chablis.grapes.set([Grape.objects.create(name="Chardonnay"), Grape.objects.create(name="Aligoté")])
+        Purchase.objects.create(reference=self.chablis, date="2023-01-10", quantity=6, price=10)
+        Purchase.objects.create(reference=self.chablis, date="2024-02-01", quantity=4, price=15)
+        self.morgon = Reference.objects.create(name="Morgon", retail_price_override=30)
+
+    def download(self, fmt, **headers):
+        response = self.client.get(f"/api/export/{fmt}", **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b"".join(response.streaming_content)
+
+    def test_ndjson(self):
+        response, body = self.download("ndjson")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertIn("attachment", response["Content-Disposition"])
+        chablis, morgon = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(chablis["sqid"], sqid_encode(self.chablis.id))
+        self.assertEqual(
+            {k: chablis[k] for k in ("category", "region", "format", "grapes", "vintage")},
+            {"category": "White", "region": None, "format": "75cl",
+             "grapes": ["Aligoté", "Chardonnay"], "vintage": 2020},
+        )
+        self.assertEqual(
+            {k: chablis[k] for k in (
+                "purchase_count", "purchased_quantity", "average_purchase_price",
+                "first_purchase", "last_purchase",
+            )},
+            {"purchase_count": 2, "purchased_quantity": 10, "average_purchase_price": 12.0,
+             "first_purchase": "2023-01-10", "last_purchase": "2024-02-01"},
+        )
+        # Same price as the reference endpoints.
+        detail = self.client.get(f"/api/ref/{chablis['sqid']}").json()
+        self.assertEqual(chablis["retail_price"], detail["retail_price"])
+        self.assertEqual(chablis["retail_price"], 24)
+        self.assertEqual(
+            (morgon["retail_price"], morgon["grapes"], morgon["purchase_count"]), (30.0, [], 0)
+        )
+
+    def test_csv(self):
+        _, body = self.download("csv")
+        rows = list(csv.DictReader(StringIO(body.decode())))
+        self.assertEqual(list(rows[0]), export.COLUMNS)
+        self.assertEqual([row["name"] for row in rows], ["Chablis", "Morgon"])
+        self.assertEqual(rows[0]["grapes"], "Aligoté, Chardonnay")
+
+    def test_parquet(self):
+        import pyarrow.parquet
+
+        _, body = self.download("parquet")
+        table = pyarrow.parquet.read_table(BytesIO(body))
+        self.assertEqual(table.column_names, export.COLUMNS)
+        self.assertEqual(table.column("name").to_pylist(), ["Chablis", "Morgon"])
+        self.assertEqual(table.column("grapes").to_pylist()[0], ["Aligoté", "Chardonnay"])
+
+    def test_streams_in_chunks(self):
+        import pyarrow.parquet
+
+        Reference.objects.bulk_create(Reference(name=f"Wine {i}") for i in range(25))
+        with patch.object(export, "CHUNK_SIZE", 10):
+            chunks = list(export.write_ndjson(export.rows()))
+            self.assertEqual(len(chunks), 3)
+            with patch.object(export, "ROW_GROUP_SIZE", 10):
+                parts = list(export.write_parquet(export.rows()))
+        self.assertGreater(len(parts), 3)
+        table = pyarrow.parquet.read_table(BytesIO(b"".join(parts)))
+        self.assertEqual(table.num_rows, 27)
+
+    def test_compressed(self):
+        response, body = self.download("csv", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn(b"Chablis", gzip.decompress(body))
+
+    def test_conditional(self):
+        response, _ = self.download("csv")
+        response = self.client.get("/api/export/csv", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_parquet_needs_pyarrow(self):
+        with patch.object(export, "pyarrow", None):
+            response = self.client.get("/api/export/parquet")
+        self.assertEqual(response.status_code, 501)
+
+
+class BackupTest(AuthenticatedTestCase):
+    """Test gibolin_dump / gibolin_restore."""
+
+    def setUp(self):
+        super().setUp()
+        self.chablis = Reference.objects.create(
+            name="Chablis",
+            category=Category.objects.create(name="White", color="#ffee00"),
+            vintage=2020,
+            current_quantity=6,
+            price_multiplier="2.50",
+            notes="Été\nfrais",
+            user=self.user,
+        )
+        self.chablis.grapes.set([Grape.objects.create(name="Chardonnay")])
+        Purchase.objects.create(reference=self.chablis, date="2023-01-10", quantity=6, price="18.90")
+        Reference.objects.adjust_quantities([(self.chablis.pk, -2, None)], reason="sale", user=self.user)
+        self.morgon = Reference.objects.create(name="Morgon", category=Category.objects.get(name="White"))
+        MenuTemplate.set_template("# Menu")
+        PosEvent.record(["till-1"])
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "cellar.zip")
+
+    def snapshot(self):
+        return {
+            "references": list(Reference.objects.order_by("pk").values(
+                "pk", "name", "category__name", "vintage", "current_quantity", "price_multiplier",
+                "notes", "user", "created_at",
+            )),
+            "grapes": list(Reference.grapes.through.objects.values_list("reference_id", "grape__name")),
+            "purchases": list(Purchase.objects.values_list("reference_id", "date", "quantity", "price")),
+            "movements": list(StockMovement.objects.values_list("reference_id", "delta", "reason", "user")),
+            "counts": dict(Category.objects.values_list("name", "reference_count")),
+            "menu": MenuTemplate.get_template(),
+            "pos": list(PosEvent.objects.values_list("event_id", flat=True)),
+        }
+
+    def test_round_trip(self):
+        before = self.snapshot()
+        out = StringIO()
+        call_command("gibolin_dump", self.path, chunk_size=1, stdout=out)
+        self.assertIn("cave.reference: 2 rows", out.getvalue())
+        with zipfile.ZipFile(self.path) as archive:
+            manifest = json.loads(archive.read("manifest.json"))
+        self.assertEqual(manifest["version"], backup.FORMAT_VERSION)
+        self.assertEqual(len(manifest["tables"]["cave.reference"]["chunks"]), 2)
+        self.assertEqual(manifest["tables"]["cave.reference"]["columns"][-1], "user")
+
+        # Change the cellar, then bring it back.
+        Reference.objects.create(name="Sancerre", category=Category.objects.create(name="Red"))
+        morgon_id = self.morgon.pk
+        self.morgon.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("gibolin_restore", self.path, replace=True, stdout=StringIO())
+
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(
+            self.client.get(f"/api/ref/{sqid_encode(morgon_id)}").json()["name"], "Morgon"
+        )
+        # Sequences continue after the restored ids.
+        self.assertGreater(Reference.objects.create(name="New").pk, morgon_id)
+
+    def test_restore_is_a_sync_change(self):
+        call_command("gibolin_dump", self.path, stdout=StringIO())
+        sancerre = Reference.objects.create(name="Sancerre")
+        token = self.client.get("/api/sync").json()["token"]
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("gibolin_restore", self.path, replace=True, stdout=StringIO())
+
+        synced = self.client.get("/api/sync", {"since": token}).json()
+        self.assertFalse(synced["full"])
+        self.assertEqual({r["name"] for r in synced["references"]}, {"Chablis", "Morgon"})
+        self.assertEqual(synced["deleted"], {"reference": [sqid_encode(sancerre.pk)]})
+
+    def test_restore_requires_replace_when_not_empty(self):
+        call_command("gibolin_dump", self.path, stdout=StringIO())
+        with self.assertRaisesMessage(CommandError, "not empty"):
+            call_command("gibolin_restore", self.path, stdout=StringIO())
+
+    def test_restore_into_empty_cellar(self):
+        call_command("gibolin_dump", self.path, stdout=StringIO())
+        before = self.snapshot()
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            cursor.execute("TRUNCATE {}".format(", ".join(m._meta.db_table for m in backup.MODELS)))
+        call_command("gibolin_restore", self.path, stdout=StringIO())
+        self.assertEqual(self.snapshot(), before)
+
+    def test_unknown_user_is_dropped(self):
+        call_command("gibolin_dump", self.path, stdout=StringIO())
+        self.user.email = "someone@else.example"
+        self.user.save()
+        call_command("gibolin_restore", self.path, replace=True, stdout=StringIO())
+        self.assertIsNone(Reference.objects.get(pk=self.chablis.pk).user)
+
+    def test_rejects_other_archives(self):
+        with zipfile.ZipFile(self.path, "w") as archive:
+            archive.writestr("manifest.json", json.dumps({"format": backup.FORMAT, "version": 99}))
+        with self.assertRaisesMessage(CommandError, "Unsupported archive version 99"):
+            call_command("gibolin_restore", self.path, stdout=StringIO())
+        with open(self.path, "w") as f:
+            f.write("not a zip")
+        with self.assertRaisesMessage(CommandError, "not a zip archive"):
+            call_command("gibolin_restore", self.path, stdout=StringIO())
+
+
+class GenerateCellarTest(TestCase):
+    def generate(self, **options):
+        call_command("generate_cellar", stdout=StringIO(), **{"references": 200, "seed": 7, **options})
+
+    def content(self):
+        return list(
+            Reference.objects.order_by("pk").values_list(
+                "name", "category__name", "region__name", "appellation__name", "format__name",
+                "vintage", "current_quantity", "hidden_from_menu",
+            )
+        )
+
+    def test_generates_consistent_cellar(self):
+        self.generate(purchases_per_ref=2, chunk_size=64)
+        self.assertEqual(Reference.objects.count(), 200)
+        self.assertEqual(Purchase.objects.count(), 400)
+        self.assertTrue(Reference.objects.filter(current_quantity=0).exists())
+        ledger = dict(
+            StockMovement.objects.values("reference").annotate(total=Sum("delta"))
+            .values_list("reference", "total")
+        )
+        for pk, quantity in Reference.objects.values_list("pk", "current_quantity"):
+            self.assertEqual(ledger.get(pk, 0), quantity)
+        for model, field in [(Region, "region"), (Format, "format"), (Grape, "grapes")]:
+            for lookup in model.objects.all():
+                self.assertEqual(
+                    lookup.reference_count, Reference.objects.filter(**{field: lookup}).count()
+                )
+
+    def test_same_seed_same_cellar(self):
+        self.generate()
+        first = self.content()
+        self.generate(clear=True)
+        self.assertEqual(self.content(), first)
+        self.generate(clear=True, seed=8)
+        self.assertNotEqual(self.content(), first)
+
+
+class BenchmarkTest(TestCase):
+    def test_every_scenario_runs(self):
+        user = User.objects.create_user(email="bench@example.com", password="x")
+        results = benchmark.run(user, sizes=[30], iterations=2, warmup=1)
+        measured = results["sizes"]["30"]
+        self.assertEqual(list(measured), [scenario.name for scenario in benchmark.SCENARIOS])
+        for stats in measured.values():
+            self.assertLessEqual(stats["p50_ms"], stats["p95_ms"])
+            self.assertGreater(stats["rps"], 0)
+        self.assertGreater(measured["refs"]["queries"], 0)
+        self.assertGreater(measured["menu_html_uncached"]["queries"], measured["menu_html"]["queries"])
+
+    def test_compare(self):
+        baseline = {"sizes": {"100": {"refs": {"queries": 5, "p95_ms": 10.0}}}}
+
+        def results(queries, p95):
+            return {"sizes": {"100": {"refs": {"queries": queries, "p95_ms": p95}, "new": {}}}}
+
+        self.assertEqual(benchmark.compare(baseline, results(5, 14.0)), [])
+        self.assertEqual(benchmark.compare(baseline, results(4, 9.0)), [])
+        self.assertEqual(
+            benchmark.compare(baseline, results(6, 16.0)),
+            ["100/refs: 6 queries (baseline 5)", "100/refs: p95 16.0ms (baseline 10.0ms)"],
+        )
+        self.assertEqual(benchmark.compare(baseline, results(5, 16.0), tolerance=1.1), [
+            "100/refs: p95 16.0ms (baseline 10.0ms)"
+        ])
+        # Jitter of a few milliseconds on fast requests is not a regression.
+        self.assertEqual(benchmark.compare(baseline, results(5, 14.5), tolerance=1.1), [])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 0.5), 50)
+        self.assertEqual(benchmark.percentile(values, 0.95), 95)
+        self.assertEqual(benchmark.percentile([3.0], 0.99), 3.0)
+
+
+class QueryBudgetTest(AuthenticatedTestCase):
+    """Queries per request must not grow with the cellar."""
+
+    def get(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            b"".join(response.streaming_content)
+        return response
+
+    def send(self, method, path, payload):
+        response = getattr(self.client, method)(path, payload, content_type="application/json")
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    @query_budget(4)
+    def test_bootstrap(self):
+        self.get("/api/bootstrap")
+
+    @query_budget(7)
+    def test_list_references(self):
+        self.get("/api/refs")
+        self.get("/api/refs", search=self.reference.name.split()[-1])
+        self.get("/api/refs", location=self.reference.location)
+
+    @query_budget(6)
+    def test_reference_detail(self):
+        self.get(f"/api/ref/{self.sqid}")
+
+    @query_budget(5)
+    def test_reference_purchases_and_movements(self):
+        self.get(f"/api/ref/{self.sqid}/purchases")
+        self.get(f"/api/ref/{self.sqid}/movements")
+        self.get("/api/movements")
+        self.get("/api/movements/summary")
+
+    @query_budget(4)
+    def test_lookups(self):
+        self.get("/api/locations")
+        for lookup in ["categories", "regions", "appellations", "formats", "grapes"]:
+            self.get(f"/api/{lookup}", counts=True)
+
+    @query_budget(11)
+    def test_sync(self):
+        token = self.get("/api/sync").json()["token"]
+        self.get("/api/sync", since=token)
+
+    @query_budget(7)
+    def test_menu(self):
+        self.get("/api/menu/template/generate")
+        self.get("/api/export/html")
+
+    @query_budget(4)
+    def test_export(self):
+        self.get("/api/export/csv")
+        self.get("/api/export/ndjson")
+
+    @query_budget(24)
+    def test_write_reference(self):
+        payload = {
+            "name": "Morgon", "category": "Rouges", "region": "Beaujolais",
+            "appellation": "Morgon", "format": "Standard", "grapes": ["Gamay"],
+        }
+        sqid = self.send("post", "/api/ref", payload).json()["sqid"]
+        self.send("put", f"/api/ref/{sqid}", {**payload, "vintage": 2022})
+        self.client.delete(f"/api/ref/{sqid}")
+
+    @query_budget(8)
+    def test_quantities_and_purchases(self):
+        self.send("post", f"/api/ref/{self.sqid}/quantity/adjust", {"delta": 2})
+        self.send("put", f"/api/ref/{self.sqid}/quantity", {"quantity": 3})
+        self.send("post", "/api/quantities/adjust", {
+            "adjustments": [
+                {"sqid": sqid_encode(pk), "delta": 1}
+                for pk in Reference.objects.values_list("pk", flat=True)
+            ],
+        })
+        self.send("post", f"/api/ref/{self.sqid}/purchases", {
+            "date": "2024-05-01", "quantity": 6, "price": 12.5,
+        })
+
+    def test_failure_lists_queries(self):
+        self.make_cellar(2)
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertRequestQueries(1):
+                self.get(f"/api/ref/{self.sqid}")
+        message = str(raised.exception)
+        self.assertRegex(message, rf"GET /api/ref/{self.sqid} ran \d+ queries, budget 1:")
+        self.assertIn('FROM "cave_reference"', message)
+        self.assertIn("cave/api.py", message)
+
+
+class BatchAPITest(AuthenticatedTestCase):
+    """Test /api/batch running many operations in one request."""
+
+    def batch(self, operations, atomic=True):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                "/api/batch",
+                json.dumps({"operations": operations, "atomic": atomic}),
+                content_type="application/json",
+            )
+
+    def test_mixed_operations(self):
+        ref = Reference.objects.create(name="Old", current_quantity=3)
+        purchase = Purchase.objects.create(reference=ref, date="2023-01-01", quantity=6, price=10)
+        sqid = sqid_encode(ref.id)
+        response = self.batch([
+            {"op": "create_reference", "data": {"name": "New", "category": "Red", "grapes": ["Syrah"]}},
+            {"op": "create_purchase", "sqid": "$0", "data": {"date": "2024-01-01", "quantity": 2, "price": 20}},
+            {"op": "set_quantity", "sqid": sqid, "data": {"quantity": 12}},
+            {"op": "adjust_quantity", "sqid": sqid, "data": {"delta": -2, "expected": 12}},
+            {"op": "update_purchase", "id": purchase.id, "data": {"date": "2023-01-02", "quantity": 5, "price": 11}},
+            {"op": "delete_reference", "sqid": sqid},
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data["committed"])
+        self.assertTrue(all(r["ok"] for r in data["results"]))
+        self.assertEqual(data["results"][2]["quantity"], 12)
+        self.assertEqual(data["results"][3]["quantity"], 10)
+
+        new = Reference.objects.get(id=sqid_decode(data["results"][0]["sqid"]))
+        self.assertEqual(new.category.name, "Red")
+        self.assertEqual([g.name for g in new.grapes.all()], ["Syrah"])
+        self.assertEqual(new.purchases.get().quantity, 2)
+        self.assertFalse(Reference.objects.filter(id=ref.id).exists())
+
+    def test_shares_lookups_across_operations(self):
+        response = self.batch([
+            {"op": "create_reference", "data": {"name": f"Wine {i}", "region": "Loire"}}
+            for i in range(3)
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Region.objects.count(), 1)
+        self.assertEqual(Reference.objects.filter(region__name="Loire").count(), 3)
+
+    def test_atomic_failure_rolls_back(self):
+        ref = Reference.objects.create(name="Wine", current_quantity=3)
+        response = self.batch([
+            {"op": "set_quantity", "sqid": sqid_encode(ref.id), "data": {"quantity": 7}},
+            {"op": "create_reference", "data": {"name": "New", "category": "Red"}},
+            {"op": "delete_purchase", "id": 999999},
+        ])
+        self.assertEqual(response.status_code, 400)
+        data = response.json()
+        self.assertFalse(data["committed"])
+        self.assertEqual(data["results"], [{"index": 2, "ok": False, "error": "purchase not found"}])
+        ref.refresh_from_db()
+        self.assertEqual(ref.current_quantity, 3)
+        self.assertFalse(Reference.objects.filter(name="New").exists())
+        self.assertFalse(Category.objects.exists())
+
+    def test_atomic_validation_error_runs_nothing(self):
+        ref = Reference.objects.create(name="Wine", current_quantity=3)
+        response = self.batch([
+            {"op": "set_quantity", "sqid": sqid_encode(ref.id), "data": {"quantity": 7}},
+            {"op": "create_reference", "data": {"unknown": True}},
+        ])
+        self.assertEqual(response.status_code, 400)
+        result = response.json()["results"][0]
+        self.assertEqual(result["index"], 1)
+        self.assertEqual(result["error"], "invalid payload")
+        ref.refresh_from_db()
+        self.assertEqual(ref.current_quantity, 3)
+
+    def test_non_atomic_reports_per_item(self):
+        ref = Reference.objects.create(name="Wine", current_quantity=3)
+        response = self.batch(
+            [
+                {"op": "create_reference", "data": {"name": "First", "category": "Rosé"}},
+                {"op": "update_reference", "sqid": "$0", "data": {"name": "Renamed"}},
+                {"op": "set_quantity", "sqid": sqid_encode(ref.id), "data": {"quantity": 7}},
+                {"op": "set_quantity", "sqid": "nope", "data": {"quantity": 1}},
+            ],
+            atomic=False,
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([r["ok"] for r in results], [True, True, True, False])
+        self.assertEqual(results[3]["error"], "reference not found")
+        ref.refresh_from_db()
+        self.assertEqual(ref.current_quantity, 7)
+        # Updates replace the whole reference, orphaning the category.
+        self.assertIsNone(Reference.objects.get(name="Renamed").category)
+        self.assertFalse(Category.objects.exists())
+
+    def test_non_atomic_failure_does_not_leave_orphans(self):
+        response = self.batch(
+            [{"op": "create_purchase", "sqid": "$5", "data": {"date": "2024-01-01", "quantity": 1, "price": 1}},
+             {"op": "update_reference", "sqid": "nope", "data": {"name": "X", "region": "Jura"}}],
+            atomic=False,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["ok"] for r in response.json()["results"]], [False, False])
+        self.assertFalse(Region.objects.exists())
+
+    def test_update_cleans_up_orphans(self):
+        ref = Reference.objects.create(name="Wine", category=Category.objects.create(name="Red"))
+        response = self.batch([
+            {"op": "update_reference", "sqid": sqid_encode(ref.id), "data": {"name": "Wine", "category": "White"}},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Category.objects.values_list("name", flat=True)), ["White"])
+
+    def test_batch_size_limit(self):
+        with patch("cave.api.MAX_BATCH_SIZE", 2):
+            response = self.batch([{"op": "delete_purchase", "id": 1}] * 3)
+        self.assertEqual(response.status_code, 400)
+
+    def test_requires_authentication(self):
+        self.client.logout()
+        response = self.batch([])
+        self.assertEqual(response.status_code, 401)
+
+
+class MetricsTest(AuthenticatedTestCase):
+    """Test the Prometheus metrics and /metrics."""
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_metrics(self):
+        Reference.objects.create(name="Chablis")
+        labels = {"method": "GET", "route": "api/ref/<sqid>"}
+        before = {
+            "requests": self.sample("gibolin_http_requests_total", status="200", **labels),
+            "latency": self.sample("gibolin_http_request_duration_seconds_count", **labels),
+            "queries": self.sample("gibolin_db_queries_per_request_sum", route=labels["route"]),
+        }
+        response = self.client.get(f"/api/ref/{sqid_encode(Reference.objects.get().pk)}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.sample("gibolin_http_requests_total", status="200", **labels), before["requests"] + 1
+        )
+        self.assertEqual(
+            self.sample("gibolin_http_request_duration_seconds_count", **labels), before["latency"] + 1
+        )
+        self.assertGreater(
+            self.sample("gibolin_db_queries_per_request_sum", route=labels["route"]), before["queries"]
+        )
+        missing = self.sample("gibolin_http_requests_total", status="404", **labels)
+        self.client.get("/api/ref/nope")
+        self.assertEqual(self.sample("gibolin_http_requests_total", status="404", **labels), missing + 1)
+
+    def test_cache_hits_and_misses(self):
+        cache.clear()
+        hits = self.sample("gibolin_cache_lookups_total", family="cave:menu", result="hit")
+        misses = self.sample("gibolin_cache_lookups_total", family="cave:menu", result="miss")
+        self.client.get("/api/export/html")
+        self.client.get("/api/export/html")
+        self.assertEqual(
+            self.sample("gibolin_cache_lookups_total", family="cave:menu", result="miss"), misses + 1
+        )
+        self.assertEqual(
+            self.sample("gibolin_cache_lookups_total", family="cave:menu", result="hit"), hits + 1
+        )
+        self.assertIsNone(cache.get("cave:menu:unknown"))
+        self.assertEqual(cache.get("cave:menu:unknown", "default"), "default")
+
+    def test_has_key_and_get_many_are_counted(self):
+        cache.set("cave:menu:counted", "menu")
+
+        def lookups(result):
+            return self.sample("gibolin_cache_lookups_total", family="cave:menu", result=result)
+
+        hits, misses = lookups("hit"), lookups("miss")
+        self.assertIn("cave:menu:counted", cache)
+        self.assertFalse(cache.has_key("cave:menu:absent"))
+        cache.get_many(["cave:menu:counted", "cave:menu:absent"])
+        self.assertEqual((lookups("hit"), lookups("miss")), (hits + 2, misses + 2))
+        # add() checks for the key as part of a write, not as a lookup.
+        self.assertFalse(cache.add("cave:menu:counted", "other"))
+        self.assertTrue(cache.add("cave:menu:added", "menu"))
+        self.assertEqual((lookups("hit"), lookups("miss")), (hits + 2, misses + 2))
+
+    def test_key_family(self):
+        self.assertEqual(metrics.key_family("auth:user:12"), "auth:user")
+        self.assertEqual(metrics.key_family("cave:cellar-version"), "cave:cellar-version")
+        self.assertEqual(metrics.key_family("django.contrib.sessions.cached_dbabc123"), "session")
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_exposition(self):
+        self.client.get("/api/me")
+        response = Client().get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        body = response.content.decode()
+        self.assertIn('gibolin_http_requests_total{method="GET",route="api/me",status="200"}', body)
+        self.assertIn('gibolin_http_request_duration_seconds_bucket{le="0.005",method="GET",route="api/me"}', body)
+        self.assertIn("gibolin_http_requests_in_flight", body)
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_token(self):
+        self.assertEqual(Client().get("/metrics").status_code, 401)
+        self.assertEqual(Client().get("/metrics", HTTP_AUTHORIZATION="Bearer nope").status_code, 401)
+        self.assertEqual(Client().get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200)
+
+    @override_settings(METRICS_TOKEN="")
+    def test_no_token_only_in_development(self):
+        self.assertEqual(Client().get("/metrics").status_code, 404)
+        with override_settings(DEBUG=True):
+            self.assertEqual(Client().get("/metrics").status_code, 200)
+
+    def test_workers_are_aggregated(self):
+        """Values written by separate processes add up in one exposition."""
+        def run(code):
+            return subprocess.run(
+                [sys.executable, "-c", "import django; django.setup(); from cave import metrics; " + code],
+                cwd=PROJECT_DIR, env=env, check=True, capture_output=True, text=True,
+            ).stdout
+
+        with tempfile.TemporaryDirectory() as directory:
+            env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": directory,
+                   "DJANGO_SETTINGS_MODULE": "gibolin.settings"}
+            for _ in range(2):
+                run('metrics.REQUESTS.labels("GET", "api/refs", "200").inc(3)')
+            body = run("print(metrics.render()[0].decode())")
+        self.assertIn('gibolin_http_requests_total{method="GET",route="api/refs",status="200"} 6.0', body)
+
+
+class CompressionTest(AuthenticatedTestCase):
+    """Test content-negotiated compression of API responses."""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(30):
+            Reference.objects.create(name=f"Wine {i}", domain="Domaine de Test")
+
+    def test_gzip_json_response(self):
+        response = self.client.get("/api/refs", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        data = json.loads(gzip.decompress(response.content))
+        self.assertEqual(data["count"], 30)
+
+    def test_prefers_brotli_when_available(self):
+        response = self.client.get("/api/refs", HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(response["Content-Encoding"], "br")
+        data = json.loads(brotli.decompress(response.content))
+        self.assertEqual(data["count"], 30)
+
+    def test_no_compression_without_accept_encoding(self):
+        response = self.client.get("/api/refs")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_small_response_not_compressed(self):
+        response = self.client.get("/api/me", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_negotiate_respects_q_zero(self):
+        self.assertEqual(compression.negotiate("br;q=0, gzip"), "gzip")
+        self.assertIsNone(compression.negotiate("identity"))
+
+    def test_compress_chunks_round_trip(self):
+        chunks = [b"line %d\n" % i for i in range(100)]
+        compressed = b"".join(compression.compress_chunks(iter(chunks), "gzip"))
+        self.assertEqual(gzip.decompress(compressed), b"".join(chunks))
+
+    def test_precompressed_body_is_reused(self):
+        body = b"<html>" + b"x" * 2000 + b"</html>"
+        response = HttpResponse(body, content_type="text/html")
+        response.precompressed = {"gzip": compression.compress_bytes(body, "gzip", max_effort=True)}
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+        result = CompressionMiddleware(lambda r: response)(request)
+        self.assertEqual(result.content, response.precompressed["gzip"])
+
+
+class SpaShellTest(TestCase):
+    """Test the in-memory SPA shell served by the catch-all route."""
+
+    def setUp(self):
+        tmp = tempfile.NamedTemporaryFile("wb", suffix=".html", delete=False)
+        tmp.write(b"<html>v1</html>")
+        tmp.close()
+        self.index_path = tmp.name
+        self.addCleanup(os.unlink, self.index_path)
+        for p in (
+            patch("gibolin.urls.SPA_INDEX_PATH", self.index_path),
+            patch.dict("gibolin.urls._spa_shell", {"mtime": None}),
+        ):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_serves_shell_with_etag_and_cache_headers(self):
+        response = Client().get("/some/page")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"<html>v1</html>")
+        self.assertTrue(response["ETag"])
+        self.assertIn("max-age=60", response["Cache-Control"])
+
+    def test_matching_etag_returns_304(self):
+        client = Client()
+        etag = client.get("/").headers["ETag"]
+        response = client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_reads_file_once(self):
+        client = Client()
+        client.get("/")
+        with patch("gibolin.urls.open", create=True) as mock_open:
+            client.get("/")
+        mock_open.assert_not_called()
+
+    def test_reloads_on_file_change(self):
+        client = Client()
+        etag = client.get("/").headers["ETag"]
+        with open(self.index_path, "wb") as f:
+            f.write(b"<html>v2</html>")
+        stat = os.stat(self.index_path)
+        os.utime(self.index_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        response = client.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"<html>v2</html>")
+
+
+class WhiteNoiseMiddlewareTest(TestCase):
+    """Test which static files are cached forever."""
+
+    def setUp(self):
+        self.middleware = WhiteNoiseMiddleware(lambda request: None)
+
+    def test_vite_assets_are_immutable(self):
+        self.assertTrue(self.middleware.immutable_file_test("", "/assets/index-3f2a1b.js"))
+        self.assertFalse(self.middleware.immutable_file_test("", "/favicon.ico"))
+
+    def test_hashed_static_files_are_still_immutable(self):
+        with patch.object(self.middleware, "get_static_url", return_value="/static/app.0123456789ab.css"):
+            self.assertTrue(self.middleware.immutable_file_test("", "/static/app.0123456789ab.css"))
+        self.assertFalse(self.middleware.immutable_file_test("", "/static/app.css"))
+
+
 class ConfigAPITest(TestCase):
     """Test /api/config public endpoint."""
 
@@ -1468,9 +3030,10 @@ class GrapeTest(AuthenticatedTestCase):
         ref.grapes.add(grape)
         sqid = sqid_encode(ref.id)
         data = {"name": "Wine", "grapes": ["NewGrape"]}
-        self.client.put(
-            f"/api/ref/{sqid}", json.dumps(data), content_type="application/json"
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}", json.dumps(data), content_type="application/json"
+            )
         self.assertFalse(Grape.objects.filter(name="OldGrape").exists())
 
     def test_shared_grape_kept_on_update(self):
@@ -1481,9 +3044,10 @@ class GrapeTest(AuthenticatedTestCase):
         ref_b.grapes.add(grape)
         sqid = sqid_encode(ref_b.id)
         data = {"name": "Wine B", "grapes": ["Other"]}
-        self.client.put(
-            f"/api/ref/{sqid}", json.dumps(data), content_type="application/json"
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}", json.dumps(data), content_type="application/json"
+            )
         self.assertTrue(Grape.objects.filter(name="SharedGrape").exists())
 
     def test_orphan_grape_deleted_on_ref_delete(self):
@@ -1491,7 +3055,8 @@ class GrapeTest(AuthenticatedTestCase):
         grape = Grape.objects.create(name="LonelyGrape")
         ref.grapes.add(grape)
         sqid = sqid_encode(ref.id)
-        self.client.delete(f"/api/ref/{sqid}")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/ref/{sqid}")
         self.assertFalse(Grape.objects.filter(name="LonelyGrape").exists())
 
     def test_search_matches_grape(self):
@@ -1505,16 +3070,283 @@ class GrapeTest(AuthenticatedTestCase):
         self.assertEqual(data["items"][0]["name"], "Wine")
 
 
+class LookupUpsertTest(TestCase):
+    """Test LookupManager.upsert resolving names in one statement."""
+
+    def test_creates_missing_and_returns_existing(self):
+        red = Category.objects.create(name="Red", color="#ff0000")
+        found = Category.objects.upsert(["Red", "White", "White"])
+        self.assertEqual(set(found), {"Red", "White"})
+        self.assertEqual(found["Red"].pk, red.pk)
+        self.assertEqual(found["Red"].color, "#ff0000")
+        self.assertEqual(found["White"].color, "#000000")
+        self.assertEqual(Category.objects.count(), 2)
+
+    def test_existing_rows_keep_their_version(self):
+        loire = Region.objects.create(name="Loire")
+        Region.objects.upsert(["Loire", "Jura"])
+        loire_version = Region.objects.get(name="Loire").version
+        self.assertEqual(loire_version, loire.version)
+        self.assertGreater(Region.objects.get(name="Jura").version, loire_version)
+
+    def test_fixed_number_of_queries(self):
+        Grape.objects.create(name="Syrah")
+        names = ["Syrah", "Grenache", "Mourvèdre", "Cinsault"]
+        # Locking select, version bump, insert.
+        with self.assertNumQueries(3):
+            found = Grape.objects.upsert(names)
+        self.assertEqual(sorted(found), sorted(names))
+
+    def test_existing_names_are_not_written(self):
+        red = Category.objects.create(name="Red")
+        version = get_cellar_version()
+        # One locking select.
+        with self.assertNumQueries(1):
+            found, created = Category.objects.upsert_one("Red")
+        self.assertFalse(created)
+        self.assertEqual(found.pk, red.pk)
+        self.assertEqual(get_cellar_version(), version)
+        self.assertEqual(Category.objects.get(pk=red.pk).version, red.version)
+
+    def test_posting_an_existing_name_keeps_etags(self):
+        client = Client()
+        client.force_login(User.objects.create_user(email="etag@example.com", password="pw"))
+        client.post("/api/categories", {"name": "Red"}, content_type="application/json")
+        etag = client.get("/api/categories")["ETag"]
+        client.post("/api/categories", {"name": "Red"}, content_type="application/json")
+        self.assertEqual(client.get("/api/categories", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_upsert_one(self):
+        fmt, created = Format.objects.upsert_one("Magnum")
+        self.assertTrue(created)
+        again, created = Format.objects.upsert_one("Magnum")
+        self.assertFalse(created)
+        self.assertEqual(again.pk, fmt.pk)
+
+    def test_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Appellation.objects.upsert([]), {})
+
+
+class LookupCacheTest(TransactionTestCase):
+    """Test the per-process lookup id cache and its shared invalidation."""
+
+    def setUp(self):
+        cache.delete(lookup_cache.LOOKUP_VERSION_KEY)
+        lookup_cache._state.update(token=None, ids=None)
+        self.red = Category.objects.create(name="Red")
+        lookup_cache.warm()
+
+    def tearDown(self):
+        cache.delete(lookup_cache.LOOKUP_VERSION_KEY)
+        lookup_cache._state.update(token=None, ids=None)
+
+    def post(self, name, **lookups):
+        client = Client()
+        client.force_login(User.objects.get_or_create(email="cache@example.com")[0])
+        return client.post("/api/ref", {"name": name, **lookups}, content_type="application/json")
+
+    def test_known_names_cost_no_query(self):
+        with self.assertNumQueries(0):
+            found = Category.objects.resolve(["Red"])
+        self.assertEqual(found["Red"].pk, self.red.pk)
+
+    def test_cached_id_deleted_meanwhile_is_upserted_again(self):
+        # Deleted behind the cache's back, as by a concurrent orphan cleanup:
+        # the first attempt fails its foreign key check at commit.
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM cave_category WHERE id = %s", [self.red.pk])
+        self.assertEqual(self.post("Wine", category="Red").status_code, 200)
+        category = Reference.objects.get().category
+        self.assertEqual(category.name, "Red")
+        self.assertNotEqual(category.pk, self.red.pk)
+        self.assertEqual(category.reference_count, 1)
+
+    def test_write_requests_warm_the_cache(self):
+        lookup_cache._state.update(token=None, ids=None)
+        token = cache.get(lookup_cache.LOOKUP_VERSION_KEY)
+        self.assertEqual(self.post("Wine", category="Red", region="Loire").status_code, 200)
+        # Creating Loire added it to this copy and left the others valid.
+        loire = Region.objects.get(name="Loire")
+        self.assertEqual(cache.get(lookup_cache.LOOKUP_VERSION_KEY), token)
+        self.assertEqual(lookup_cache.cached_ids(Category, ["Red"]), {"Red": self.red.pk})
+        self.assertEqual(lookup_cache.cached_ids(Region, ["Loire"]), {"Loire": loire.pk})
+        self.assertEqual(self.post("Other", category="Red", region="Loire").status_code, 200)
+        self.assertEqual(Reference.objects.filter(region=loire).count(), 2)
+
+    def test_existing_names_are_remembered(self):
+        # Rows created without signals are unknown until an upsert returns them.
+        Grape.objects.bulk_create([Grape(name="Gamay")])
+        self.assertEqual(lookup_cache.cached_ids(Grape, ["Gamay"]), {})
+        with transaction.atomic():
+            Grape.objects.upsert(["Gamay"])
+        self.assertIn("Gamay", lookup_cache.cached_ids(Grape, ["Gamay"]))
+
+    def test_delete_invalidates(self):
+        token = cache.get(lookup_cache.LOOKUP_VERSION_KEY)
+        self.red.delete()
+        self.assertNotEqual(cache.get(lookup_cache.LOOKUP_VERSION_KEY), token)
+        self.assertEqual(lookup_cache.cached_ids(Category, ["Red"]), {})
+
+    def test_orphan_cleanup_invalidates(self):
+        _cleanup_orphaned_lookups([self.red])
+        self.assertEqual(lookup_cache.cached_ids(Category, ["Red"]), {})
+
+    def test_other_worker_invalidation(self):
+        cache.set(lookup_cache.LOOKUP_VERSION_KEY, "from-another-worker", None)
+        self.assertEqual(lookup_cache.cached_ids(Category, ["Red"]), {})
+
+    def test_rollback_does_not_poison_cache(self):
+        with transaction.atomic():
+            Format.objects.upsert(["Magnum"])
+            transaction.set_rollback(True)
+        lookup_cache.warm()
+        self.assertEqual(lookup_cache.cached_ids(Format, ["Magnum"]), {})
+
+    def test_warm_skipped_inside_transactions(self):
+        lookup_cache._state.update(ids=None)
+        with transaction.atomic():
+            lookup_cache.warm()
+        self.assertIsNone(lookup_cache._state["ids"])
+
+
+class DeleteOrphansTest(TestCase):
+    """Test LookupManager.delete_orphans."""
+
+    def test_deletes_only_unused_candidates(self):
+        used = Category.objects.create(name="Used")
+        Reference.objects.create(name="Wine", category=used)
+        orphan = Category.objects.create(name="Orphan")
+        other = Category.objects.create(name="Other orphan")
+        deleted = Category.objects.delete_orphans([used.pk, orphan.pk])
+        self.assertEqual(deleted, [orphan.pk])
+        self.assertEqual(
+            set(Category.objects.values_list("name", flat=True)), {"Used", "Other orphan"}
+        )
+        self.assertEqual(Category.objects.delete_orphans(), [other.pk])
+
+    def test_grapes_use_the_through_table(self):
+        ref = Reference.objects.create(name="Wine")
+        ref.grapes.add(Grape.objects.create(name="Syrah"))
+        lonely = Grape.objects.create(name="Gamay")
+        self.assertEqual(Grape.objects.delete_orphans(), [lonely.pk])
+
+    def test_writes_tombstones(self):
+        orphan = Region.objects.create(name="Jura")
+        Region.objects.delete_orphans([orphan.pk])
+        self.assertTrue(
+            Tombstone.objects.filter(model="region", object_id=orphan.pk).exists()
+        )
+
+    def test_single_statement_without_deletions(self):
+        used = Format.objects.create(name="Magnum")
+        Reference.objects.create(name="Wine", format=used)
+        version = get_cellar_version()
+        with self.assertNumQueries(1):
+            self.assertEqual(Format.objects.delete_orphans([used.pk]), [])
+        self.assertEqual(get_cellar_version(), version)
+
+    def test_bumps_the_version_before_deleting(self):
+        orphan = Format.objects.create(name="Jeroboam")
+        with CaptureQueriesContext(connection) as queries:
+            Format.objects.delete_orphans([orphan.pk])
+        statements = [q["sql"] for q in queries.captured_queries]
+        bump = next(i for i, sql in enumerate(statements) if "cave_cellarversion" in sql)
+        delete = next(i for i, sql in enumerate(statements) if sql.startswith("DELETE"))
+        self.assertLess(bump, delete)
+
+    def test_no_candidates(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(Format.objects.delete_orphans([None]), [])
+
+
+class ReferenceCountTest(AuthenticatedTestCase):
+    """Test the trigger-maintained reference_count on lookups."""
+
+    def count(self, instance):
+        return type(instance).objects.values_list("reference_count", flat=True).get(pk=instance.pk)
+
+    def test_create_update_delete(self):
+        red = Category.objects.create(name="Red")
+        white = Category.objects.create(name="White")
+        loire = Region.objects.create(name="Loire")
+        ref = Reference.objects.create(name="Wine", category=red, region=loire)
+        Reference.objects.create(name="Other", category=red)
+        self.assertEqual((self.count(red), self.count(loire)), (2, 1))
+
+        ref.category = white
+        ref.region = None
+        ref.save()
+        self.assertEqual((self.count(red), self.count(white), self.count(loire)), (1, 1, 0))
+
+        Reference.objects.filter(category=red).update(category=white)
+        self.assertEqual((self.count(red), self.count(white)), (0, 2))
+
+        ref.delete()
+        self.assertEqual(self.count(white), 1)
+
+    def test_updates_only_fire_on_lookup_changes(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_get_triggerdef(oid) FROM pg_trigger "
+                "WHERE tgrelid = 'cave_reference'::regclass AND NOT tgisinternal"
+            )
+            updates = [definition for (definition,) in cursor.fetchall() if " UPDATE " in definition]
+        self.assertEqual(len(updates), 1)
+        self.assertIn("UPDATE OF category_id, region_id, appellation_id, format_id", updates[0])
+        self.assertIn("FOR EACH ROW WHEN", updates[0])
+
+    def test_grapes(self):
+        syrah = Grape.objects.create(name="Syrah")
+        gamay = Grape.objects.create(name="Gamay")
+        ref = Reference.objects.create(name="Wine")
+        ref.grapes.set([syrah, gamay])
+        Reference.objects.create(name="Other").grapes.add(syrah)
+        self.assertEqual((self.count(syrah), self.count(gamay)), (2, 1))
+        ref.grapes.set([gamay])
+        self.assertEqual((self.count(syrah), self.count(gamay)), (1, 1))
+        ref.delete()
+        self.assertEqual(self.count(gamay), 0)
+
+    def test_lookup_save_keeps_count(self):
+        red = Category.objects.create(name="Red")
+        Reference.objects.create(name="Wine", category=red)
+        red.color = "#aa0000"  # red.reference_count is still 0 in memory
+        red.save()
+        self.assertEqual(self.count(red), 1)
+
+    def test_orphans_follow_the_count(self):
+        red = Category.objects.create(name="Red")
+        ref = Reference.objects.create(name="Wine", category=red)
+        self.assertEqual(Category.objects.delete_orphans([red.pk]), [])
+        ref.delete()
+        self.assertEqual(Category.objects.delete_orphans([red.pk]), [red.pk])
+
+    def test_list_endpoints_with_counts(self):
+        red = Category.objects.create(name="Red")
+        Category.objects.create(name="White")
+        Reference.objects.create(name="Wine", category=red)
+        Reference.objects.create(name="Other", category=red)
+        response = self.client.get("/api/categories?counts=true")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(), [{"name": "Red", "count": 2}, {"name": "White", "count": 0}]
+        )
+        self.assertEqual(self.client.get("/api/categories").json(), ["Red", "White"])
+        self.assertEqual(self.client.get("/api/grapes?counts=true").json(), [])
+
+
 class OrphanLookupCleanupTest(AuthenticatedTestCase):
     def test_update_ref_deletes_orphaned_category(self):
         cat = Category.objects.create(name="OldCat")
         ref = Reference.objects.create(name="Wine", category=cat)
         sqid = sqid_encode(ref.id)
-        self.client.put(
-            f"/api/ref/{sqid}",
-            json.dumps({"name": "Wine", "category": "NewCat"}),
-            content_type="application/json",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}",
+                json.dumps({"name": "Wine", "category": "NewCat"}),
+                content_type="application/json",
+            )
         self.assertFalse(Category.objects.filter(name="OldCat").exists())
         self.assertTrue(Category.objects.filter(name="NewCat").exists())
 
@@ -1523,55 +3355,60 @@ class OrphanLookupCleanupTest(AuthenticatedTestCase):
         Reference.objects.create(name="Wine A", category=cat)
         ref_b = Reference.objects.create(name="Wine B", category=cat)
         sqid = sqid_encode(ref_b.id)
-        self.client.put(
-            f"/api/ref/{sqid}",
-            json.dumps({"name": "Wine B", "category": "Other"}),
-            content_type="application/json",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}",
+                json.dumps({"name": "Wine B", "category": "Other"}),
+                content_type="application/json",
+            )
         self.assertTrue(Category.objects.filter(name="SharedCat").exists())
 
     def test_update_ref_clearing_lookup_deletes_orphan(self):
         cat = Category.objects.create(name="LonelyCat")
         ref = Reference.objects.create(name="Wine", category=cat)
         sqid = sqid_encode(ref.id)
-        self.client.put(
-            f"/api/ref/{sqid}",
-            json.dumps({"name": "Wine", "category": None}),
-            content_type="application/json",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}",
+                json.dumps({"name": "Wine", "category": None}),
+                content_type="application/json",
+            )
         self.assertFalse(Category.objects.filter(name="LonelyCat").exists())
 
     def test_update_ref_deletes_orphaned_region(self):
         region = Region.objects.create(name="OldRegion")
         ref = Reference.objects.create(name="Wine", region=region)
         sqid = sqid_encode(ref.id)
-        self.client.put(
-            f"/api/ref/{sqid}",
-            json.dumps({"name": "Wine", "region": "NewRegion"}),
-            content_type="application/json",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}",
+                json.dumps({"name": "Wine", "region": "NewRegion"}),
+                content_type="application/json",
+            )
         self.assertFalse(Region.objects.filter(name="OldRegion").exists())
 
     def test_update_ref_deletes_orphaned_appellation(self):
         appellation = Appellation.objects.create(name="OldApp")
         ref = Reference.objects.create(name="Wine", appellation=appellation)
         sqid = sqid_encode(ref.id)
-        self.client.put(
-            f"/api/ref/{sqid}",
-            json.dumps({"name": "Wine", "appellation": "NewApp"}),
-            content_type="application/json",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}",
+                json.dumps({"name": "Wine", "appellation": "NewApp"}),
+                content_type="application/json",
+            )
         self.assertFalse(Appellation.objects.filter(name="OldApp").exists())
 
     def test_update_ref_deletes_orphaned_format(self):
         fmt = Format.objects.create(name="OldFmt")
         ref = Reference.objects.create(name="Wine", format=fmt)
         sqid = sqid_encode(ref.id)
-        self.client.put(
-            f"/api/ref/{sqid}",
-            json.dumps({"name": "Wine", "format": "NewFmt"}),
-            content_type="application/json",
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                f"/api/ref/{sqid}",
+                json.dumps({"name": "Wine", "format": "NewFmt"}),
+                content_type="application/json",
+            )
         self.assertFalse(Format.objects.filter(name="OldFmt").exists())
 
     def test_delete_ref_deletes_orphaned_lookups(self):
@@ -1584,7 +3421,8 @@ class OrphanLookupCleanupTest(AuthenticatedTestCase):
             appellation=appellation, format=fmt,
         )
         sqid = sqid_encode(ref.id)
-        self.client.delete(f"/api/ref/{sqid}")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/ref/{sqid}")
         self.assertFalse(Category.objects.filter(name="DelCat").exists())
         self.assertFalse(Region.objects.filter(name="DelRegion").exists())
         self.assertFalse(Appellation.objects.filter(name="DelApp").exists())
@@ -1595,7 +3433,8 @@ class OrphanLookupCleanupTest(AuthenticatedTestCase):
         Reference.objects.create(name="Wine A", category=cat)
         ref_b = Reference.objects.create(name="Wine B", category=cat)
         sqid = sqid_encode(ref_b.id)
-        self.client.delete(f"/api/ref/{sqid}")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/ref/{sqid}")
         self.assertTrue(Category.objects.filter(name="SharedCat").exists())
 
 
@@ -1630,6 +3469,413 @@ class LogoutViewTest(TestCase):
         self.assertEqual(response.status_code, 401)
 
 
+class ServerTimingMiddlewareTest(AuthenticatedTestCase):
+    """Test per-request timings in Server-Timing and the request log."""
+
+    def timings(self, response):
+        timings = {}
+        for entry in response["Server-Timing"].split(", "):
+            name, *params = entry.split(";")
+            timings[name] = dict(param.split("=", 1) for param in params)
+        return timings
+
+    def test_api_request(self):
+        Reference.objects.create(name="Chablis", category=Category.objects.create(name="White"))
+        with self.assertLogs("cave.requests", "INFO") as logs:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/api/refs")
+        self.assertEqual(response.status_code, 200)
+        timings = self.timings(response)
+        self.assertEqual(list(timings), ["db", "view", "serialize", "total"])
+        self.assertEqual(timings["db"]["desc"], f'"{len(queries)} queries"')
+        total = float(timings["total"]["dur"])
+        self.assertLessEqual(
+            sum(float(timings[name]["dur"]) for name in ["db", "view", "serialize"]), total
+        )
+
+        [line] = logs.records
+        logged = json.loads(line.getMessage())
+        self.assertEqual(logged["method"], "GET")
+        self.assertEqual(logged["path"], "/api/refs")
+        self.assertEqual(logged["status"], 200)
+        self.assertEqual(logged["queries"], len(queries))
+        self.assertEqual(logged["total_ms"], total)
+
+    def test_menu_render_phase(self):
+        with self.assertLogs("cave.requests", "INFO"):
+            response = self.client.get("/api/export/html")
+        self.assertIn("render", self.timings(response))
+        self.assertNotIn("serialize", self.timings(response))
+
+    def test_not_modified_and_errors_are_timed(self):
+        with self.assertLogs("cave.requests", "INFO") as logs:
+            etag = self.client.get("/api/refs")["ETag"]
+            response = self.client.get("/api/refs", HTTP_IF_NONE_MATCH=etag)
+            missing = self.client.get("/api/ref/nope")
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("total", self.timings(response))
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual([json.loads(r.getMessage())["status"] for r in logs.records], [200, 304, 404])
+
+    def test_phase_excludes_queries(self):
+        timer = timing.Timer()
+        with connection.execute_wrapper(timer), timer.phase("view"):
+            Reference.objects.count()
+        metrics = timer.metrics()
+        self.assertEqual(metrics["queries"], 1)
+        self.assertGreater(metrics["db_ms"], 0)
+        self.assertLess(metrics["view_ms"], metrics["total_ms"] - metrics["db_ms"] + 0.01)
+
+
+@override_settings(SLOW_REQUEST_MS=None, SLOW_QUERY_MS=None, SLOW_REQUEST_EXPLAIN=0)
+class SlowRequestLogTest(AuthenticatedTestCase):
+    """Test the slow request log."""
+
+    def setUp(self):
+        super().setUp()
+        self.reference = Reference.objects.create(
+            name="Chablis", category=Category.objects.create(name="White")
+        )
+
+    def slow_entries(self, *requests):
+        with self.assertLogs("cave.slow", "WARNING") as logs:
+            for request in requests:
+                request()
+        return [json.loads(record.getMessage()) for record in logs.records]
+
+    def test_fast_requests_are_not_logged(self):
+        with self.assertNoLogs("cave.slow", "WARNING"):
+            self.client.get("/api/refs")
+        with override_settings(SLOW_REQUEST_MS=60_000, SLOW_QUERY_MS=60_000):
+            with self.assertNoLogs("cave.slow", "WARNING"):
+                self.client.get("/api/refs")
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_request_entry(self):
+        with CaptureQueriesContext(connection) as queries:
+            [entry] = self.slow_entries(lambda: self.client.get("/api/refs?search=chab&page=2"))
+        self.assertEqual(entry["reasons"], ["request"])
+        self.assertEqual(entry["method"], "GET")
+        self.assertEqual(entry["route"], "api/refs")
+        self.assertEqual(entry["path"], "/api/refs")
+        self.assertEqual(entry["params"], {"search": ["chab"], "page": ["2"]})
+        self.assertEqual(entry["user"], self.user.get_username())
+        self.assertEqual(entry["status"], 200)
+        self.assertEqual(entry["queries"], len(queries))
+        self.assertEqual(len(entry["statements"]), len(queries))
+        self.assertTrue(any('"cave_reference"' in s["sql"] for s in entry["statements"]))
+        self.assertEqual(entry["statements_omitted"], 0)
+        self.assertTrue(all(s["ms"] >= 0 and "plan" not in s for s in entry["statements"]))
+
+    @override_settings(SLOW_QUERY_MS=0)
+    def test_slow_query_is_logged(self):
+        [entry] = self.slow_entries(lambda: self.client.get(f"/api/ref/{sqid_encode(self.reference.pk)}"))
+        self.assertEqual(entry["reasons"], ["query"])
+
+    @override_settings(SLOW_REQUEST_MS=0, SLOW_REQUEST_EXPLAIN=2)
+    def test_explain_slowest_reads(self):
+        [entry] = self.slow_entries(lambda: self.client.get("/api/refs"))
+        plans = [s["plan"] for s in entry["statements"] if "plan" in s]
+        self.assertEqual(len(plans), 2)
+        for plan in plans:
+            self.assertIn("Plan", plan)
+            self.assertIn("Actual Total Time", plan["Plan"])
+            self.assertIn("Shared Hit Blocks", plan["Plan"])
+
+    @override_settings(SLOW_REQUEST_MS=0, SLOW_REQUEST_EXPLAIN=100)
+    def test_writes_are_not_explained(self):
+        [entry] = self.slow_entries(lambda: self.client.post(
+            "/api/ref", {"name": "Meursault", "category": "White"}, content_type="application/json"
+        ))
+        self.assertEqual(entry["status"], 200)
+        self.assertEqual(Reference.objects.filter(name="Meursault").count(), 1)
+        for statement in entry["statements"]:
+            if "plan" in statement:
+                self.assertRegex(statement["sql"], r"^\s*(SELECT|WITH)")
+                self.assertNotIn("FOR UPDATE", statement["sql"])
+        self.assertTrue(any(s["sql"].startswith("INSERT") and "plan" not in s for s in entry["statements"]))
+
+    def test_explain_never_runs_writes(self):
+        self.assertIsNone(slowlog.explain("DELETE FROM cave_reference", ()))
+        self.assertIsNone(slowlog.explain("SELECT nextval('cave_reference_id_seq')", ()))
+        self.assertIsNone(slowlog.explain('SELECT 1 FROM "cave_reference" FOR UPDATE', ()))
+        self.assertEqual(Reference.objects.count(), 1)
+        self.assertIn("error", slowlog.explain("SELECT * FROM nope", ()))
+        self.assertEqual(Reference.objects.count(), 1)
+
+    def test_session_and_user_params_are_redacted(self):
+        session_key = self.client.session.session_key
+        timer = timing.Timer()
+        with connection.execute_wrapper(timer):
+            SessionStore(session_key).load()
+            User.objects.get(pk=self.user.pk)
+        request = RequestFactory().get("/api/refs")
+        request.user = self.user
+        entry = slowlog.entry(request, HttpResponse(), timer, timer.metrics(), ["query"])
+        self.assertEqual([s["params"] for s in entry["statements"]], [slowlog.REDACTED] * 2)
+        self.assertNotIn(session_key, json.dumps(entry, default=str))
+        self.assertIsNone(slowlog.explain('SELECT * FROM "django_session" WHERE session_key = %s', ("x",)))
+
+    @override_settings(SLOW_REQUEST_MS=0, SLOW_REQUEST_EXPLAIN=1)
+    def test_explain_runs_after_the_response(self):
+        request = RequestFactory().get("/api/refs")
+        request.user = self.user
+        response = HttpResponse()
+        timer = timing.Timer()
+        with connection.execute_wrapper(timer):
+            Reference.objects.count()
+        with self.assertNoLogs("cave.slow", "WARNING"):
+            slowlog.record(request, response, timer, timer.metrics())
+        # The callbacks response.close() runs, without its request_finished
+        # signal, which would close the test's connection.
+        with self.assertLogs("cave.slow", "WARNING") as logs:
+            for closer in response._resource_closers:
+                closer()
+        [statement] = json.loads(logs.records[0].getMessage())["statements"]
+        self.assertIn("Plan", statement["plan"])
+
+
+class ProfilingTest(AuthenticatedTestCase):
+    """Test on-demand profiling of staff requests."""
+
+    def setUp(self):
+        super().setUp()
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+        cache.clear()
+
+    def assertCollapsed(self, stacks, samples):
+        lines = stacks.splitlines()
+        for line in lines:
+            self.assertRegex(line, r"^\S.* \d+$")
+        self.assertEqual(sum(int(line.rsplit(" ", 1)[1]) for line in lines), samples)
+
+    def test_staff_request_is_profiled(self):
+        response = self.client.get("/api/refs", HTTP_X_PROFILE="1")
+        self.assertEqual(response.status_code, 200)
+        profile = Profile.objects.get()
+        self.assertEqual(response["X-Profile"], f"/backoffice/cave/profile/{profile.pk}/download/")
+        self.assertEqual(profile.user, self.user)
+        self.assertEqual((profile.method, profile.path, profile.route), ("GET", "/api/refs", "api/refs"))
+        self.assertEqual(profile.status, 200)
+        self.assertGreater(profile.duration_ms, 0)
+        self.assertCollapsed(profile.stacks, profile.samples)
+
+        download = self.client.get(response["X-Profile"])
+        self.assertEqual(download.status_code, 200)
+        self.assertEqual(download["Content-Disposition"], f'attachment; filename="profile-{profile.pk}.folded"')
+        self.assertEqual(download.content.decode(), profile.stacks)
+        listing = self.client.get("/backoffice/cave/profile/")
+        self.assertContains(listing, response["X-Profile"])
+
+    def test_query_parameter(self):
+        response = self.client.get("/api/refs?profile&search=chab")
+        self.assertIn("X-Profile", response)
+        self.assertEqual(Profile.objects.get().path, "/api/refs?profile&search=chab")
+
+    def test_only_staff_and_only_on_demand(self):
+        self.assertNotIn("X-Profile", self.client.get("/api/refs"))
+        self.user.is_staff = False
+        self.user.is_superuser = False
+        self.user.save()
+        cache.clear()
+        response = self.client.get("/api/refs?profile", HTTP_X_PROFILE="1")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Profile", response)
+        self.assertFalse(Profile.objects.exists())
+
+    def test_download_is_staff_only(self):
+        self.client.get("/api/refs?profile")
+        url = reverse("admin:cave_profile_download", args=[Profile.objects.get().pk])
+        self.assertEqual(Client().get(url).status_code, 302)
+
+    @override_settings(PROFILE_KEEP=2)
+    def test_keeps_latest_profiles(self):
+        for _ in range(3):
+            self.client.get("/api/refs?profile")
+        self.assertEqual(Profile.objects.count(), 2)
+        self.assertEqual(Profile.objects.first().pk, Profile.objects.aggregate(Max("pk"))["pk__max"])
+
+    def test_sampler_collects_stacks(self):
+        def spin(seconds):
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                pass
+
+        with profiling.Sampler(0.001) as sampler:
+            spin(0.05)
+        self.assertGreater(sampler.samples, 10)
+        self.assertCollapsed(sampler.collapsed(), sampler.samples)
+        heaviest = sampler.collapsed().splitlines()[0]
+        self.assertRegex(heaviest, r"^ProfilingTest\.test_sampler_collects_stacks\.<locals>\.spin \(cave/tests\.py:\d+\) \d+$")
+
+    def test_streaming_response(self):
+        response = self.client.get("/api/export/csv?profile")
+        self.assertTrue(response.streaming)
+        profile = Profile.objects.get()
+        self.assertEqual(response["X-Profile"], f"/backoffice/cave/profile/{profile.pk}/download/")
+        before = profile.duration_ms
+        b"".join(response.streaming_content)
+        profile.refresh_from_db()
+        self.assertGreaterEqual(profile.duration_ms, before)
+        self.assertCollapsed(profile.stacks, profile.samples)
+
+    def test_stream_samples_are_added(self):
+        def chunks():
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+            yield b"done"
+
+        with profiling.Sampler(0.001) as sampler:
+            pass
+        profile = Profile.objects.create(
+            method="GET", path="/", route="", status=200, duration_ms=0,
+            interval_ms=1, samples=0, stacks="",
+        )
+        self.assertEqual(list(profiling.stream(profile, sampler, chunks())), [b"done"])
+        profile.refresh_from_db()
+        self.assertGreater(profile.samples, 10)
+        self.assertGreaterEqual(profile.duration_ms, 50)
+        self.assertCollapsed(profile.stacks, profile.samples)
+        self.assertIn("chunks", profile.stacks.splitlines()[0])
+
+    def test_overlapping_samplers_restore_switch_interval(self):
+        original = sys.getswitchinterval()
+        first, second = profiling.Sampler(0.001), profiling.Sampler(0.001)
+        first.__enter__()
+        second.__enter__()
+        first.__exit__(None, None, None)
+        self.assertEqual(sys.getswitchinterval(), 0.001)
+        second.__exit__(None, None, None)
+        self.assertEqual(sys.getswitchinterval(), original)
+
+
+class HealthCheckMiddlewareTest(TestCase):
+    """Test probes answered ahead of the middleware stack."""
+
+    def test_healthcheck_skips_stack(self):
+        """Healthcheck should not touch the database or set cookies"""
+        client = Client()
+        with self.assertNumQueries(0):
+            response = client.get("/api/healthcheck")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {})
+        self.assertEqual(len(response.cookies), 0)
+
+    def test_readiness_reports_db_latency(self):
+        """Readiness should run one query and report latency and pool state"""
+        client = Client()
+        with self.assertNumQueries(1):
+            response = client.get("/api/readiness")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["status"], "ok")
+        self.assertGreaterEqual(data["db_latency_ms"], 0)
+        self.assertIn("max_age", data["pool"])
+
+    def test_readiness_unavailable_on_db_error(self):
+        """Readiness should return 503 when the database is unreachable"""
+        client = Client()
+        with patch("cave.middleware.connection.cursor", side_effect=OperationalError("down")):
+            response = client.get("/api/readiness")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["status"], "unavailable")
+
+    def test_readiness_does_not_leak_db_error(self):
+        """Driver errors name hosts and users: they are logged, not returned"""
+        error = OperationalError('connection to server at "db.internal", user "gibolin" failed')
+        with patch("cave.middleware.connection.cursor", side_effect=error), \
+                self.assertLogs("cave.middleware", "ERROR") as logs:
+            response = Client().get("/api/readiness")
+        self.assertNotIn("db.internal", response.content.decode())
+        self.assertIn("db.internal", logs.output[0])
+
+
+@override_settings(DEBUG=True)
+class DevAutoLoginMiddlewareTest(TestCase):
+    """Test dev auto-login resolves the staff user once."""
+
+    def test_logs_in_staff_user(self):
+        User.objects.create_user(email="staff@example.com", password="x", is_staff=True)
+        response = Client().get("/api/me")
+        self.assertEqual(response.json()["email"], "staff@example.com")
+
+    def test_staff_user_resolved_once(self):
+        User.objects.create_user(email="staff@example.com", password="x", is_staff=True)
+        get_dev_user()
+        with self.assertNumQueries(0):
+            get_dev_user()
+
+    def test_demoted_or_deleted_user_is_dropped(self):
+        staff = User.objects.create_user(email="staff@example.com", password="x", is_staff=True)
+        other = User.objects.create_user(email="other@example.com", password="x", is_staff=True)
+        self.assertEqual(get_dev_user(), staff)
+        staff.is_staff = False
+        staff.save()
+        self.assertEqual(get_dev_user(), other)
+        other.delete()
+        self.assertIsNone(get_dev_user())
+        self.assertEqual(Client().get("/api/me").status_code, 401)
+
+
+class CachedAuthTest(TestCase):
+    """Test session and user resolution through the cache."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="cached@example.com", password="test"
+        )
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def test_warm_request_does_no_queries(self):
+        """A second authenticated request should not touch the database"""
+        self.client.get("/api/me")
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/me")
+        self.assertEqual(response.status_code, 200)
+
+    def test_user_change_invalidates_cache(self):
+        """Saving the user should drop the cached copy"""
+        self.client.get("/api/me")
+        self.user.email = "renamed@example.com"
+        self.user.save()
+        response = self.client.get("/api/me")
+        self.assertEqual(response.json()["email"], "renamed@example.com")
+
+    def test_password_change_ends_session(self):
+        """A stale cached user must not outlive a password change"""
+        self.client.get("/api/me")
+        self.user.set_password("changed")
+        self.user.save()
+        response = self.client.get("/api/me")
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout_invalidates_cache(self):
+        """Logout should remove the cached user"""
+        self.client.get("/api/me")
+        self.assertIsNotNone(cache.get(_user_cache_key(self.user.pk)))
+        self.client.get("/logout/")
+        self.assertIsNone(cache.get(_user_cache_key(self.user.pk)))
+
+    def test_oidc_session_refresh_does_no_queries(self):
+        """SessionRefresh reads the cached session and user only"""
+        client = Client()
+        client.force_login(self.user, backend="cave.auth.GibolinOIDCBackend")
+        session = client.session
+        session["oidc_id_token_expiration"] = time.time() + 3600
+        session.save()
+        middleware = [*settings.MIDDLEWARE, "mozilla_django_oidc.middleware.SessionRefresh"]
+        # The OIDC views are only routed when OIDC is configured.
+        with override_settings(MIDDLEWARE=middleware), patch.object(SessionRefresh, "exempt_urls", set()):
+            client.get("/api/me")
+            with self.assertNumQueries(0):
+                response = client.get("/api/me")
+        self.assertEqual(response.status_code, 200)
+
+
 class CleanupOrphanedLookupsCommandTest(TestCase):
     """Test the cleanup_orphaned_lookups management command."""
 
@@ -0,0 +1,126 @@
+"""Per-request timings for ServerTimingMiddleware.
+
+The middleware puts a Timer on the request and installs it as a database
+execute wrapper, so every query adds to the request's DB time. The API's
+router and NinjaAPI below add the time spent in the view and in
+serializing its result (response schema validation, then JSON), and
+views can time other work, such as rendering a template, with phase().
+Each phase excludes the queries run during it, which are already
+counted as DB time: lazy querysets evaluated while serializing show up
+as DB, not serialization.
+"""
+
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+import ninja
+
+# Statements kept per request for the slow request log.
+MAX_STATEMENTS = 500
+
+
+class Timer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db = 0.0
+        self.queries = 0
+        self.phases = {}
+        self.view_returned = None
+        # (sql, params, many, seconds) of the first MAX_STATEMENTS queries.
+        self.statements = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.db += elapsed
+            self.queries += 1
+            if len(self.statements) < MAX_STATEMENTS:
+                self.statements.append((sql, params, many, elapsed))
+
+    def mark(self):
+        return time.perf_counter(), self.db
+
+    def add(self, name, mark):
+        started, db = mark
+        own = time.perf_counter() - started - (self.db - db)
+        self.phases[name] = self.phases.get(name, 0.0) + own
+
+    @contextmanager
+    def phase(self, name):
+        mark = self.mark()
+        try:
+            yield
+        finally:
+            self.add(name, mark)
+
+    def metrics(self):
+        """Milliseconds per phase, DB time and query count, and the total."""
+        metrics = {
+            "total_ms": (time.perf_counter() - self.started) * 1000,
+            "db_ms": self.db * 1000,
+            "queries": self.queries,
+        }
+        metrics.update((f"{name}_ms", seconds * 1000) for name, seconds in self.phases.items())
+        return {key: round(value, 2) for key, value in metrics.items()}
+
+    def header(self, metrics):
+        """A Server-Timing header value for metrics()."""
+        entries = [f'db;dur={metrics["db_ms"]};desc="{metrics["queries"]} queries"']
+        entries += [
+            f"{key[:-3]};dur={value}" for key, value in metrics.items()
+            if key.endswith("_ms") and key not in ("db_ms", "total_ms")
+        ]
+        entries.append(f"total;dur={metrics['total_ms']}")
+        return ", ".join(entries)
+
+
+def phase(request, name):
+    """Time a block as a phase of the request, when it is being timed."""
+    timer = getattr(request, "timer", None)
+    return timer.phase(name) if timer else nullcontext()
+
+
+def timed_view(view_func):
+    @wraps(view_func)
+    def view(request, *args, **kwargs):
+        timer = getattr(request, "timer", None)
+        if timer is None:
+            return view_func(request, *args, **kwargs)
+        with timer.phase("view"):
+            result = view_func(request, *args, **kwargs)
+        timer.view_returned = timer.mark()
+        return result
+
+    return view
+
+
+class Router(ninja.Router):
+    """Router timing every operation's view."""
+
+    def add_api_operation(self, path, methods, view_func, **kwargs):
+        super().add_api_operation(path, methods, timed_view(view_func), **kwargs)
+
+
+class NinjaAPI(ninja.NinjaAPI):
+    """NinjaAPI timing the serialization of view results.
+
+    Ninja validates the result against the response schema, then renders
+    it through create_response: serialization runs from the view's return
+    to the end of create_response.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("default_router", Router())
+        super().__init__(**kwargs)
+
+    def create_response(self, request, data, **kwargs):
+        response = super().create_response(request, data, **kwargs)
+        timer = getattr(request, "timer", None)
+        if timer is not None and timer.view_returned is not None:
+            timer.add("serialize", timer.view_returned)
+            timer.view_returned = None
+        return response
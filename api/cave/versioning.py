@@ -0,0 +1,181 @@
+"""Cellar-wide change version used for ETags and delta sync.
+
+Every write bumps a single-row counter inside its own transaction, so the
+version is exactly as visible as the data it describes. Committed values
+are published to the shared cache, which lets read endpoints answer
+conditional requests without touching the database. TrackedModel.save
+stamps rows with the version; the receivers below cover deletions,
+grape changes and the menu template.
+"""
+
+from functools import wraps
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils.cache import patch_cache_control
+from django.utils import timezone
+from django.utils.http import quote_etag
+from django.views.decorators.http import condition
+
+from .auth import user_token
+from .models import (
+    Appellation, Category, CellarVersion, Format, Grape, MenuTemplate, Purchase,
+    Reference, Region, Tombstone,
+)
+
+VERSION_CACHE_KEY = "cave:cellar-version"
+
+LOOKUP_MODELS = [Category, Region, Appellation, Format, Grape]
+
+
+# pg_advisory_xact_lock key serializing publications across workers.
+PUBLISH_LOCK = 0x67696230
+
+
+def cellar_changed():
+    """Bump the cellar version; publish it to the cache once committed."""
+    version = CellarVersion.bump()
+    transaction.on_commit(lambda: publish_version(version))
+    return version
+
+
+def publish_version(version):
+    """Publish the committed version to the cache, which only moves forward.
+
+    Workers may run their commit callbacks in another order than they
+    committed, so the value written is the row read under a lock rather
+    than the version this worker wrote.
+    """
+    published = cache.get(VERSION_CACHE_KEY)
+    if published is not None and published >= version:
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [PUBLISH_LOCK])
+        current = CellarVersion.objects.filter(pk=1).values_list("version", flat=True).first()
+        cache.set(VERSION_CACHE_KEY, max(current or 0, version), None)
+
+
+def touch(queryset, version=None, **fields):
+    """Update rows outside of save() (update(), m2m, cascades) and stamp them."""
+    with transaction.atomic():
+        return queryset.update(
+            version=version or cellar_changed(), updated_at=timezone.now(), **fields
+        )
+
+
+def get_cellar_version():
+    """Return the current version, from the cache outside of transactions.
+
+    Inside an atomic block the cache may not reflect the transaction's own
+    writes, so the row is read directly.
+    """
+    if not connection.in_atomic_block:
+        version = cache.get(VERSION_CACHE_KEY)
+        if version is not None:
+            return version
+    version = (
+        CellarVersion.objects.filter(pk=1).values_list("version", flat=True).first()
+        or 0
+    )
+    if not connection.in_atomic_block:
+        cache.add(VERSION_CACHE_KEY, version, None)
+    return version
+
+
+def request_cellar_version(request):
+    if not hasattr(request, "_cellar_version"):
+        request._cellar_version = get_cellar_version()
+    return request._cellar_version
+
+
+def cellar_etag(request, *args, **kwargs):
+    # Scoped to the user so a shared browser never revalidates another
+    # user's representation.
+    if not request.user.is_authenticated:
+        return None
+    return quote_etag(f"{request_cellar_version(request)}.{request.user.pk}")
+
+
+def cellar_user_etag(request, *args, **kwargs):
+    # For representations that include the user, which change with it.
+    if not request.user.is_authenticated:
+        return None
+    return quote_etag(
+        f"{request_cellar_version(request)}.{request.user.pk}.{user_token(request.user.pk)}"
+    )
+
+
+def cellar_conditional(view, etag_func=cellar_etag):
+    """Answer If-None-Match from the cellar version.
+
+    There is no Last-Modified: its whole seconds would hide a second write
+    within the same second, and answer it with a stale 304. Responses are
+    marked no-cache so browsers always revalidate.
+    """
+    conditional_view = condition(etag_func=etag_func)(view)
+
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    return inner
+
+
+@receiver(post_save, sender=MenuTemplate)
+@receiver(post_delete, sender=MenuTemplate)
+def _on_menu_template_change(sender, **kwargs):
+    cellar_changed()
+
+
+def _on_tracked_delete(sender, instance, **kwargs):
+    Tombstone.objects.create(
+        model=sender._meta.model_name, object_id=instance.pk, version=cellar_changed()
+    )
+
+
+for _model in [Reference, *LOOKUP_MODELS]:
+    post_delete.connect(_on_tracked_delete, sender=_model, dispatch_uid=f"tombstone-{_model.__name__}")
+
+
+def _on_lookup_pre_delete(sender, instance, **kwargs):
+    # References are about to lose this lookup through SET_NULL.
+    touch(instance.references.all())
+
+
+for _model in LOOKUP_MODELS:
+    pre_delete.connect(_on_lookup_pre_delete, sender=_model, dispatch_uid=f"lookup-pre-delete-{_model.__name__}")
+
+
+@receiver(post_save, sender=Purchase)
+def _on_purchase_save(sender, instance, **kwargs):
+    # Purchases are synced embedded in their reference.
+    touch(Reference.objects.filter(pk=instance.reference_id), instance.version)
+
+
+@receiver(post_delete, sender=Purchase)
+def _on_purchase_delete(sender, instance, **kwargs):
+    touch(Reference.objects.filter(pk=instance.reference_id))
+
+
+@receiver(m2m_changed, sender=Reference.grapes.through)
+def _on_grapes_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove"):
+        pks = pk_set if reverse else [instance.pk]
+    elif reverse and action == "pre_clear":
+        pks = list(instance.references.values_list("pk", flat=True))
+    elif not reverse and action == "post_clear":
+        pks = [instance.pk]
+    else:
+        return
+    touch(Reference.objects.filter(pk__in=pks))
+
+
+@receiver(post_migrate)
+def _on_migrate(sender, **kwargs):
+    # Deploys run migrate, so cached representations from older code expire.
+    if sender.name == "cave" and CellarVersion._meta.db_table in connection.introspection.table_names():
+        cellar_changed()
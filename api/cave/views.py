@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.contrib.auth import logout
+from django.http import Http404, HttpResponse
 from django.shortcuts import redirect
+from django.utils.crypto import constant_time_compare
 from django_ratelimit.decorators import ratelimit
 from mozilla_django_oidc.views import OIDCAuthenticationRequestView
 
+from . import metrics
+
 
 class RateLimitedOIDCLoginView(OIDCAuthenticationRequestView):
     """OIDC login with rate limiting to prevent abuse."""
@@ -15,3 +20,19 @@ class RateLimitedOIDCLoginView(OIDCAuthenticationRequestView):
 def logout_view(request):
     logout(request)
     return redirect("/")
+
+
+def metrics_view(request):
+    """Prometheus exposition of the metrics of every worker.
+
+    Without METRICS_TOKEN it is only served in development.
+    """
+    if not settings.METRICS_TOKEN:
+        if not settings.DEBUG:
+            raise Http404
+    elif not constant_time_compare(
+        request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"
+    ):
+        return HttpResponse("Unauthorized", status=401)
+    body, content_type = metrics.render()
+    return HttpResponse(body, content_type=content_type)
@@ -10,7 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import atexit
 import os
+import shutil
+import sys
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -57,13 +61,18 @@ CORS_ALLOWED_ORIGINS = os.getenv(
 ).split(",")
 
 MIDDLEWARE = [
+    "cave.middleware.HealthCheckMiddleware",
+    "cave.middleware.ServerTimingMiddleware",
+    "cave.middleware.MetricsMiddleware",
+    "cave.middleware.CompressionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "cave.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "cave.middleware.CachedAuthenticationMiddleware",
+    "cave.middleware.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -83,11 +92,15 @@ AUTHENTICATION_BACKENDS = [
     "django.contrib.auth.backends.ModelBackend",
 ]
 
-# Add SessionRefresh when OIDC is configured, or DevAutoLogin in dev
+# Add SessionRefresh when OIDC is configured, or DevAutoLogin in dev. The
+# dev user is logged in before ProfilingMiddleware checks it is staff.
 if OIDC_ENABLED:
     MIDDLEWARE.append("mozilla_django_oidc.middleware.SessionRefresh")
 elif DEBUG:
-    MIDDLEWARE.append("cave.middleware.DevAutoLoginMiddleware")
+    MIDDLEWARE.insert(
+        MIDDLEWARE.index("cave.middleware.ProfilingMiddleware"),
+        "cave.middleware.DevAutoLoginMiddleware",
+    )
 
 ROOT_URLCONF = "gibolin.urls"
 
@@ -124,6 +137,86 @@ DATABASES = {
     }
 }
 
+# Cache
+# File-based so that gunicorn workers share sessions, cached users and
+# invalidations without requiring an external service. The backend also
+# counts hits and misses for /metrics.
+
+CACHES = {
+    "default": {
+        "BACKEND": "cave.metrics.FileBasedCache",
+        "LOCATION": os.getenv("CACHE_DIR", "/tmp/gibolin-cache"),
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
+}
+
+# Tests and benchmarks clear the cache: each run gets its own directory
+# rather than wiping the sessions of a running server.
+if sys.argv[1:2] in (["test"], ["benchmark"]):
+    CACHES["default"]["LOCATION"] = tempfile.mkdtemp(prefix="gibolin-cache-")
+    atexit.register(shutil.rmtree, CACHES["default"]["LOCATION"], ignore_errors=True)
+
+# Point of sale
+# Ids of applied sale events are kept POS_EVENT_RETENTION_DAYS so that
+# replays are skipped; older ones are pruned after each ingestion.
+POS_EVENT_RETENTION_DAYS = int(os.getenv("POS_EVENT_RETENTION_DAYS", "90"))
+
+# Profiling
+# Staff requests with an X-Profile header or a profile query parameter are
+# sampled every PROFILE_INTERVAL_MS (see cave.profiling). The latest
+# PROFILE_KEEP profiles are kept, in the backoffice.
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+
+# Logging
+# ServerTimingMiddleware logs one JSON line per request to cave.requests;
+# REQUEST_LOG_LEVEL=WARNING turns it off. Requests slower than
+# SLOW_REQUEST_MS, or with a query slower than SLOW_QUERY_MS, go to the
+# slow request log (cave.slow), a rotating JSON lines file at SLOW_LOG_FILE,
+# with their SQL. SLOW_REQUEST_EXPLAIN=N adds EXPLAIN (ANALYZE, BUFFERS)
+# plans of their N slowest reads. Empty thresholds turn them off.
+
+
+def _milliseconds(name, default):
+    value = os.getenv(name, default)
+    return float(value) if value else None
+
+
+SLOW_REQUEST_MS = _milliseconds("SLOW_REQUEST_MS", "1000")
+SLOW_QUERY_MS = _milliseconds("SLOW_QUERY_MS", "250")
+SLOW_REQUEST_EXPLAIN = int(os.getenv("SLOW_REQUEST_EXPLAIN", "0"))
+SLOW_LOG_FILE = os.getenv("SLOW_LOG_FILE", "/tmp/gibolin-slow.jsonl")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+        "slow_file": {
+            "class": "logging.handlers.RotatingFileHandler",
+            "filename": SLOW_LOG_FILE,
+            "maxBytes": 10 * 1024 * 1024,
+            "backupCount": 5,
+            "encoding": "utf-8",
+            "delay": True,
+        },
+    },
+    "loggers": {
+        "cave.requests": {
+            "handlers": ["console"],
+            "level": os.getenv("REQUEST_LOG_LEVEL", "INFO"),
+            "propagate": False,
+        },
+        "cave.slow": {"handlers": ["slow_file"], "level": "WARNING", "propagate": False},
+    },
+}
+
+# Metrics
+# Scrapers of /metrics send METRICS_TOKEN as "Authorization: Bearer <token>".
+# Without a token, /metrics is only served when DEBUG is on.
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 # Custom user model
 AUTH_USER_MODEL = "users.User"
 
@@ -167,6 +260,9 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 # Vite builds frontend assets with root-relative paths (/assets/...).
 # WHITENOISE_ROOT serves them at the root URL path, matching what the HTML expects.
 WHITENOISE_ROOT = str(BASE_DIR / ".." / "ui" / "dist")
+# Vite content-hashes everything under /assets/, so browsers may keep it forever
+# (see cave.middleware.WhiteNoiseMiddleware). Precompressed .br/.gz siblings
+# are generated at build time (see Dockerfile.prod).
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -179,6 +275,7 @@ _scs = os.getenv("SESSION_COOKIE_SECURE")
 SESSION_COOKIE_SECURE = _scs.lower() in ("true", "1", "yes") if _scs is not None else not DEBUG
 SESSION_COOKIE_SAMESITE = "Lax"
 SESSION_COOKIE_AGE = 86400 * 7  # 1 week
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
 
 LOGIN_REDIRECT_URL = "/"
 LOGOUT_REDIRECT_URL = "/"
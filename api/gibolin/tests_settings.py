@@ -34,3 +34,15 @@ class SessionCookieSecureSettingTest(TestCase):
             "SESSION_COOKIE_SECURE": "true",
         })
         self.assertTrue(s.SESSION_COOKIE_SECURE)
+
+
+class MiddlewareOrderTest(TestCase):
+    def test_dev_user_is_logged_in_before_profiling(self):
+        import gibolin.settings as settings_module
+        with patch.dict("os.environ", {"DEBUG": "true", "OIDC_RP_CLIENT_ID": ""}, clear=False):
+            importlib.reload(settings_module)
+        middleware = settings_module.MIDDLEWARE
+        self.assertLess(
+            middleware.index("cave.middleware.DevAutoLoginMiddleware"),
+            middleware.index("cave.middleware.ProfilingMiddleware"),
+        )
@@ -5,6 +5,7 @@ The `urlpatterns` list routes URLs to views. For more information please see:
     https://docs.djangoproject.com/en/5.0/topics/http/urls/
 """
 
+import hashlib
 import os
 
 from django.contrib import admin
@@ -12,28 +13,57 @@ from django.http import HttpResponse
 from django.urls import include, path, re_path
 from django.conf import settings
 from django.conf.urls.static import static
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views.decorators.csrf import ensure_csrf_cookie
 
 from cave.api import api as cave_api
-from cave.views import logout_view
+from cave.compression import precompress
+from cave.views import logout_view, metrics_view
+
+
+SPA_INDEX_PATH = os.path.join(settings.BASE_DIR, "..", "ui", "dist", "index.html")
+SPA_MAX_AGE = 60
+
+_spa_shell = {"mtime": None, "content": None, "etag": None, "precompressed": None}
+
+
+def _load_spa_shell():
+    """Return index.html state, re-reading and recompressing it only when it changes."""
+    mtime = os.stat(SPA_INDEX_PATH).st_mtime_ns
+    if _spa_shell["mtime"] != mtime:
+        with open(SPA_INDEX_PATH, "rb") as f:
+            content = f.read()
+        _spa_shell.update(
+            mtime=mtime,
+            content=content,
+            etag=f'"{hashlib.md5(content).hexdigest()}"',
+            precompressed=precompress(content),
+        )
+    return _spa_shell
 
 
 @ensure_csrf_cookie
 def spa_catchall(request):
-    index_path = os.path.join(settings.BASE_DIR, "..", "ui", "dist", "index.html")
     try:
-        with open(index_path) as f:
-            return HttpResponse(f.read(), content_type="text/html")
+        shell = _load_spa_shell()
     except FileNotFoundError:
         return HttpResponse(
             "Frontend not built. Run: cd ui && npm run build", status=501
         )
+    response = get_conditional_response(request, etag=shell["etag"])
+    if response is None:
+        response = HttpResponse(shell["content"], content_type="text/html")
+        response.precompressed = shell["precompressed"]
+    response["ETag"] = shell["etag"]
+    patch_cache_control(response, private=True, max_age=SPA_MAX_AGE)
+    return response
 
 
 urlpatterns = [
     path("backoffice/", admin.site.urls),
     path("api/", cave_api.urls),
     path("logout/", logout_view, name="logout"),
+    path("metrics", metrics_view, name="metrics"),
 ]
 
 if settings.OIDC_ENABLED:
@@ -0,0 +1,22 @@
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # Drop the in-flight gauge of workers that exit; their counters and
+    # histograms keep counting towards the totals.
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # Load the lookup id cache before the first request. When the database
+    # is not reachable yet, the first write request loads it instead.
+    from django.db import DatabaseError, connections
+
+    from cave import lookup_cache
+
+    try:
+        lookup_cache.warm()
+    except DatabaseError:
+        pass
+    finally:
+        connections.close_all()
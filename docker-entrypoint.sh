@@ -1,8 +1,13 @@
 #!/bin/sh
 set -e
+# Gunicorn workers share their metrics through this directory (see cave/metrics.py).
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/gibolin-metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 python manage.py migrate --noinput
 python manage.py cleanup_orphaned_lookups
 exec gunicorn gibolin.wsgi:application \
+    --config gunicorn.conf.py \
     --bind 0.0.0.0:8000 \
     --workers 2 \
     --access-logfile -
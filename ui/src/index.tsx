@@ -68,9 +68,24 @@ export type RefsResponse = {
 // Auth
 type CurrentUser = { email: string };
 
-const fetchCurrentUser = async (): Promise<CurrentUser> => {
-  const response = await fetch(`${API_BASE_URL}/api/me`);
-  if (!response.ok) throw new Error("Unauthorized");
+// Startup data, fetched in one request instead of one per lookup.
+const BOOTSTRAP_LOOKUPS = [
+  "categories",
+  "regions",
+  "appellations",
+  "formats",
+  "grapes",
+  "locations",
+] as const;
+
+type Bootstrap = {
+  config: { oidc_enabled: boolean };
+  me: CurrentUser | null;
+} & Partial<Record<(typeof BOOTSTRAP_LOOKUPS)[number], string[]>>;
+
+const fetchBootstrap = async (): Promise<Bootstrap> => {
+  const response = await fetch(`${API_BASE_URL}/api/bootstrap`);
+  if (!response.ok) throw new Error("Bootstrap failed");
   return response.json();
 };
 
@@ -105,6 +120,7 @@ function ReferenceTable() {
   const [menuTemplate, setMenuTemplate] = React.useState<string>("");
   const [editingQuantity, setEditingQuantity] = React.useState<string | null>(null);
   const [quantityValue, setQuantityValue] = React.useState<number>(0);
+  const [quantityOriginal, setQuantityOriginal] = React.useState<number>(0);
   const [selectedLocation, setSelectedLocation] = React.useState<string | undefined>(undefined);
   const [exportLocation, setExportLocation] = React.useState<string | undefined>(undefined);
   const [hideExportPrices, setHideExportPrices] = React.useState(false);
@@ -226,13 +242,14 @@ function ReferenceTable() {
       }),
   });
 
-  // Update reference quantity
+  // Adjust reference quantity by the edited difference, so concurrent
+  // edits by other users are not overwritten
   const updateQuantityMutation = useMutation({
-    mutationFn: ({ sqid, quantity }: { sqid: string; quantity: number }) =>
-      apiFetch(`${API_BASE_URL}/api/ref/${sqid}/quantity`, {
-        method: 'PUT',
+    mutationFn: ({ sqid, delta }: { sqid: string; delta: number }) =>
+      apiFetch(`${API_BASE_URL}/api/ref/${sqid}/quantity/adjust`, {
+        method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ quantity }),
+        body: JSON.stringify({ delta }),
       }),
     onSuccess: () => {
       queryClient.invalidateQueries({ queryKey: ['references'] });
@@ -281,11 +298,12 @@ function ReferenceTable() {
   const handleQuantityEdit = React.useCallback((sqid: string, currentQuantity: number) => {
     setEditingQuantity(sqid);
     setQuantityValue(currentQuantity);
+    setQuantityOriginal(currentQuantity);
   }, []);
 
   const handleQuantitySave = React.useCallback((sqid: string) => {
-    updateQuantityMutation.mutate({ sqid, quantity: quantityValue });
-  }, [quantityValue, updateQuantityMutation]);
+    updateQuantityMutation.mutate({ sqid, delta: quantityValue - quantityOriginal });
+  }, [quantityValue, quantityOriginal, updateQuantityMutation]);
 
   const handleQuantityCancel = React.useCallback(() => {
     setEditingQuantity(null);
@@ -660,9 +678,17 @@ function LoginPage() {
 
 // eslint-disable-next-line react-refresh/only-export-components
 function App() {
-  const { isLoading, error } = useQuery({
-    queryKey: ["me"],
-    queryFn: fetchCurrentUser,
+  const queryClient = useQueryClient();
+  const { isLoading, error, data } = useQuery({
+    queryKey: ["bootstrap"],
+    queryFn: async () => {
+      const bootstrap = await fetchBootstrap();
+      queryClient.setQueryData(["config"], bootstrap.config);
+      for (const key of BOOTSTRAP_LOOKUPS) {
+        if (bootstrap[key]) queryClient.setQueryData([key], bootstrap[key]);
+      }
+      return bootstrap;
+    },
     retry: false,
   });
 
@@ -674,7 +700,7 @@ function App() {
     );
   }
 
-  if (error) {
+  if (error || !data?.me) {
     return <LoginPage />;
   }
 
@@ -683,6 +709,11 @@ function App() {
 
 // App Setup
 const queryClient = new QueryClient();
+// Lookups are seeded by the bootstrap request and invalidated by mutations,
+// so mounting a form should not refetch them straight away.
+for (const key of BOOTSTRAP_LOOKUPS) {
+  queryClient.setQueryDefaults([key], { staleTime: 60_000 });
+}
 
 const rootElement = document.getElementById("root")!;
 const root = ReactDOM.createRoot(rootElement);